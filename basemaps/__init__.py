@@ -34,8 +34,13 @@ bl_info = {
 	'category': '3D View'
 	}
 
-import bpy
-from .mapviewer import *
+try:
+	import bpy
+except ImportError:
+	#outside Blender, only the tiles services modules are usable (eg. headless cache seeding)
+	pass
+else:
+	from .mapviewer import *
 
 
 def register():
@@ -0,0 +1,396 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+"""
+Export of a map layer area as a georeferenced raster, usable without Blender
+
+The raster is built one row of tiles at a time, so the whole image is never held in memory :
+- GeoTIFF is written uncompressed and tiled, its pixels are memory mapped and filled in place
+  (BigTIFF is used beyond 4GB, note the georaster importer can't read BigTIFF)
+- PNG is compressed on the fly, row after row
+A worldfile is written beside the raster, it's the first georef source searched by the georaster importer
+
+Usage example :
+python -m basemaps.mapexport OSM:MAPNIK /path/to/cache/ /path/to/map.tif --bbox 2.9 45.7 3.2 45.9 --crs 4326 --zoom 15
+"""
+
+#built-in imports
+import os
+import io
+import math
+import struct
+import zlib
+import argparse
+import collections
+
+#deps imports
+import numpy as np
+from PIL import Image
+
+#addon import
+from .mapservice import MapService, reprojBbox
+from .metrics import metrics
+
+
+def worldfilePath(path):
+	'''Worldfile path as searched by the georaster importer, eg. tif --> tfw, png --> pgw'''
+	ext = path[-3:].lower()
+	return path[:-3] + ext[0] + ext[2] + 'w'
+
+def writeWorldfile(path, xmin, ymax, res):
+	'''Write the worldfile of a north up raster from the coords of its top left corner'''
+	#pixel size, rotation terms, then upper left pixel center
+	params = (res, 0, 0, -res, xmin + res / 2, ymax - res / 2)
+	with open(worldfilePath(path), 'w') as f:
+		f.write('\n'.join(repr(float(v)) for v in params) + '\n')
+
+
+class TiffWriter():
+	"""
+	Uncompressed and tiled GeoTIFF, RGB or RGBA 8 bits
+	The tiles data are memory mapped, rows of pixels are written in place in any order
+	"""
+
+	TILE_SIZE = 256 #pixels, must be a multiple of 16
+	ALIGN = 4096 #bytes, tiles data start on a page boundary
+	MAX_SIZE = 2**32 #bytes, classic TIFF offsets are 32 bits, bigger files are written as BigTIFF
+
+	#tags types {name: (code, numpy dtype)}
+	SHORT, LONG, DOUBLE, LONG8 = (3, '<u2'), (4, '<u4'), (12, '<f8'), (16, '<u8')
+
+	def __init__(self, path, width, height, bands, xmin, ymax, res, crs):
+		self.path = path
+		self.width, self.height, self.bands = width, height, bands
+		ts = self.TILE_SIZE
+		self.nx, self.ny = math.ceil(width / ts), math.ceil(height / ts)
+		tileBytes = ts * ts * bands
+		dataSize = tileBytes * self.nx * self.ny
+		self.bigtiff = dataSize + self.ALIGN * 1024 > self.MAX_SIZE
+		if self.bigtiff:
+			print("Raster exceed 4GB, it's written as BigTIFF")
+
+		#Header length doesn't depend on offsets values, so compute it with dummy offsets
+		nbTiles = self.nx * self.ny
+		tags = self.getTags(xmin, ymax, res, crs, [0] * nbTiles, tileBytes)
+		self.dataOffset = math.ceil(len(self.buildHeader(tags)) / self.ALIGN) * self.ALIGN
+		offsets = [self.dataOffset + i * tileBytes for i in range(nbTiles)]
+		header = self.buildHeader(self.getTags(xmin, ymax, res, crs, offsets, tileBytes))
+
+		with open(path, 'wb') as f:
+			f.write(header)
+			#file is extended without writing the tiles, they are filled through the memory map
+			f.truncate(self.dataOffset + dataSize)
+		self.data = np.memmap(path, dtype=np.uint8, mode='r+', offset=self.dataOffset,
+			shape=(self.ny, self.nx, ts, ts, bands))
+
+	def getTags(self, xmin, ymax, res, crs, offsets, tileBytes):
+		'''Return the list of (tag, type, values) of the image file directory'''
+		ts = self.TILE_SIZE
+		offsetType = self.LONG8 if self.bigtiff else self.LONG
+		tags = [
+			(256, self.LONG, [self.width]), #ImageWidth
+			(257, self.LONG, [self.height]), #ImageLength
+			(258, self.SHORT, [8] * self.bands), #BitsPerSample
+			(259, self.SHORT, [1]), #Compression : none
+			(262, self.SHORT, [2]), #PhotometricInterpretation : RGB
+			(277, self.SHORT, [self.bands]), #SamplesPerPixel
+			(284, self.SHORT, [1]), #PlanarConfiguration : chunky
+			(322, self.LONG, [ts]), #TileWidth
+			(323, self.LONG, [ts]), #TileLength
+			(324, offsetType, offsets), #TileOffsets
+			(325, offsetType, [tileBytes] * len(offsets)), #TileByteCounts
+			(339, self.SHORT, [1] * self.bands), #SampleFormat : uint
+			(33550, self.DOUBLE, [res, res, 0]), #ModelPixelScale
+			(33922, self.DOUBLE, [0, 0, 0, xmin, ymax, 0]) #ModelTiepoint, top left corner
+		]
+		if self.bands == 4:
+			tags.append((338, self.SHORT, [2])) #ExtraSamples : unassociated alpha
+		#GeoKeyDirectory : version, revision, minor revision, number of keys, then (key, location, count, value)
+		if crs == 4326:
+			keys = [(1024, 0, 1, 2), (1025, 0, 1, 1), (2048, 0, 1, crs)] #geographic model, pixel is area, EPSG
+		else:
+			keys = [(1024, 0, 1, 1), (1025, 0, 1, 1), (3072, 0, 1, crs)] #projected model, pixel is area, EPSG
+		tags.append((34735, self.SHORT, [1, 1, 0, len(keys)] + [v for key in keys for v in key]))
+		return sorted(tags, key=lambda tag: tag[0])
+
+	def buildHeader(self, tags):
+		'''Return file header, image file directory and the tags values not fitting in directory entries'''
+		if self.bigtiff:
+			head = struct.pack('<2sHHHQ', b'II', 43, 8, 0, 16)
+			countFmt, entryFmt, pointerFmt = '<Q', '<HHQ', '<Q'
+		else:
+			head = struct.pack('<2sHL', b'II', 42, 8)
+			countFmt, entryFmt, pointerFmt = '<H', '<HHL', '<L'
+		inline = struct.calcsize(pointerFmt)
+		ifdSize = struct.calcsize(countFmt) + len(tags) * (struct.calcsize(entryFmt) + inline) + inline
+		extraOffset = len(head) + ifdSize
+		entries, extra = [], b''
+		for tag, (code, dtype), values in tags:
+			data = np.asarray(values, dtype=dtype).tobytes()
+			if len(data) <= inline:
+				value = data.ljust(inline, b'\0')
+			else:
+				value = struct.pack(pointerFmt, extraOffset + len(extra))
+				extra += data + b'\0' * (len(data) % 2) #values start on a word boundary
+			entries.append(struct.pack(entryFmt, tag, code, len(values)) + value)
+		ifd = struct.pack(countFmt, len(tags)) + b''.join(entries) + struct.pack(pointerFmt, 0)
+		return head + ifd + extra
+
+	def writeRows(self, y, rows):
+		'''Write an array of full width rows of pixels (height, width, bands) starting at row y'''
+		ts = self.TILE_SIZE
+		h = rows.shape[0]
+		if self.width % ts:
+			padded = np.zeros((h, self.nx * ts, self.bands), dtype=np.uint8)
+			padded[:, :self.width] = rows
+			rows = padded
+		i = 0
+		while i < h:
+			ty, r = divmod(y + i, ts)
+			n = min(ts - r, h - i)
+			self.data[ty, :, r:r+n] = rows[i:i+n].reshape(n, self.nx, ts, self.bands).swapaxes(0, 1)
+			i += n
+		#write back modified pages, they can be then freed by the system
+		self.data.flush()
+
+	def close(self):
+		if self.data is not None:
+			self.data.flush()
+			self.data = None
+
+
+class PngWriter():
+	"""
+	PNG compressed on the fly, RGB or RGBA 8 bits
+	Rows of pixels must be written in order, from top to bottom
+	"""
+
+	IDAT_SIZE = 2**20 #bytes, compressed data are written by chunks of this size
+	BLOCK_ROWS = 16 #number of rows filtered at once, limit the size of temporary arrays
+
+	def __init__(self, path, width, height, bands, level=6):
+		self.width, self.height, self.bands = width, height, bands
+		self.f = open(path, 'wb')
+		self.f.write(b'\x89PNG\r\n\x1a\n')
+		colorType = 6 if bands == 4 else 2 #RGBA or RGB
+		self.writeChunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, colorType, 0, 0, 0))
+		self.compressor = zlib.compressobj(level)
+		self.pending = b''
+		self.y = 0
+		self.prevRow = np.zeros(width * bands, dtype=np.uint8) #row above the first one is zeros
+
+	def writeChunk(self, tag, data):
+		self.f.write(struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+
+	def writeRows(self, y, rows):
+		'''Write an array of full width rows of pixels (height, width, bands) starting at row y'''
+		if y != self.y:
+			raise ValueError('PNG rows must be written in order')
+		rows = rows.reshape(rows.shape[0], -1)
+		for i in range(0, rows.shape[0], self.BLOCK_ROWS):
+			self.pending += self.compressor.compress(self.filter(rows[i:i+self.BLOCK_ROWS]))
+			while len(self.pending) >= self.IDAT_SIZE:
+				self.writeChunk(b'IDAT', self.pending[:self.IDAT_SIZE])
+				self.pending = self.pending[self.IDAT_SIZE:]
+		self.y += rows.shape[0]
+
+	def filter(self, rows):
+		'''
+		Apply the Paeth filter to a block of rows (height, width * bands), return the filtered bytes
+		The predictor only depends on unfiltered neighbours, so all rows are filtered at once
+		'''
+		bpp = self.bands
+		x = rows.astype(np.int16)
+		b = np.vstack((self.prevRow[np.newaxis], rows[:-1])).astype(np.int16) #up
+		a = np.zeros_like(x) #left
+		a[:, bpp:] = x[:, :-bpp]
+		c = np.zeros_like(x) #up left
+		c[:, bpp:] = b[:, :-bpp]
+		p = a + b - c
+		pa, pb, pc = np.abs(p - a), np.abs(p - b), np.abs(p - c)
+		pred = np.where((pa <= pb) & (pa <= pc), a, np.where(pb <= pc, b, c))
+		out = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+		out[:, 0] = 4 #filter type of each row
+		out[:, 1:] = (x - pred) & 0xff
+		self.prevRow = rows[-1].copy()
+		return out.tobytes()
+
+	def close(self):
+		if self.f is None:
+			return
+		self.pending += self.compressor.flush()
+		self.writeChunk(b'IDAT', self.pending)
+		self.writeChunk(b'IEND', b'')
+		self.f.close()
+		self.f = None
+
+
+class MapExport():
+	"""Build a georeferenced raster of a map layer inside a bbox at a given zoom level"""
+
+	DENSIFY = 10 #number of points per bbox edge used to reproject the bbox
+	ROWS_AHEAD = 2 #number of rows of tiles downloading ahead of the one being written
+
+	def __init__(self, mapKey, cacheFolder, bbox, bboxCRS, zoom, dstGrid=None):
+		srcKey, self.layKey = mapKey.split(':')
+		cacheFolder = os.path.join(cacheFolder, '') #cache path is built by concatenation
+		self.srv = MapService(srcKey, cacheFolder, dstGrid)
+		self.tm = self.srv.tm2
+		self.zoom = zoom
+
+		#Zoom levels served by the layer, reprojected tiles are available at all levels of destination grid
+		layer = self.srv.layers[self.layKey]
+		if self.tm is self.srv.tm1:
+			self.zmin, self.zmax = layer.zmin, min(layer.zmax, len(self.tm.getResList()) - 1)
+		else:
+			self.zmin, self.zmax = 0, len(self.tm.getResList()) - 1
+		if not self.zmin <= zoom <= self.zmax:
+			self.srv.close()
+			raise ValueError('Zoom level ' + str(zoom) + ' is outside the levels of the layer (' + str(self.zmin) + ' to ' + str(self.zmax) + ')')
+		self.res = self.tm.getRes(zoom)
+
+		#Bbox in tile matrix crs, clipped to its extent
+		xmin, ymin, xmax, ymax = reprojBbox(bboxCRS, self.tm.CRS, bbox, self.DENSIFY)
+		xmin, xmax = max(xmin, self.tm.xmin), min(xmax, self.tm.xmax)
+		ymin, ymax = max(ymin, self.tm.ymin), min(ymax, self.tm.ymax)
+		if xmin >= xmax or ymin >= ymax:
+			self.srv.close()
+			raise ValueError('Bbox is outside the tile matrix extent')
+
+		#Top left tile and pixels offset of the bbox inside it, output pixels are aligned on tiles pixels
+		#(values are rounded before floor or ceil so a bbox on a pixel edge doesn't get an extra pixel)
+		self.col1, self.row1 = self.tm.getTileNumber(xmin, ymax, zoom)
+		tx, ty = self.tm.getTileCoords(self.col1, self.row1, zoom)
+		self.ox = math.floor(round((xmin - tx) / self.res, 6))
+		self.oy = math.floor(round((ty - ymax) / self.res, 6))
+		self.width = math.ceil(round((xmax - tx) / self.res, 6)) - self.ox
+		self.height = math.ceil(round((ty - ymin) / self.res, 6)) - self.oy
+		#Top left corner of the raster
+		self.xmin, self.ymax = tx + self.ox * self.res, ty - self.oy * self.res
+
+		ts = self.tm.tileSize
+		self.nbCols = math.ceil((self.ox + self.width) / ts)
+		self.nbRows = math.ceil((self.oy + self.height) / ts)
+		#jpeg layers have no transparency
+		self.bands = 3 if layer.format.lower() in ('jpeg', 'jpg') else 4
+
+	@property
+	def size(self):
+		'''Uncompressed raster size in bytes'''
+		return self.width * self.height * self.bands
+
+	def getTile(self, i, j):
+		'''Tile number of the ith column and jth row of tiles covering the raster'''
+		if self.tm.originLoc == "NW":
+			return self.col1 + i, self.row1 + j
+		else:
+			return self.col1 + i, self.row1 - j
+
+	def submitRow(self, j):
+		'''Queue the download of a row of tiles, earlier rows are processed first'''
+		tiles = [self.getTile(i, j) for i in range(self.nbCols)]
+		return [self.srv.pool.submit(self.srv.getTile, self.layKey, col, row, self.zoom, priority=j) for col, row in tiles]
+
+	def decode(self, future):
+		'''Return the tile as numpy array, or None if it's unavailable'''
+		try:
+			data = future.result()
+			with metrics.timer('decode'):
+				img = Image.open(io.BytesIO(data)).convert('RGBA' if self.bands == 4 else 'RGB')
+		except Exception:
+			return None
+		ts = self.tm.tileSize
+		if img.size != (ts, ts):
+			return None
+		return np.asarray(img)
+
+	def run(self, path, progress=None):
+		'''
+		Write the raster, GeoTIFF (.tif) or PNG (.png) according to the path extension, and its worldfile
+		progress is an optional function called with (nb rows of tiles done, total nb rows of tiles)
+		Return the number of tiles that could not be obtained, they are left transparent (or black)
+		'''
+		ext = os.path.splitext(path)[1].lower()
+		if ext in ('.tif', '.tiff'):
+			writer = TiffWriter(path, self.width, self.height, self.bands, self.xmin, self.ymax, self.res, self.tm.CRS)
+		elif ext == '.png':
+			writer = PngWriter(path, self.width, self.height, self.bands)
+		else:
+			raise ValueError('Unsupported raster format ' + ext)
+
+		ts = self.tm.tileSize
+		nbFailed = 0
+		queued = collections.deque(self.submitRow(j) for j in range(min(self.ROWS_AHEAD, self.nbRows)))
+		try:
+			for j in range(self.nbRows):
+				futures = queued.popleft()
+				if j + self.ROWS_AHEAD < self.nbRows:
+					queued.append(self.submitRow(j + self.ROWS_AHEAD))
+				#Strip of the full row of tiles, then cropped to the raster window
+				strip = np.zeros((ts, self.nbCols * ts, self.bands), dtype=np.uint8)
+				for i, future in enumerate(futures):
+					tile = self.decode(future)
+					if tile is None:
+						nbFailed += 1
+					else:
+						strip[:, i*ts:(i+1)*ts] = tile
+				y1 = max(0, self.oy - j * ts)
+				y2 = min(ts, self.oy + self.height - j * ts)
+				writer.writeRows(j * ts + y1 - self.oy, strip[y1:y2, self.ox:self.ox + self.width])
+				if progress is not None:
+					progress(j + 1, self.nbRows)
+		finally:
+			for futures in queued:
+				for future in futures:
+					future.cancel()
+			writer.close()
+			self.srv.close() #stop threads and commit downloaded tiles
+
+		writeWorldfile(path, self.xmin, self.ymax, self.res)
+		return nbFailed
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Export a basemap area as a georeferenced raster (GeoTIFF or PNG)')
+	parser.add_argument('mapKey', help='source and layer keys as defined in servicesDefs, eg. OSM:MAPNIK')
+	parser.add_argument('cacheFolder')
+	parser.add_argument('output', help='raster path, .tif or .png')
+	parser.add_argument('--bbox', nargs=4, type=float, required=True, metavar=('XMIN', 'YMIN', 'XMAX', 'YMAX'))
+	parser.add_argument('--crs', type=int, default=4326, help='EPSG code of the bbox coordinates')
+	parser.add_argument('--zoom', type=int, required=True)
+	parser.add_argument('--grid', help='key of the grid in which tiles are reprojected, default to the source grid')
+	args = parser.parse_args()
+
+	os.makedirs(args.cacheFolder, exist_ok=True)
+	try:
+		export = MapExport(args.mapKey, args.cacheFolder, args.bbox, args.crs, args.zoom, args.grid)
+	except ValueError as e:
+		parser.error(str(e))
+	print('Raster : ' + str(export.width) + ' x ' + str(export.height) + ' px, '
+		+ str(round(export.size / 1024**2, 1)) + ' MB uncompressed, ' + str(export.nbCols * export.nbRows) + ' tiles')
+
+	def progress(done, total):
+		print('rows of tiles : ' + str(done) + '/' + str(total))
+
+	failed = export.run(args.output, progress)
+	print('Export complete, ' + str(failed) + ' tiles failed')
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,2209 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+#built-in imports
+import math
+import os
+import threading
+import queue
+import itertools
+import collections
+import traceback
+import time
+import concurrent.futures
+import heapq
+import random
+import glob
+import datetime
+import sqlite3
+import io
+import hashlib
+import urllib.parse
+import urllib.error
+import urllib.request
+import http.client
+import socket
+import base64
+import zlib
+import gzip
+import imghdr
+
+#deps imports
+import numpy as np #Ship with Blender since 2.70
+from PIL import Image
+try:
+	from osgeo import osr
+except:
+	PROJ = False
+else:
+	PROJ = True
+
+#addon import
+from .servicesDefs import grids, sources
+from .metrics import metrics
+
+
+####################################
+
+#http://www.geopackage.org/spec/#tiles
+#https://github.com/GitHubRGI/geopackage-python/blob/master/Packaging/tiles2gpkg_parallel.py
+#https://github.com/Esri/raster2gpkg/blob/master/raster2gpkg.py
+
+
+#table_name refer to the name of the table witch contains tiles data
+#here for simplification, table_name will always be named "gpkg_tiles"
+
+#With deduplicated layout, tiles data are stored once in a blobs table keyed by content hash
+#and gpkg_tiles is a read only view joining the tiles index with the blobs table
+
+TILES_VIEW = """
+	CREATE VIEW gpkg_tiles AS
+		SELECT i.id AS id, i.zoom_level AS zoom_level,
+			i.tile_column AS tile_column, i.tile_row AS tile_row,
+			b.tile_data AS tile_data,
+			i.last_modified AS last_modified, i.last_access AS last_access,
+			b.tile_format AS tile_format
+		FROM bgis_tiles_index AS i JOIN bgis_tiles_blobs AS b ON i.tile_hash = b.tile_hash;
+"""
+
+#tile_format column records the image format of each tile ('png', 'jpeg', 'webp'...) so the data
+#does not need to be sniffed when read, it's NULL for tiles stored by previous versions
+
+def isDedupLayout(db):
+	'''Check if the tiles table of this database is the deduplicated layout view'''
+	row = db.execute("SELECT type FROM sqlite_master WHERE name = 'gpkg_tiles'").fetchone()
+	return row is not None and row[0] == 'view'
+
+#Covering index of the tiles table (gpkg_tiles or bgis_tiles_index), lookups of cached tiles
+#with their modification time are answered by the index alone, without reading the rows and their blobs
+COVERING_INDEX = "CREATE INDEX IF NOT EXISTS bgis_tiles_zxy ON {} (zoom_level, tile_column, tile_row, last_modified);"
+
+MISSING_TABLE = """
+	CREATE TABLE IF NOT EXISTS bgis_missing_tiles (
+		zoom_level INTEGER NOT NULL,
+		tile_column INTEGER NOT NULL,
+		tile_row INTEGER NOT NULL,
+		last_try TIMESTAMP DEFAULT (datetime('now','localtime')),
+		reason TEXT,
+		PRIMARY KEY (zoom_level, tile_column, tile_row));
+"""
+
+#Hashes of the blobs queued by this process and not yet commited {cache path: Counter}
+#the maintenance must not delete them as orphans, their index rows are about to reference them
+pendingHashes = {}
+pendingHashesLock = threading.Lock()
+
+def addPendingHash(path, h):
+	with pendingHashesLock:
+		pendingHashes.setdefault(os.path.abspath(path), collections.Counter())[h] += 1
+
+def removePendingHash(path, h):
+	with pendingHashesLock:
+		hashes = pendingHashes.get(os.path.abspath(path))
+		if hashes is not None:
+			hashes[h] -= 1
+			if hashes[h] <= 0:
+				del hashes[h]
+
+def getPendingHashes(path):
+	'''Return the set of blob hashes with pending writes in a cache'''
+	with pendingHashesLock:
+		return set(pendingHashes.get(os.path.abspath(path), ()))
+
+#Caches whose schema has been checked by this process {path: (file key, dedup)}
+#a file modified since, by another process or version, is checked again
+checkedSchemas = {}
+
+def getFileKey(path):
+	'''
+	Return (mtime, size) of a sqlite database and of its write ahead log, or None if the database does not exist
+	Changes still in the log are not yet visible in the database file
+	'''
+	key = []
+	for p in (path, path + '-wal'):
+		try:
+			stat = os.stat(p)
+		except OSError:
+			if p == path:
+				return None
+			key.append(None)
+		else:
+			key.append((stat.st_mtime_ns, stat.st_size))
+	return tuple(key)
+
+def checkSchema(db):
+	'''
+	Quick check of the schema with three queries,
+	return a tuple (isGPKG, upToDate), upToDate is False if the cache was created by a previous version
+	'''
+	#check application id
+	app_id = db.execute("PRAGMA application_id").fetchone()
+	if not app_id[0] == 1196437808:
+		return False, False
+	names = set(row[0] for row in db.execute("SELECT name FROM sqlite_master"))
+	if not {'gpkg_contents', 'gpkg_spatial_ref_sys', 'gpkg_tile_matrix_set', 'gpkg_tile_matrix', 'gpkg_tiles'}.issubset(names):
+		return False, False
+	columns = [row[1] for row in db.execute("PRAGMA table_info(gpkg_tiles)")]
+	if not {'zoom_level', 'tile_column', 'tile_row', 'tile_data'}.issubset(columns):
+		return False, False
+	upToDate = {'last_access', 'tile_format'}.issubset(columns) and {'bgis_missing_tiles', 'bgis_tiles_zxy'}.issubset(names)
+	return True, upToDate
+
+def upgradeSchema(db):
+	'''
+	Add columns, tables and index missing in caches created by previous versions
+	db is a connection without implicit transactions
+	'''
+	getColumns = lambda: [row[1] for row in db.execute("PRAGMA table_info(gpkg_tiles)")]
+	try:
+		db.execute("BEGIN IMMEDIATE")
+		#check again inside the transaction, another process could have done it in the meantime
+		columns = getColumns()
+		dedup = isDedupLayout(db)
+		if 'last_access' not in columns:
+			db.execute("ALTER TABLE gpkg_tiles ADD COLUMN last_access TIMESTAMP")
+		if 'tile_format' not in columns:
+			if dedup:
+				db.execute("ALTER TABLE bgis_tiles_blobs ADD COLUMN tile_format TEXT")
+				db.execute("DROP VIEW gpkg_tiles")
+				db.execute(TILES_VIEW)
+			else:
+				db.execute("ALTER TABLE gpkg_tiles ADD COLUMN tile_format TEXT")
+		db.execute(MISSING_TABLE)
+		db.execute(COVERING_INDEX.format('bgis_tiles_index' if dedup else 'gpkg_tiles'))
+		db.execute("COMMIT")
+	except:
+		if db.in_transaction:
+			db.execute("ROLLBACK")
+		raise
+
+
+class GeoPackage():
+
+	MAX_DAYS = 90
+	BUSY_TIMEOUT = 5000 #ms, time to wait for a lock held by another connection
+	COMMIT_SIZE = 200 #max number of queued writes commited in a single transaction
+	COMMIT_DELAY = 0.1 #seconds, time to wait for others writes before commiting a transaction
+	WRITER_IDLE = 5 #seconds, the writer thread ends after this idle time
+	ACCESS_DELAY = 3600 #seconds, minimum delay between two updates of a tile access time
+	MISSING_TTL = 900 #seconds, delay before trying again to download a tile the server reported as missing
+	FAILED_TTL = 30 #seconds, delay before trying again to download a tile that failed for another reason
+	WRITE_RETRIES = 8 #number of retries of a batch of writes if the database stays locked
+	RETRY_DELAY = 0.1 #seconds, first delay before retrying, doubled on each retry
+	MAX_RETRY_DELAY = 5 #seconds
+	IMPORT_BATCH = 1000 #number of tiles read or written at once by bulk import and export
+
+	def __init__(self, path, tm, dedup=False):
+		self.dbPath = path
+		self.name = os.path.splitext(os.path.basename(path))[0]
+		
+		#Get props from TileMatrix object
+		self.crs = tm.CRS
+		self.tileSize = tm.tileSize
+		self.xmin, self.ymin, self.xmax, self.ymax = tm.globalbbox
+		self.resolutions = tm.getResList()
+
+		#Each thread get its own connection, kept open for the lifetime of the thread
+		self._local = threading.local()
+		#Writes are queued and commited by batch from a single writer thread
+		self._writeQueue = queue.Queue()
+		self._writer = None
+		self._writerLock = threading.Lock()
+
+		#Schema is set up with the connection of this thread, and is not checked again while the file is unchanged
+		db = self.getConnection()
+		path = os.path.abspath(self.dbPath)
+		key = getFileKey(path)
+		checked = checkedSchemas.get(path)
+		#Layout of an existing cache is kept whatever the requested one
+		if key is not None and checked is not None and checked[0] == key:
+			self.dedup = checked[1]
+		else:
+			self.dedup = self.setup(db, dedup)
+			checkedSchemas[path] = (getFileKey(path), self.dedup)
+		#table to update when editing tiles index
+		self.tilesTable = 'bgis_tiles_index' if self.dedup else 'gpkg_tiles'
+
+		#Negative cache of tiles reported as missing by the server {(z, x, y): expiration time}
+		now = time.time()
+		self._missing = {}
+		#Tiles that failed on network or server errors, kept in memory only {(z, x, y): expiration time}
+		self._failed = {}
+		for z, x, y, t in db.execute("SELECT zoom_level, tile_column, tile_row, last_try FROM bgis_missing_tiles"):
+			expire = t.timestamp() + self.MISSING_TTL
+			if expire > now:
+				self._missing[(z, x, y)] = expire
+
+
+	def getConnection(self):
+		'''Return the connection dedicated to the current thread, open it if needed'''
+		db = getattr(self._local, 'db', None)
+		if db is None:
+			#connect with detect_types parameter for automatically convert date to Python object
+			db = sqlite3.connect(self.dbPath, timeout=self.BUSY_TIMEOUT/1000, detect_types=sqlite3.PARSE_DECLTYPES)
+			db.execute("PRAGMA busy_timeout = " + str(self.BUSY_TIMEOUT))
+			#in WAL mode, NORMAL sync is safe and avoid a fsync on each commit
+			db.execute("PRAGMA synchronous = NORMAL")
+			self._local.db = db
+		return db
+
+
+	def close(self, wait=True):
+		'''
+		Write pending tiles and close the connection of the current thread.
+		Connections of others threads are closed when their thread ends.
+		If wait is False, return without waiting for the pending tiles, the writer thread commits them in background
+		'''
+		if wait:
+			self.flush()
+		db = getattr(self._local, 'db', None)
+		if db is not None:
+			db.close()
+			self._local.db = None
+
+
+	def setup(self, db, dedup=False):
+		'''Create or upgrade the schema if needed, return True if the cache use the deduplicated layout'''
+		#transactions are explicit, and journal mode can't be changed inside one
+		db.isolation_level = None
+		try:
+			isGPKG, upToDate = checkSchema(db)
+			if not isGPKG:
+				self.create(db, dedup)
+			elif not upToDate:
+				upgradeSchema(db)
+			#Write ahead log allows readers to work while the writer thread commits
+			#(journal mode is persistent, it's stored in the database file)
+			db.execute("PRAGMA journal_mode = WAL")
+			return isDedupLayout(db)
+		finally:
+			db.isolation_level = ''
+
+
+	def create(self, db, dedup=False):
+		"""
+		Create default geopackage schema on the database, db is a connection without implicit transactions.
+		Schema and metadata are written in a single exclusive transaction, so when several
+		processes create the same cache at the same time only the first one builds it
+		"""
+		cursor = db.cursor()
+
+		# Free pages can be released without rebuilding the whole file (must be set before creating tables)
+		cursor.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+		# Readers are not blocked by writers of others processes (journal mode can't be changed in a transaction)
+		cursor.execute("PRAGMA journal_mode = WAL;")
+
+		cursor.execute("BEGIN EXCLUSIVE;")
+		if cursor.execute("SELECT count(*) FROM sqlite_master WHERE name = 'gpkg_contents'").fetchone()[0]:
+			#already created by another process
+			cursor.execute("ROLLBACK;")
+			return
+
+		# Add GeoPackage version 1.0 ("GP10" in ASCII) to the Sqlite header
+		cursor.execute("PRAGMA application_id = 1196437808;")
+		
+		cursor.execute("""
+			CREATE TABLE gpkg_contents (
+				table_name TEXT NOT NULL PRIMARY KEY,
+				data_type TEXT NOT NULL,
+				identifier TEXT UNIQUE,
+				description TEXT DEFAULT '',
+				last_change DATETIME NOT NULL DEFAULT
+				(strftime('%Y-%m-%dT%H:%M:%fZ','now')),
+				min_x DOUBLE,
+				min_y DOUBLE,
+				max_x DOUBLE,
+				max_y DOUBLE,
+				srs_id INTEGER,
+				CONSTRAINT fk_gc_r_srs_id FOREIGN KEY (srs_id)
+					REFERENCES gpkg_spatial_ref_sys(srs_id));
+		""")
+		
+		cursor.execute("""
+			CREATE TABLE gpkg_spatial_ref_sys (
+				srs_name TEXT NOT NULL,
+				srs_id INTEGER NOT NULL PRIMARY KEY,
+				organization TEXT NOT NULL,
+				organization_coordsys_id INTEGER NOT NULL,
+				definition TEXT NOT NULL,
+				description TEXT);
+		""")
+
+		cursor.execute("""
+			CREATE TABLE gpkg_tile_matrix_set (
+				table_name TEXT NOT NULL PRIMARY KEY,
+				srs_id INTEGER NOT NULL,
+				min_x DOUBLE NOT NULL,
+				min_y DOUBLE NOT NULL,
+				max_x DOUBLE NOT NULL,
+				max_y DOUBLE NOT NULL,
+				CONSTRAINT fk_gtms_table_name FOREIGN KEY (table_name)
+					REFERENCES gpkg_contents(table_name),
+				CONSTRAINT fk_gtms_srs FOREIGN KEY (srs_id)
+					REFERENCES gpkg_spatial_ref_sys(srs_id));
+		""")
+
+		cursor.execute("""
+			CREATE TABLE gpkg_tile_matrix (
+				table_name TEXT NOT NULL,
+				zoom_level INTEGER NOT NULL,
+				matrix_width INTEGER NOT NULL,
+				matrix_height INTEGER NOT NULL,
+				tile_width INTEGER NOT NULL,
+				tile_height INTEGER NOT NULL,
+				pixel_x_size DOUBLE NOT NULL,
+				pixel_y_size DOUBLE NOT NULL,
+				CONSTRAINT pk_ttm PRIMARY KEY (table_name, zoom_level),
+				CONSTRAINT fk_ttm_table_name FOREIGN KEY (table_name)
+					REFERENCES gpkg_contents(table_name));
+		""")		
+		
+		if not dedup:
+			cursor.execute("""
+				CREATE TABLE gpkg_tiles (
+					id INTEGER PRIMARY KEY AUTOINCREMENT,
+					zoom_level INTEGER NOT NULL,
+					tile_column INTEGER NOT NULL,
+					tile_row INTEGER NOT NULL,
+					tile_data BLOB NOT NULL,
+					last_modified TIMESTAMP DEFAULT (datetime('now','localtime')),
+					last_access TIMESTAMP,
+					tile_format TEXT,
+					UNIQUE (zoom_level, tile_column, tile_row));
+			""")
+			cursor.execute(COVERING_INDEX.format('gpkg_tiles'))
+
+		else:
+			cursor.execute("""
+				CREATE TABLE bgis_tiles_blobs (
+					tile_hash TEXT NOT NULL PRIMARY KEY,
+					tile_data BLOB NOT NULL,
+					tile_format TEXT);
+			""")
+
+			cursor.execute("""
+				CREATE TABLE bgis_tiles_index (
+					id INTEGER PRIMARY KEY AUTOINCREMENT,
+					zoom_level INTEGER NOT NULL,
+					tile_column INTEGER NOT NULL,
+					tile_row INTEGER NOT NULL,
+					tile_hash TEXT NOT NULL,
+					last_modified TIMESTAMP DEFAULT (datetime('now','localtime')),
+					last_access TIMESTAMP,
+					UNIQUE (zoom_level, tile_column, tile_row));
+			""")
+
+			cursor.execute("CREATE INDEX bgis_tiles_hash ON bgis_tiles_index (tile_hash);")
+			cursor.execute(COVERING_INDEX.format('bgis_tiles_index'))
+
+			#gpkg_tiles as a view keep the cache readable by any geopackage reader
+			cursor.execute(TILES_VIEW)
+
+		self.insertMetadata(db)
+
+		self.insertCRS(db, self.crs, str(self.crs), wkt='')
+		#self.insertCRS(db, 3857, "Web Mercator", wkt='')
+		#self.insertCRS(db, 4326, "WGS84", wkt='')
+
+		self.insertTileMatrixSet(db)
+
+		cursor.execute(MISSING_TABLE)
+
+		cursor.execute("COMMIT;")
+
+
+
+	def insertMetadata(self, db):
+		query = """INSERT OR REPLACE INTO gpkg_contents (
+					table_name, data_type,
+					identifier, description,
+					min_x, min_y, max_x, max_y,
+					srs_id)
+				VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);"""
+		db.execute(query, ("gpkg_tiles", "tiles", self.name, "Created with BlenderGIS", self.xmin, self.ymin, self.xmax, self.ymax, self.crs))  
+
+
+	def insertCRS(self, db, code, name, wkt=''):
+		db.execute(""" INSERT OR REPLACE INTO gpkg_spatial_ref_sys (
+					srs_id,
+					organization,
+					organization_coordsys_id,
+					srs_name,
+					definition)
+				VALUES (?, ?, ?, ?, ?)
+			""", (code, "EPSG", code, name, wkt))
+
+
+	def insertTileMatrixSet(self, db):
+		
+		#Tile matrix set
+		query = """INSERT OR REPLACE INTO gpkg_tile_matrix_set (
+					table_name, srs_id,
+					min_x, min_y, max_x, max_y)
+				VALUES (?, ?, ?, ?, ?, ?);"""
+		db.execute(query, ('gpkg_tiles', self.crs, self.xmin, self.ymin, self.xmax, self.ymax))
+		
+		
+		#Tile matrix of each levels
+		for level, res in enumerate(self.resolutions):
+			
+			w = math.ceil( (self.xmax - self.xmin) / (self.tileSize * res) )
+			h = math.ceil( (self.ymax - self.ymin) / (self.tileSize * res) )			
+			
+			query = """INSERT OR REPLACE INTO gpkg_tile_matrix (
+						table_name, zoom_level,
+						matrix_width, matrix_height,
+						tile_width, tile_height,
+						pixel_x_size, pixel_y_size)
+					VALUES (?, ?, ?, ?, ?, ?, ?, ?);"""  
+			db.execute(query, ('gpkg_tiles', level, w, h, self.tileSize, self.tileSize, res, res))	   
+		
+
+	def isMissing(self, x, y, z):
+		'''Check if the tile is known as missing or recently failed to download'''
+		for d in (self._missing, self._failed):
+			expire = d.get((z, x, y))
+			if expire is None:
+				continue
+			if expire < time.time():
+				d.pop((z, x, y), None)
+				continue
+			return True
+		return False
+
+	def putMissing(self, x, y, z, reason=''):
+		'''Record a tile missing on the server, it will not be requested again before MISSING_TTL'''
+		self._missing[(z, x, y)] = time.time() + self.MISSING_TTL
+		query = """INSERT OR REPLACE INTO bgis_missing_tiles
+		(zoom_level, tile_column, tile_row, last_try, reason) VALUES (?,?,?,datetime('now','localtime'),?)"""
+		self.write(query, (z, x, y, reason))
+
+	def putFailed(self, x, y, z):
+		'''Record a tile that failed to download, it will not be requested again before FAILED_TTL'''
+		self._failed[(z, x, y)] = time.time() + self.FAILED_TTL
+
+	def putTile(self, x, y, z, data, format=None):
+		'''
+		Queue the tile for writing, it will be commited later by the writer thread
+		format is the image format of data as named by imghdr, if known
+		'''
+		self._failed.pop((z, x, y), None)
+		if self._missing.pop((z, x, y), None) is not None:
+			self.write("DELETE FROM bgis_missing_tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?", (z, x, y))
+		if self.dedup:
+			#identical tiles share the same blob
+			#blob and index rows are queued as a single unit, so they are always commited in the same transaction
+			h = hashlib.sha1(data).hexdigest()
+			query = """INSERT OR REPLACE INTO bgis_tiles_index
+			(zoom_level, tile_column, tile_row, tile_hash) VALUES (?,?,?,?)"""
+			addPendingHash(self.dbPath, h)
+			self.writeUnit([
+				("INSERT OR IGNORE INTO bgis_tiles_blobs (tile_hash, tile_data, tile_format) VALUES (?,?,?)", (h, data, format)),
+				(query, (z, x, y, h))
+				], blobHash=h)
+		else:
+			query = """INSERT OR REPLACE INTO gpkg_tiles 
+			(zoom_level, tile_column, tile_row, tile_data, tile_format) VALUES (?,?,?,?,?)"""
+			self.write(query, (z, x, y, data, format))
+
+	def write(self, query, params):
+		'''Queue a write query and make sure the writer thread is running'''
+		self.writeUnit([(query, params)])
+
+	def writeUnit(self, statements, blobHash=None):
+		'''
+		Queue a list of (query, params) that must be commited in the same transaction
+		blobHash is the hash of a blob written by the unit, released from the pending hashes once commited
+		'''
+		self._writeQueue.put((statements, blobHash))
+		with self._writerLock:
+			if self._writer is None:
+				self._writer = threading.Thread(target=self._writeLoop, daemon=True)
+				self._writer.start()
+
+	def flush(self):
+		'''Block until all queued writes are commited'''
+		self._writeQueue.join()
+
+	def _writeLoop(self):
+		'''Writer thread, commit queued queries by batch'''
+		db = self.getConnection()
+		while True:
+			try:
+				batch = [self._writeQueue.get(timeout=self.WRITER_IDLE)]
+			except queue.Empty:
+				with self._writerLock:
+					#a write can be queued just before we get the lock
+					if self._writeQueue.empty():
+						self._writer = None
+						db.close()
+						return
+				continue
+			#Gather others writes to commit them in the same transaction
+			#(the delay is counted from the first write, so a steady flow of writes can't postpone the commit)
+			deadline = time.time() + self.COMMIT_DELAY
+			while len(batch) < self.COMMIT_SIZE:
+				try:
+					batch.append(self._writeQueue.get(timeout=max(0, deadline - time.time())))
+				except queue.Empty:
+					break
+			try:
+				self.commitBatch(db, batch)
+			except sqlite3.Error as e:
+				print("Unable to write tiles in cache " + self.name + " : " + str(e))
+			finally:
+				for statements, blobHash in batch:
+					if blobHash is not None:
+						removePendingHash(self.dbPath, blobHash)
+					self._writeQueue.task_done()
+
+	def commitBatch(self, db, batch):
+		'''
+		Execute the queries of the queued units in a single transaction
+		If the database is still locked by another process after the busy timeout,
+		the whole batch is retried with an exponential backoff
+		'''
+		for attempt in range(self.WRITE_RETRIES + 1):
+			try:
+				with db: #commit on exit or rollback if an exception occurs
+					for statements, blobHash in batch:
+						for query, params in statements:
+							db.execute(query, params)
+				return
+			except sqlite3.OperationalError as e:
+				if 'locked' not in str(e) and 'busy' not in str(e) or attempt == self.WRITE_RETRIES:
+					raise
+			#random factor avoid processes retrying in lockstep
+			time.sleep(min(self.RETRY_DELAY * 2**attempt, self.MAX_RETRY_DELAY) * random.uniform(0.5, 1.5))
+
+	def getTile(self, x, y, z):
+		'''Return (data, format) of the tile, or (None, None) if it's missing or expired, format is None if unknown'''
+		db = self.getConnection()
+		query = 'SELECT tile_data, last_modified, last_access, tile_format FROM gpkg_tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?'
+		result = db.execute(query, (z, x, y)).fetchone()
+		if result is None:
+			return None, None
+		data, t, access, format = result
+		now = datetime.datetime.now()
+		if (now - t).days > self.MAX_DAYS:
+			return None, None
+		self.touch(x, y, z, access, now)
+		return data, format
+
+	def touch(self, x, y, z, access, now):
+		'''Queue an update of tile access time, used for least recently used eviction'''
+		if access is None or (now - access).total_seconds() > self.ACCESS_DELAY:
+			query = "UPDATE " + self.tilesTable + """ SET last_access = datetime('now','localtime')
+					WHERE zoom_level=? AND tile_column=? AND tile_row=?"""
+			self.write(query, (z, x, y))
+
+
+	def getTiles(self, tiles, z):
+		'''
+		Get a set of tiles at the same zoom level with a single indexed query
+		Return a dict {(col, row): (data, last_modified, format)}, missing or expired tiles are omitted
+		'''
+		if not tiles:
+			return {}
+		tiles = set(tiles)
+		cols, rows = zip(*tiles)
+		#Range query on (zoom_level, tile_column, tile_row) unique index
+		#a viewport is a rectangle of tiles so the range rarely contains unwanted rows
+		db = self.getConnection()
+		query = """SELECT tile_column, tile_row, tile_data, last_modified, last_access, tile_format FROM gpkg_tiles
+				WHERE zoom_level = ? AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?"""
+		result = db.execute(query, (z, min(cols), max(cols), min(rows), max(rows))).fetchall()
+		now = datetime.datetime.now()
+		tilesData = {}
+		for col, row, data, t, access, format in result:
+			if (col, row) in tiles and (now - t).days <= self.MAX_DAYS:
+				tilesData[(col, row)] = (data, t, format)
+				self.touch(col, row, z, access, now)
+		return tilesData
+
+	def hasTiles(self, tiles, z):
+		'''Return the set of requested (col, row) available in cache, without reading tiles data'''
+		if not tiles:
+			return set()
+		tiles = set(tiles)
+		cols, rows = zip(*tiles)
+		db = self.getConnection()
+		#gpkg_tiles view of deduplicated layout only lists index rows whose blob exists
+		query = """SELECT tile_column, tile_row, last_modified FROM gpkg_tiles
+				WHERE zoom_level = ? AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?"""
+		result = db.execute(query, (z, min(cols), max(cols), min(rows), max(rows))).fetchall()
+		now = datetime.datetime.now()
+		return set((col, row) for col, row, t in result if (col, row) in tiles and (now - t).days <= self.MAX_DAYS)
+
+	def countTiles(self, z, colmin, colmax, rowmin, rowmax):
+		'''Return number of tiles and total bytes stored in cache inside a range of tiles'''
+		db = self.getConnection()
+		query = """SELECT COUNT(*), SUM(LENGTH(tile_data)) FROM gpkg_tiles
+				WHERE zoom_level = ? AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?"""
+		n, size = db.execute(query, (z, colmin, colmax, rowmin, rowmax)).fetchone()
+		return n, size or 0
+
+	def getStats(self):
+		'''Return number of tiles and bytes stored in cache, in total and by zoom level'''
+		db = self.getConnection()
+		query = "SELECT zoom_level, COUNT(*), SUM(LENGTH(tile_data)) FROM gpkg_tiles GROUP BY zoom_level"
+		zooms = {z:{'tiles':n, 'bytes':size} for z, n, size in db.execute(query)}
+		nbTiles = sum(v['tiles'] for v in zooms.values())
+		size = sum(v['bytes'] for v in zooms.values())
+		if self.dedup:
+			nbBlobs, storedSize = db.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(tile_data)), 0) FROM bgis_tiles_blobs").fetchone()
+		else:
+			nbBlobs, storedSize = nbTiles, size
+		return {
+			'tiles': nbTiles,
+			'bytes': size,
+			'storedBytes': storedSize, #less than bytes if some tiles are deduplicated
+			'dedupRatio': nbTiles / nbBlobs if nbBlobs else 1,
+			'fileSize': getFileSize(self.dbPath),
+			'zoom': zooms
+			}
+
+	def getAverageTileSize(self):
+		'''Return mean size in bytes of stored tiles or None if the cache is empty'''
+		db = self.getConnection()
+		return db.execute("SELECT AVG(LENGTH(tile_data)) FROM gpkg_tiles").fetchone()[0]
+
+	def exportTiles(self):
+		'''Yield all stored tiles as (x, y, z, data, format), ordered by zoom level, column and row'''
+		db = self.getConnection()
+		cursor = db.execute("""SELECT tile_column, tile_row, zoom_level, tile_data, tile_format FROM gpkg_tiles
+				ORDER BY zoom_level, tile_column, tile_row""")
+		while True:
+			rows = cursor.fetchmany(self.IMPORT_BATCH)
+			if not rows:
+				return
+			yield from rows
+
+	def importTiles(self, tiles, progress=None):
+		'''
+		Write an iterable of (x, y, z, data, format) tiles in a single transaction, existing tiles are replaced
+		Tiles are inserted by batch, without going through the writer thread
+		progress is an optional function called with the number of tiles written so far
+		Return the number of tiles written
+		'''
+		self.flush()
+		db = sqlite3.connect(self.dbPath, timeout=self.BUSY_TIMEOUT/1000, isolation_level=None)
+		nbTiles = 0
+		try:
+			db.execute("BEGIN IMMEDIATE")
+			for batch in iterBatches(tiles, self.IMPORT_BATCH):
+				if self.dedup:
+					hashes = [hashlib.sha1(data).hexdigest() for x, y, z, data, format in batch]
+					db.executemany("INSERT OR IGNORE INTO bgis_tiles_blobs (tile_hash, tile_data, tile_format) VALUES (?,?,?)",
+						[(h, data, format) for h, (x, y, z, data, format) in zip(hashes, batch)])
+					db.executemany("""INSERT OR REPLACE INTO bgis_tiles_index
+						(zoom_level, tile_column, tile_row, tile_hash) VALUES (?,?,?,?)""",
+						[(z, x, y, h) for h, (x, y, z, data, format) in zip(hashes, batch)])
+				else:
+					db.executemany("""INSERT OR REPLACE INTO gpkg_tiles
+						(zoom_level, tile_column, tile_row, tile_data, tile_format) VALUES (?,?,?,?,?)""",
+						[(z, x, y, data, format) for x, y, z, data, format in batch])
+				#imported tiles are no longer missing
+				found = [(z, x, y) for x, y, z, data, format in batch if self._missing.pop((z, x, y), None) is not None]
+				if found:
+					db.executemany("DELETE FROM bgis_missing_tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?", found)
+				nbTiles += len(batch)
+				if progress is not None:
+					progress(nbTiles)
+			db.execute("COMMIT")
+		except:
+			if db.in_transaction:
+				db.execute("ROLLBACK")
+			raise
+		finally:
+			db.close()
+		return nbTiles
+
+
+def iterBatches(iterable, size):
+	'''Yield lists of at most size items from an iterable'''
+	it = iter(iterable)
+	while True:
+		batch = list(itertools.islice(it, size))
+		if not batch:
+			return
+		yield batch
+
+
+def getFileSize(dbPath):
+	'''Size of a sqlite database on disk, including its write ahead log'''
+	size = os.path.getsize(dbPath)
+	if os.path.exists(dbPath + '-wal'):
+		size += os.path.getsize(dbPath + '-wal')
+	return size
+
+
+####################################
+
+class CachePolicy():
+	"""
+	Enforce age and size limits on the caches of a folder
+	Expired tiles are deleted then least recently used tiles are evicted until caches fit the max sizes
+	"""
+
+	MAX_CACHE_SIZE = 1024**3 #bytes of tiles allowed per cache file
+	MAX_FOLDER_SIZE = 4 * 1024**3 #bytes of tiles allowed for all caches of the folder
+	INTERVAL = 600 #seconds between two maintenance runs of the background thread
+	START_DELAY = 10 #seconds before the first run, so it doesn't slow down the loading of the map
+	VACUUM_RATIO = 0.25 #a full vacuum is made when the free pages exceed this ratio of the file
+
+	def __init__(self, folder, maxCacheSize=None, maxFolderSize=None, maxDays=None):
+		self.folder = folder
+		self.maxCacheSize = maxCacheSize or self.MAX_CACHE_SIZE
+		self.maxFolderSize = maxFolderSize or self.MAX_FOLDER_SIZE
+		self.maxDays = maxDays or GeoPackage.MAX_DAYS
+		self._stop = threading.Event()
+		self.thread = None
+
+	def listCaches(self):
+		return sorted(glob.glob(os.path.join(self.folder, '*.gpkg')))
+
+	def connect(self, path):
+		db = sqlite3.connect(path, timeout=GeoPackage.BUSY_TIMEOUT/1000)
+		db.execute("PRAGMA busy_timeout = " + str(GeoPackage.BUSY_TIMEOUT))
+		return db
+
+	def openCache(self, path):
+		'''
+		Connect to a cache, upgraded first if it was created by a previous version
+		Return None if the file is not a valid cache or can't be read, it's ignored by the maintenance
+		'''
+		db = self.connect(path)
+		try:
+			isGPKG, upToDate = checkSchema(db)
+			if isGPKG and not upToDate:
+				db.isolation_level = None
+				upgradeSchema(db)
+				db.isolation_level = ''
+		except sqlite3.Error as e:
+			print("Cache " + path + " skipped : " + str(e))
+			isGPKG = False
+		if not isGPKG:
+			db.close()
+			return None
+		return db
+
+	def start(self):
+		'''Run maintenance periodically in a background thread'''
+		if self.thread is None:
+			self._stop.clear()
+			self.thread = threading.Thread(target=self._loop, daemon=True)
+			self.thread.start()
+
+	def stop(self):
+		self._stop.set()
+		self.thread = None
+
+	def _loop(self):
+		self._stop.wait(self.START_DELAY)
+		while not self._stop.is_set():
+			try:
+				self.maintain()
+			except sqlite3.Error as e:
+				print("Cache maintenance failed : " + str(e))
+			self._stop.wait(self.INTERVAL)
+
+	def maintain(self):
+		'''Delete expired tiles, evict tiles beyond size limits and release free space'''
+		#errors are handled by file, so a broken cache doesn't stop the maintenance of the others
+		dbs = []
+		for path in self.listCaches():
+			if self._stop.is_set():
+				break
+			db = self.openCache(path)
+			if db is None:
+				continue
+			try:
+				self.deleteExpired(db)
+				self.evict([db], self.maxCacheSize)
+			except sqlite3.Error as e:
+				print("Cache maintenance failed on " + path + " : " + str(e))
+				db.close()
+			else:
+				dbs.append(db)
+		try:
+			if not self._stop.is_set():
+				#only the caches maintained without error are merged
+				self.evict(dbs, self.maxFolderSize)
+			for db in dbs:
+				try:
+					self.vacuum(db)
+				except sqlite3.Error as e:
+					print("Cache vacuum failed : " + str(e))
+		finally:
+			for db in dbs:
+				db.close()
+
+	def deleteExpired(self, db):
+		table = 'bgis_tiles_index' if isDedupLayout(db) else 'gpkg_tiles'
+		with db:
+			db.execute("DELETE FROM " + table + " WHERE last_modified < datetime('now', 'localtime', ?)",
+				('-' + str(self.maxDays) + ' days',))
+			db.execute("DELETE FROM bgis_missing_tiles WHERE last_try < datetime('now', 'localtime', ?)",
+				('-' + str(GeoPackage.MISSING_TTL) + ' seconds',))
+		self.deleteOrphans(db)
+
+	def deleteOrphans(self, db):
+		'''Delete blobs no longer referenced by a tile in deduplicated layout'''
+		if isDedupLayout(db):
+			#blobs with writes still queued in this process are kept
+			path = db.execute("PRAGMA database_list").fetchone()[2]
+			pending = getPendingHashes(path)
+			orphans = [row[0] for row in db.execute("""SELECT tile_hash FROM bgis_tiles_blobs WHERE NOT EXISTS
+				(SELECT 1 FROM bgis_tiles_index WHERE bgis_tiles_index.tile_hash = bgis_tiles_blobs.tile_hash)""")
+				if row[0] not in pending]
+			with db:
+				for i in range(0, len(orphans), 500):
+					chunk = orphans[i:i+500]
+					#check again, a tile could reference the blob since the select
+					db.execute("DELETE FROM bgis_tiles_blobs WHERE tile_hash IN (" + ','.join('?'*len(chunk)) + """) AND NOT EXISTS
+						(SELECT 1 FROM bgis_tiles_index WHERE bgis_tiles_index.tile_hash = bgis_tiles_blobs.tile_hash)""", chunk)
+
+	def getSize(self, db):
+		'''Bytes of tiles data stored in the database'''
+		table = 'bgis_tiles_blobs' if isDedupLayout(db) else 'gpkg_tiles'
+		return db.execute("SELECT COALESCE(SUM(LENGTH(tile_data)), 0) FROM " + table).fetchone()[0]
+
+	def evict(self, dbs, maxSize):
+		'''Delete least recently used tiles of the databases until their total size is under maxSize'''
+		excess = sum(self.getSize(db) for db in dbs) - maxSize
+		if excess <= 0:
+			return
+		#merge the tiles of all databases ordered by access time, timestamps are compared as iso strings
+		query = "SELECT COALESCE(last_access, last_modified) AS t, LENGTH(tile_data), id FROM gpkg_tiles ORDER BY t"
+		#a shared blob is only released with its last tile, so each tile accounts for a share of the blob
+		dedupQuery = """SELECT COALESCE(i.last_access, i.last_modified) AS t, LENGTH(b.tile_data) / r.n, i.id
+			FROM bgis_tiles_index AS i
+			JOIN bgis_tiles_blobs AS b ON i.tile_hash = b.tile_hash
+			JOIN (SELECT tile_hash, COUNT(*) AS n FROM bgis_tiles_index GROUP BY tile_hash) AS r ON i.tile_hash = r.tile_hash
+			ORDER BY t"""
+		def tagRows(cursor, i):
+			for t, n, id in cursor:
+				yield t, n, id, i
+		cursors = [db.execute(dedupQuery if isDedupLayout(db) else query) for db in dbs]
+		rows = [tagRows(cursor, i) for i, cursor in enumerate(cursors)]
+		ids = [[] for db in dbs]
+		for t, n, id, i in heapq.merge(*rows):
+			ids[i].append(id)
+			excess -= n
+			if excess <= 0:
+				break
+		for cursor in cursors:
+			cursor.close()
+		for db, dbIds in zip(dbs, ids):
+			table = 'bgis_tiles_index' if isDedupLayout(db) else 'gpkg_tiles'
+			with db:
+				for i in range(0, len(dbIds), 500):
+					chunk = dbIds[i:i+500]
+					db.execute("DELETE FROM " + table + " WHERE id IN (" + ','.join('?'*len(chunk)) + ")", chunk)
+			self.deleteOrphans(db)
+
+	def vacuum(self, db):
+		'''Release free pages to the file system'''
+		if db.execute("PRAGMA auto_vacuum").fetchone()[0] == 2: #incremental
+			#a single step of the pragma through execute() only frees one page, executescript runs it to completion
+			db.commit()
+			db.executescript("PRAGMA incremental_vacuum;")
+			#with write ahead log, the file is only truncated when the log is checkpointed
+			db.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+		else:
+			#caches created before incremental mode, convert them when it's worth a full rebuild
+			free = db.execute("PRAGMA freelist_count").fetchone()[0]
+			total = db.execute("PRAGMA page_count").fetchone()[0]
+			if total and free / total > self.VACUUM_RATIO:
+				db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+				db.execute("VACUUM")
+
+	def getStats(self):
+		'''Return tiles count and bytes of each cache file, with the total of the folder'''
+		stats = {}
+		for path in self.listCaches():
+			db = self.openCache(path)
+			if db is None:
+				continue
+			n = db.execute("SELECT COUNT(*) FROM gpkg_tiles").fetchone()[0]
+			size = self.getSize(db)
+			db.close()
+			stats[os.path.basename(path)] = {'tiles':n, 'bytes':size, 'fileSize':getFileSize(path)}
+		stats['total'] = {k:sum(v[k] for v in stats.values()) for k in ['tiles', 'bytes', 'fileSize']}
+		return stats
+
+
+####################################
+
+class Ellps():
+	"""ellipsoid"""
+	def __init__(self, a, b):
+		self.a =  a#equatorial radius in meters
+		self.b =  b#polar radius in meters
+		self.f = (self.a-self.b)/self.a#inverse flat
+		self.perimeter = (2*math.pi*self.a)#perimeter at equator
+
+GRS80 = Ellps(6378137, 6356752.314245)
+
+
+#osr transformations are not thread safe, each thread keeps its own ones {(crs1, crs2): transformation}
+_transforms = threading.local()
+
+def getTransform(crs1, crs2):
+	'''Return a cached gdal osr transformation from crs1 to crs2'''
+	cache = getattr(_transforms, 'cache', None)
+	if cache is None:
+		cache = _transforms.cache = {}
+	transfo = cache.get((crs1, crs2))
+	if transfo is None:
+		prjs = []
+		for crs in (crs1, crs2):
+			prj = osr.SpatialReference()
+			prj.ImportFromEPSG(crs)
+			#since GDAL 3, geographic crs use lat long axis order unless asking for x y order
+			if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+				prj.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+			prjs.append(prj)
+		transfo = cache[(crs1, crs2)] = osr.CoordinateTransformation(*prjs)
+	return transfo
+
+
+def reproj(crs1, crs2, x1, y1):
+	"""
+	Reproject x1,y1 coords from crs1 to crs2
+	x1, y1 can be numbers or sequences of same length, in this case numpy arrays are returned
+	Lat long (decimel degrees) <--> web mercator is computed directly, others crs need GDAL
+	Warning, latitudes 90° or -90° are outside web mercator bounds
+	"""
+	if crs1 == crs2:
+		return x1, y1
+
+	if isinstance(x1, (int, float)) and isinstance(y1, (int, float)):
+		#math functions are faster than numpy for a single point
+		if crs1 == 4326 and crs2 == 3857:
+			long, lat = x1, y1
+			k = GRS80.perimeter/360
+			x2 = long * k
+			lat = math.log( math.tan((90 + lat) * math.pi / 360.0 )) / (math.pi / 180.0)
+			y2 = lat * k
+			return x2, y2
+		elif crs1 == 3857 and crs2 == 4326:
+			k = GRS80.perimeter/360
+			long = x1 / k
+			lat = y1 / k
+			lat = 180 / math.pi * (2 * math.atan( math.exp( lat * math.pi / 180.0)) - math.pi / 2.0)
+			return long, lat
+		else:
+			x2, y2 = reproj(crs1, crs2, [x1], [y1])
+			return float(x2[0]), float(y2[0])
+
+	x1, y1 = np.asarray(x1, dtype=np.float64), np.asarray(y1, dtype=np.float64)
+	if crs1 == 4326 and crs2 == 3857:
+		k = GRS80.perimeter/360
+		x2 = x1 * k
+		y2 = np.log( np.tan((90 + y1) * np.pi / 360.0 )) / (np.pi / 180.0) * k
+		return x2, y2
+	elif crs1 == 3857 and crs2 == 4326:
+		k = GRS80.perimeter/360
+		x2 = x1 / k
+		y2 = 180 / np.pi * (2 * np.arctan( np.exp( y1 / k * np.pi / 180.0)) - np.pi / 2.0)
+		return x2, y2
+	else:
+		#need an external lib (pyproj or gdal osr) to support others crs
+		if not PROJ:
+			raise NotImplementedError
+		else: #gdal osr, all points are transformed with a single call
+			transfo = getTransform(crs1, crs2)
+			pts = np.column_stack((x1.ravel(), y1.ravel())).tolist()
+			pts = np.array(transfo.TransformPoints(pts), dtype=np.float64)
+			if not len(pts):
+				return x1.copy(), y1.copy()
+			return pts[:,0].reshape(x1.shape), pts[:,1].reshape(y1.shape)
+
+
+def canReproj(crs1, crs2):
+	'''Check if coords can be reprojected from crs1 to crs2, others crs than lat long and web mercator need GDAL'''
+	return PROJ or crs1 == crs2 or {crs1, crs2} == {4326, 3857}
+
+
+def reprojBbox(crs1, crs2, bbox, densify=10):
+	'''
+	Reproject a bbox (xmin, ymin, xmax, ymax) and return the bbox of the result
+	densify is the number of points per bbox edge, edges are not straight lines once reprojected
+	'''
+	if crs1 == crs2:
+		return bbox
+	xmin, ymin, xmax, ymax = bbox
+	pts = []
+	for i in range(densify + 1):
+		x = xmin + (xmax - xmin) * i / densify
+		y = ymin + (ymax - ymin) * i / densify
+		pts.extend([(x, ymin), (x, ymax), (xmin, y), (xmax, y)])
+	xs, ys = reproj(crs1, crs2, *zip(*pts))
+	return xs.min(), ys.min(), xs.max(), ys.max()
+
+
+def warp(src, px, py, resampling='bilinear'):
+	"""
+	Resample src image array (rows, cols, bands) at fractional pixel coords px, py (inverse mapping),
+	pixels centers are at integer coords. Return an array of shape px.shape + bands
+	Coords outside src or not finite give transparent (zero) pixels
+	resampling is 'nearest' or 'bilinear'
+	"""
+	h, w = src.shape[:2]
+	out = np.zeros(px.shape + src.shape[2:], dtype=src.dtype)
+	with np.errstate(invalid='ignore'):
+		inside = (px > -0.5) & (px < w - 0.5) & (py > -0.5) & (py < h - 0.5)
+	px, py = px[inside], py[inside]
+	if resampling == 'nearest':
+		out[inside] = src[np.floor(py + 0.5).astype(int), np.floor(px + 0.5).astype(int)]
+	elif resampling == 'bilinear':
+		x0, y0 = np.floor(px).astype(int), np.floor(py).astype(int)
+		fx, fy = (px - x0)[:, None], (py - y0)[:, None]
+		#neighbours outside the image are replaced by the nearest edge pixel
+		x0, x1 = np.clip(x0, 0, w - 1), np.clip(x0 + 1, 0, w - 1)
+		y0, y1 = np.clip(y0, 0, h - 1), np.clip(y0 + 1, 0, h - 1)
+		v = src[y0, x0] * ((1 - fx) * (1 - fy)) + src[y0, x1] * (fx * (1 - fy)) \
+			+ src[y1, x0] * ((1 - fx) * fy) + src[y1, x1] * (fx * fy)
+		out[inside] = np.round(v)
+	else:
+		raise ValueError('Unknown resampling method ' + str(resampling))
+	return out
+
+
+####################################
+
+class TileMatrix():
+	
+	defaultNbLevels = 24
+	
+	def __init__(self, gridDef):
+
+		#create class attributes from grid dictionnary
+		for k, v in gridDef.items():
+			setattr(self, k, v)
+		
+		#Convert bbox to grid crs is needed
+		if self.bboxCRS != self.CRS:
+			lonMin, latMin, lonMax, latMax = self.bbox
+			self.xmin, self.ymax = self.geoToProj(lonMin, latMax)
+			self.xmax, self.ymin = self.geoToProj(lonMax, latMin)
+		else:
+			self.xmin, self.xmax = self.bbox[0], self.bbox[2]
+			self.ymin, self.ymax = self.bbox[1], self.bbox[3]
+
+		#Get initial resolution
+		if getattr(self, 'resolutions', None) is not None:
+			pass
+		else:
+			if getattr(self, 'initRes', None) is not None:
+				pass
+			else:
+				# at zoom level zero, 1 tile covers whole bounding box
+				dx = abs(self.xmax - self.xmin)
+				dy = abs(self.ymax - self.ymin)
+				dst = max(dx, dy)
+				self.initRes = dst / self.tileSize
+
+		#
+		if getattr(self, 'resolutions', None) is not None:
+			self.nbLevels = len(self.resolutions)
+		elif getattr(self, 'nbLevels', None) is not None:
+			pass
+		else:
+			self.nbLevels = self.defaultNbLevels
+
+		
+		# Define tile matrix origin
+		if self.originLoc == "NW":
+			self.originx, self.originy = self.xmin, self.ymax
+		elif self.originLoc == "SW":
+			self.originx, self.originy = self.xmin, self.ymin
+		else:
+			raise NotImplementedError
+	
+	@property
+	def globalbbox(self):
+		return self.xmin, self.ymin, self.xmax, self.ymax
+
+
+	def geoToProj(self, long, lat):
+		"""convert longitude latitude un decimal degrees to grid crs"""
+		if self.CRS == 4326:
+			return long, lat
+		else:
+			return reproj(4326, self.CRS, long, lat)
+
+	def projToGeo(self, x, y):
+		"""convert grid crs coords to longitude latitude in decimal degrees"""
+		if self.CRS == 4326:
+			return x, y
+		else:
+			return reproj(self.CRS, 4326, x, y)
+
+
+	def getResList(self):
+		if getattr(self, 'resolutions', None) is not None:
+			return self.resolutions
+		else:
+			return [self.initRes / self.resFactor**zoom for zoom in range(self.nbLevels)]
+
+	def getRes(self, zoom):
+		"""Resolution (meters/pixel) for given zoom level (measured at Equator)"""
+		if getattr(self, 'resolutions', None) is not None:
+			if zoom > len(self.resolutions):
+				zoom = len(self.resolutions)
+			return self.resolutions[zoom]
+		else:
+			return self.initRes / self.resFactor**zoom
+
+
+	def getTileNumber(self, x, y, zoom):
+		"""Convert projeted coords to tiles number"""
+		res = self.getRes(zoom)
+		geoTileSize = self.tileSize * res
+		dx = x - self.originx
+		if self.originLoc == "NW":
+			dy = self.originy - y
+		else:
+			dy = y - self.originy
+		col = dx / geoTileSize
+		row = dy / geoTileSize
+		col = int(math.floor(col))
+		row = int(math.floor(row))
+		return col, row
+
+	def getTileCoords(self, col, row, zoom):
+		"""
+		Convert tiles number to projeted coords
+		(top left pixel if matrix origin is NW)
+		"""
+		res = self.getRes(zoom)
+		geoTileSize = self.tileSize * res
+		x = self.originx + (col * geoTileSize)
+		if self.originLoc == "NW":
+			y = self.originy - (row * geoTileSize)
+		else:
+			y = self.originy + (row * geoTileSize) #bottom left
+			y += geoTileSize #top left
+		return x, y
+	
+
+###################
+
+class CancelToken():
+	"""
+	Flag shared by the jobs of a request to abort them without waiting
+	Callbacks can be registered to interrupt blocking calls, like socket reads, when the token is cancelled
+	"""
+
+	def __init__(self):
+		self.cancelled = False
+		self._callbacks = []
+		self._lock = threading.Lock()
+
+	def cancel(self):
+		with self._lock:
+			self.cancelled = True
+			callbacks, self._callbacks = self._callbacks, []
+		for callback in callbacks:
+			try:
+				callback()
+			except Exception:
+				pass
+
+	def register(self, callback):
+		'''Add a function to call on cancellation, called immediately if the token is already cancelled'''
+		with self._lock:
+			if not self.cancelled:
+				self._callbacks.append(callback)
+				return
+		callback()
+
+	def unregister(self, callback):
+		with self._lock:
+			if callback in self._callbacks:
+				self._callbacks.remove(callback)
+
+	def check(self):
+		'''Raise a CancelledError if the token has been cancelled'''
+		if self.cancelled:
+			raise concurrent.futures.CancelledError()
+
+
+class WorkerPool():
+	"""
+	Persistent pool of threads fed by a shared priority queue
+	Jobs with lowest priority value are processed first, jobs with same priority in submission order
+	"""
+
+	def __init__(self, nbWorkers):
+		self.nbWorkers = nbWorkers
+		self.queue = queue.PriorityQueue()
+		self._seq = itertools.count() #jobs sequence number, also avoid comparing jobs with same priority
+		#Timestamps of last finished jobs, used to compute throughput
+		self._done = collections.deque(maxlen=1000)
+		self.workers = []
+		for i in range(nbWorkers):
+			t = threading.Thread(target=self._work, daemon=True)
+			t.start()
+			self.workers.append(t)
+
+	def submit(self, func, *args, priority=0):
+		'''Queue a job and return a future of its result'''
+		future = concurrent.futures.Future()
+		self.queue.put((priority, next(self._seq), future, func, args))
+		return future
+
+	def _work(self):
+		while True:
+			priority, seq, future, func, args = self.queue.get()
+			if func is None: #shutdown request
+				self.queue.task_done()
+				return
+			#the future could have been cancelled while waiting in the queue
+			if future.set_running_or_notify_cancel():
+				try:
+					future.set_result(func(*args))
+				except concurrent.futures.CancelledError as e:
+					future.set_exception(e)
+				except Exception as e:
+					traceback.print_exc()
+					future.set_exception(e)
+				self._done.append(time.time())
+			self.queue.task_done()
+
+	def qsize(self):
+		'''Number of jobs waiting in the queue'''
+		return self.queue.qsize()
+
+	def throughput(self, period=5):
+		'''Number of jobs processed per second during the last period (in seconds)'''
+		t = time.time() - period
+		return len([d for d in list(self._done) if d > t]) / period
+
+	def shutdown(self):
+		'''Stop the workers once the jobs already queued are processed'''
+		for t in self.workers:
+			self.queue.put((float('inf'), next(self._seq), None, None, None))
+		self.workers = []
+
+
+###################
+
+class HTTPPool():
+	"""
+	Pool of persistent HTTP/1.1 connections shared by the download threads
+	Connections are grouped by host and the number of sockets opened per host is bounded
+	System proxies are honored, https requests are tunneled through the proxy and http ones are sent with absolute urls,
+	requests through proxies of other schemes fall back to urllib, without connection reuse
+	"""
+
+	REDIRECTS = (301, 302, 303, 307, 308)
+	MAX_REDIRECTS = 5
+	URLLIB = 'urllib' #route of requests delegated to urllib
+
+	def __init__(self, maxConn=4, timeout=3, name=None):
+		self.maxConn = maxConn #max number of sockets per host
+		self.timeout = timeout
+		self.name = name #key used to report metrics
+		self._idle = {} #{host key: [idle connections]}
+		self._slots = {} #{host key: semaphore}
+		self._routes = {} #{host key: None (direct), URLLIB or (proxy host, proxy port, proxy headers)}
+		self._lock = threading.Lock()
+		self.proxies = urllib.request.getproxies()
+
+	def _hostKey(self, url):
+		parts = urllib.parse.urlsplit(url)
+		return parts.scheme, parts.hostname, parts.port
+
+	def _route(self, key):
+		'''Return how to reach this host : None for a direct connection, URLLIB or (host, port, headers) of a http proxy'''
+		with self._lock:
+			if key in self._routes:
+				return self._routes[key]
+		scheme, host, port = key
+		proxy = self.proxies.get(scheme)
+		if proxy is None or urllib.request.proxy_bypass(host):
+			route = None
+		else:
+			if '://' not in proxy:
+				proxy = 'http://' + proxy
+			parts = urllib.parse.urlsplit(proxy)
+			if parts.scheme != 'http':
+				route = self.URLLIB
+			else:
+				headers = {}
+				if parts.username is not None:
+					creds = urllib.parse.unquote(parts.username) + ':' + urllib.parse.unquote(parts.password or '')
+					headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(creds.encode('utf-8')).decode('ascii')
+				route = (parts.hostname, parts.port or 80, headers)
+		with self._lock:
+			self._routes[key] = route
+		return route
+
+	def _connect(self, key):
+		scheme, host, port = key
+		route = self._route(key)
+		if route is None:
+			if scheme == 'https':
+				return http.client.HTTPSConnection(host, port, timeout=self.timeout)
+			else:
+				return http.client.HTTPConnection(host, port, timeout=self.timeout)
+		proxyHost, proxyPort, proxyHeaders = route
+		if scheme == 'https':
+			#CONNECT tunnel, the tls session is then negotiated with the target host
+			conn = http.client.HTTPSConnection(proxyHost, proxyPort, timeout=self.timeout)
+			conn.set_tunnel(host, port, proxyHeaders)
+			return conn
+		else:
+			return http.client.HTTPConnection(proxyHost, proxyPort, timeout=self.timeout)
+
+	def _abort(self, conn):
+		#shutting down the socket from another thread makes the blocking read return immediately
+		if conn.sock is not None:
+			try:
+				conn.sock.shutdown(socket.SHUT_RDWR)
+			except OSError:
+				pass
+
+	def _send(self, conn, path, headers, token=None):
+		if token is None:
+			conn.request('GET', path, headers=headers)
+			resp = conn.getresponse()
+			return resp, resp.read()
+		abort = lambda: self._abort(conn)
+		token.register(abort)
+		try:
+			conn.request('GET', path, headers=headers)
+			resp = conn.getresponse()
+			data = resp.read()
+		except (http.client.HTTPException, OSError):
+			if token.cancelled:
+				conn.close()
+				raise concurrent.futures.CancelledError()
+			raise
+		finally:
+			token.unregister(abort)
+		if token.cancelled: #the body could be truncated
+			conn.close()
+			raise concurrent.futures.CancelledError()
+		return resp, data
+
+	def _sendNew(self, key, path, headers, token=None):
+		'''Send the request on a new connection, closed if the request fails so its socket doesn't leak'''
+		conn = self._connect(key)
+		try:
+			resp, data = self._send(conn, path, headers, token)
+		except Exception:
+			conn.close()
+			raise
+		return conn, resp, data
+
+	def _get(self, url, headers, token=None):
+		'''Make a GET request on a pooled connection, return the response object and raw body'''
+		key = self._hostKey(url)
+		route = self._route(key)
+		if route == self.URLLIB:
+			return self._urlopen(url, headers, token)
+		parts = urllib.parse.urlsplit(url)
+		path = parts.path or '/'
+		if parts.query:
+			path += '?' + parts.query
+		if route is not None and key[0] == 'http':
+			#a http proxy expects the absolute url, with its credentials in each request
+			path = urllib.parse.urlunsplit((parts.scheme, parts.netloc, path, '', ''))
+			headers = dict(headers)
+			headers.update(route[2])
+		with self._lock:
+			slots = self._slots.setdefault(key, threading.BoundedSemaphore(self.maxConn))
+		with slots:
+			if token is not None:
+				token.check()
+			with self._lock:
+				idle = self._idle.setdefault(key, [])
+				conn = idle.pop() if idle else None
+			if conn is None:
+				conn, resp, data = self._sendNew(key, path, headers, token)
+			else:
+				try:
+					resp, data = self._send(conn, path, headers, token)
+				except socket.timeout:
+					conn.close()
+					raise
+				except (http.client.HTTPException, OSError):
+					#the server has probably closed this keep-alive connection, retry once with a new one
+					conn.close()
+					metrics.count(self.name, 'retries')
+					conn, resp, data = self._sendNew(key, path, headers, token)
+			if resp.will_close:
+				conn.close()
+			else:
+				with self._lock:
+					self._idle[key].append(conn)
+		return resp, data
+
+	def _urlopen(self, url, headers, token=None):
+		'''Make a GET request with urllib, which handles the proxy and follows redirections by itself'''
+		if token is not None:
+			token.check()
+		req = urllib.request.Request(url, None, headers)
+		with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+			return resp, resp.read()
+
+	def request(self, url, headers=None, token=None):
+		'''
+		Return the decoded body of the url, follow redirections
+		Raise an urllib HTTPError if the final response status isn't 200
+		If the optional cancel token is cancelled, the pending read is aborted and a CancelledError is raised
+		'''
+		headers = headers or {}
+		for i in range(self.MAX_REDIRECTS + 1):
+			resp, data = self._get(url, headers, token)
+			metrics.count(self.name, 'requests')
+			metrics.count(self.name, 'bytes', len(data))
+			if resp.status in self.REDIRECTS and resp.getheader('Location'):
+				url = urllib.parse.urljoin(url, resp.getheader('Location'))
+				continue
+			if resp.status != 200:
+				raise urllib.error.HTTPError(url, resp.status, resp.reason, resp.headers, None)
+			return self.decode(data, resp.getheader('Content-Encoding'))
+		raise urllib.error.HTTPError(url, resp.status, 'Too many redirections', resp.headers, None)
+
+	def decode(self, data, encoding):
+		'''Uncompress the body according to Content-Encoding header'''
+		if encoding is None:
+			return data
+		encoding = encoding.strip().lower()
+		if encoding in ('gzip', 'x-gzip'):
+			return gzip.decompress(data)
+		elif encoding == 'deflate':
+			try:
+				return zlib.decompress(data)
+			except zlib.error: #raw deflate stream without zlib header
+				return zlib.decompress(data, -zlib.MAX_WBITS)
+		return data
+
+	def close(self):
+		'''Close all idle connections'''
+		with self._lock:
+			for conns in self._idle.values():
+				for conn in conns:
+					conn.close()
+			self._idle = {}
+
+
+###################
+
+#PIL formats tiles can be stored in, with their names as returned by imghdr
+STORE_FORMATS = {'PNG':'png', 'JPEG':'jpeg', 'WEBP':'webp'}
+
+def canEncode(fmt):
+	'''Check if PIL has been built with the encoder of this format'''
+	Image.init()
+	return fmt in Image.SAVE
+
+def encodeImage(img, fmt, quality=None):
+	'''
+	Encode a PIL image, return (data, format) with format named as by imghdr
+	JPEG can't store transparency so images with transparent pixels are encoded in PNG
+	'''
+	if fmt != 'PNG':
+		if img.mode not in ('RGB', 'RGBA'):
+			img = img.convert('RGBA')
+		if img.mode == 'RGBA' and img.split()[-1].getextrema()[0] == 255:
+			img = img.convert('RGB') #fully opaque
+		if fmt == 'JPEG' and img.mode == 'RGBA':
+			fmt = 'PNG'
+	options = {'quality': quality} if quality is not None and fmt != 'PNG' else {}
+	buf = io.BytesIO()
+	img.save(buf, fmt, **options)
+	return buf.getvalue(), STORE_FORMATS[fmt]
+
+def transcode(data, fmt, quality=None, format=None):
+	'''
+	Re-encode tile data in another format, return (data, format)
+	format is the current format of data, it's sniffed if unknown
+	Original data is kept if it's already in the requested format, if it's not a valid image, or if it's not made smaller
+	(module level function so it can be run by a process pool)
+	'''
+	if format is None:
+		format = imghdr.what(None, data)
+	if format is None or format == STORE_FORMATS[fmt]:
+		return data, format
+	try:
+		img = Image.open(io.BytesIO(data))
+		img.load()
+	except Exception:
+		return data, format
+	newData, newFormat = encodeImage(img, fmt, quality)
+	if len(newData) >= len(data):
+		return data, format
+	return newData, newFormat
+
+
+###################
+
+#Tiles currently downloading {(srcKey, layKey, zoom, col, row): future}
+#shared by all services so a tile is never requested twice at the same time
+inFlight = {}
+inFlightLock = threading.Lock()
+
+
+class MapService():
+	"""
+	Represent a tile service from source
+	""" 
+	
+	DEFAULT_THREADS = 4 #number of download threads if not defined by the source
+	TIMEOUT = 3 #seconds
+	RESAMPLING = 'bilinear' #resampling method of reprojected tiles if not defined by the source
+	ZOOM_TOLERANCE = 1.2 #a source zoom level up to 20% coarser than the destination resolution is used for reprojection
+	MAX_SRC_TILES = 16 #max number of source tiles used to build a reprojected tile
+	MISSING_STATUS = (204, 404) #http status of a request for a tile that doesn't exist on the server
+	META_MEMORY = 16 #number of WMS metatiles kept in memory
+	STORE_QUALITY = 80 #quality of JPEG or WEBP tiles transcoded in cache if not defined by the source
+
+	def __init__(self, srcKey, cacheFolder, dstGrid=None):
+		'''
+		dstGrid is the key of the grid in which tiles are served, it overrides the source "dstGrid" option
+		if it differs from the source grid, tiles are reprojected
+		'''
+		
+
+		#create class attributes from source dictionnary
+		self.srcKey = srcKey
+		source = sources[self.srcKey]
+		for k, v in source.items():
+			setattr(self, k, v)
+
+		#Build objects from layers definitions
+		class Layer(): pass
+		layersObj = {}
+		for layKey, layDict in self.layers.items(): 
+			lay = Layer()
+			for k, v in layDict.items():
+				setattr(lay, k, v)
+			layersObj[layKey] = lay
+		self.layers = layersObj
+	
+		#Build source tile matrix
+		self.tm1 = TileMatrix(grids[self.grid])
+		
+		#Build destination tile matrix
+		if dstGrid is not None:
+			self.dstGrid = dstGrid
+		elif getattr(self, 'dstGrid', None) is None:
+			self.dstGrid = self.grid
+		if self.dstGrid != self.grid:
+			if not canReproj(grids[self.dstGrid]['CRS'], grids[self.grid]['CRS']):
+				raise ValueError('Reprojecting ' + srcKey + ' tiles to ' + self.dstGrid + ' grid requires GDAL')
+			self.tm2 = TileMatrix(grids[self.dstGrid])
+		else:
+			self.tm2 = self.tm1
+
+		#Init cache dict
+		self.cacheFolder = cacheFolder
+		self.caches = {}
+		self._cachesLock = threading.Lock()
+
+		#Store policy, tiles are transcoded to this format before being put in cache, a layer can override it
+		self.storeFormat = self.checkStoreFormat(getattr(self, 'storeFormat', None))
+		self.storeQuality = getattr(self, 'storeQuality', self.STORE_QUALITY)
+		for lay in self.layers.values():
+			lay.storeFormat = self.checkStoreFormat(getattr(lay, 'storeFormat', self.storeFormat))
+			lay.storeQuality = getattr(lay, 'storeQuality', self.storeQuality)
+		#Optional executor (eg. a process pool) running the transcoding, in the download thread if None
+		self.transcoder = None
+
+		#Recently downloaded WMS metatiles {key: {(col, row): data}}
+		self._metaTiles = collections.OrderedDict()
+		self._metaLock = threading.Lock()
+
+		#Downloads threads pool, built on first use and kept alive between requests
+		self._pool = None
+
+		#Persistent http connections shared by the download threads
+		self.http = HTTPPool(maxConn=getattr(self, 'nbThreads', self.DEFAULT_THREADS), timeout=self.TIMEOUT, name=srcKey)
+
+		#Fake browser header
+		self.headers = {
+			'Accept' : 'image/png,image/*;q=0.8,*/*;q=0.5' ,
+			'Accept-Charset' : 'ISO-8859-1,utf-8;q=0.7,*;q=0.7' ,
+			'Accept-Encoding' : 'gzip,deflate' ,
+			'Accept-Language' : 'fr,en-us,en;q=0.5' ,
+			'Keep-Alive': 115 ,
+			'Proxy-Connection' : 'keep-alive' ,
+			'User-Agent' : 'Mozilla/5.0 (Windows; U; Windows NT 5.1; fr; rv:1.9.2.13) Gecko/20101003 Firefox/12.0',
+			'Referer' : self.referer}
+
+
+	def checkStoreFormat(self, fmt):
+		'''Return the PIL name of a store format, fallback to JPEG if PIL can't encode it'''
+		if fmt is None:
+			return None
+		fmt = fmt.upper()
+		if fmt not in STORE_FORMATS:
+			raise ValueError('Unsupported store format ' + fmt)
+		if not canEncode(fmt):
+			print("PIL can't encode " + fmt + ", tiles of " + self.srcKey + " are stored in JPEG")
+			fmt = 'JPEG'
+		return fmt
+
+
+	@property
+	def pool(self):
+		if self._pool is None:
+			self._pool = WorkerPool(getattr(self, 'nbThreads', self.DEFAULT_THREADS))
+		return self._pool
+
+
+	def close(self, wait=True):
+		'''
+		Stop the threads pool and write pending tiles in caches
+		If wait is False, tiles are written in background, so the caller is not blocked by a large batch or a locked database
+		'''
+		if self._pool is not None:
+			self._pool.shutdown()
+			self._pool = None
+		self.http.close()
+		for cache in self.caches.values():
+			cache.close(wait)
+
+
+	def getCache(self, layKey):
+		'''Return existing cache for requested layer or built it if not exists'''
+		if self.tm2 is self.tm1:
+			return self.getSrcCache(layKey)
+		#reprojected tiles are stored in their own cache, named after destination grid
+		return self._getCache((layKey, self.dstGrid), self.srcKey + '_' + layKey + '_' + self.dstGrid, self.tm2)
+
+
+	def getSrcCache(self, layKey):
+		'''Return the cache of tiles downloaded in source grid'''
+		return self._getCache(layKey, self.srcKey + '_' + layKey, self.tm1)
+
+
+	def _getCache(self, key, mapKey, tm):
+		cache = self.caches.get(key)
+		if cache is None:
+			#caches can be requested at the same time by the download threads
+			with self._cachesLock:
+				cache = self.caches.get(key)
+				if cache is None:
+					dbPath = self.cacheFolder + mapKey + ".gpkg"
+					cache = self.caches[key] = GeoPackage(dbPath, tm, dedup=getattr(self, 'dedup', False))
+		return cache
+
+
+
+	def buildUrl(self, layKey, col, row, zoom):
+		"""
+		Receive tiles coords coords in destination tile matrix space
+		convert to source tile matrix space and build request url
+		"""
+		url = self.urlTemplate
+		lay = self.layers[layKey]
+		
+		if self.service == 'TMS':
+			url = url.replace("{LAY}", lay.urlKey)
+			if not self.quadTree:
+				url = url.replace("{X}", str(col))
+				url = url.replace("{Y}", str(row))
+				url = url.replace("{Z}", str(zoom))
+			else:
+				quadkey = self.getQuadKey(col, row, zoom)
+				url = url.replace("{QUADKEY}", quadkey) 
+			
+		if self.service == 'WMTS':
+			url = self.urlTemplate['BASE_URL']
+			if url[-1] != '?' :
+				url += '?'
+			params = ['='.join([k,v]) for k, v in self.urlTemplate.items() if k != 'BASE_URL']
+			url += '&'.join(params)
+			url = url.replace("{LAY}", lay.urlKey)
+			url = url.replace("{FORMAT}", lay.format)
+			url = url.replace("{STYLE}", lay.style)
+			url = url.replace("{MATRIX}", self.matrix)  
+			url = url.replace("{X}", str(col))
+			url = url.replace("{Y}", str(row))
+			url = url.replace("{Z}", str(zoom))
+			
+		if self.service == 'WMS':
+			xmin, ymax = self.tm1.getTileCoords(col, row, zoom)
+			xmax = xmin + self.tm1.tileSize * self.tm1.getRes(zoom)
+			ymin = ymax - self.tm1.tileSize * self.tm1.getRes(zoom)
+			url = self.buildWMSUrl(layKey, (xmin, ymin, xmax, ymax), self.tm1.tileSize, self.tm1.tileSize)
+													
+		return url
+
+
+	def buildWMSUrl(self, layKey, bbox, width, height):
+		'''Build a WMS GetMap url for a bbox in source crs and an image size in pixels'''
+		lay = self.layers[layKey]
+		url = self.urlTemplate['BASE_URL']
+		if url[-1] != '?' :
+			url += '?'  
+		params = ['='.join([k,v]) for k, v in self.urlTemplate.items() if k != 'BASE_URL']
+		url += '&'.join(params)
+		url = url.replace("{LAY}", lay.urlKey)
+		url = url.replace("{FORMAT}", lay.format)
+		url = url.replace("{STYLE}", lay.style)
+		url = url.replace("{CRS}", str(self.tm1.CRS))
+		url = url.replace("{WIDTH}", str(width))
+		url = url.replace("{HEIGHT}", str(height))
+		
+		xmin, ymin, xmax, ymax = bbox
+		if self.urlTemplate['VERSION'] == '1.3.0' and self.tm1.CRS == 4326:
+			bbox = ','.join(map(str,[ymin,xmin,ymax,xmax]))
+		else:
+			bbox = ','.join(map(str,[xmin,ymin,xmax,ymax]))
+		url = url.replace("{BBOX}", bbox)
+		return url
+
+
+	def getQuadKey(self, x, y, z):
+		"Converts TMS tile coordinates to Microsoft QuadTree"
+		quadKey = ""
+		for i in range(z, 0, -1):
+			digit = 0
+			mask = 1 << (i-1)
+			if (x & mask) != 0:
+				digit += 1
+			if (y & mask) != 0:
+				digit += 2
+			quadKey += str(digit)
+		return quadKey
+
+
+	def isTileInBounds(self, col, row, zoom, tm=None):
+		'''Check if the tile is inside the tile matrix bounds, destination tile matrix by default'''
+		tm = tm or self.tm2
+		x,y = tm.getTileCoords(col, row, zoom) #top left
+		if row < 0 or col < 0:
+			return False
+		elif not tm.xmin <= x < tm.xmax or not tm.ymin < y <= tm.ymax:
+			return False
+		return True
+
+
+	def getTile(self, layKey, col, row, zoom, token=None):
+		"""
+		Return bytes data of requested tile
+		Tile is downloaded from map service or directly pick up from cache database.
+		The optional cancel token is used to abort the download
+		"""
+
+		cache = self.getCache(layKey)
+	
+		#don't try to get tiles out of map bounds
+		if not self.isTileInBounds(col, row, zoom):
+			return None
+				
+		#check if tile already exists in cache
+		with metrics.timer('cache'):
+			data, format = cache.getTile(col, row, zoom)
+		
+		#if so check if its a valid image, the format recorded in cache avoid sniffing the data
+		if data is not None:
+			if format is None:
+				format = imghdr.what(None, data)
+			if format is None:#corrupted
+				data = None
+			
+		#if not or corrupted try to download it from map service			
+		if data is None:
+			metrics.count(self.srcKey, 'misses')
+			data, partial = self.downloadTile(layKey, col, row, zoom, token)
+		else:
+			metrics.count(self.srcKey, 'cacheHits')
+		
+		return data
+
+
+	def downloadTile(self, layKey, col, row, zoom, token=None):
+		"""
+		Download the tile from map service, reproject it if needed, and put it in cache
+		Return (data, partial), data is None if the request fails, partial is True if the tile
+		has been reprojected with some source tiles missing, such tile is not cached and must be requested again
+		Raise a CancelledError if the optional cancel token is cancelled before the end of the download
+		"""
+		key = (self.srcKey, layKey, self.dstGrid, zoom, col, row)
+		return self.coalesce(key, self.fetchTile, (layKey, col, row, zoom, token), token)
+
+
+	def coalesce(self, key, func, args, token=None):
+		"""
+		Return func(*args), concurrent calls with the same key, even from others MapService instances,
+		wait for the first call and share its result
+		"""
+		while True:
+			with inFlightLock:
+				future = inFlight.get(key)
+				leader = future is None
+				if leader:
+					future = concurrent.futures.Future()
+					inFlight[key] = future
+			if leader:
+				break
+			metrics.count(self.srcKey, 'coalesced')
+			try:
+				return self.waitTile(future, token)
+			except concurrent.futures.CancelledError:
+				if token is not None and token.cancelled:
+					raise
+				#the first request has been cancelled by its owner, not by us, so request it again
+		try:
+			data = func(*args)
+		except Exception as e:
+			future.set_exception(e)
+			raise
+		else:
+			future.set_result(data)
+		finally:
+			with inFlightLock:
+				del inFlight[key]
+		return data
+
+
+	def waitTile(self, future, token=None):
+		'''Wait for the result of a download made by another thread, unless the cancel token is cancelled'''
+		if token is None:
+			return future.result()
+		while True:
+			token.check()
+			try:
+				return future.result(timeout=0.1)
+			except concurrent.futures.TimeoutError:
+				pass
+
+
+	def fetchTile(self, layKey, col, row, zoom, token=None):
+		'''Get a destination grid tile from map service and put it in cache, return (data, partial)'''
+		if self.tm2 is self.tm1:
+			return self.requestTile(layKey, col, row, zoom, token), False
+		else:
+			return self.warpTile(layKey, col, row, zoom, token)
+
+
+	def requestTile(self, layKey, col, row, zoom, token=None):
+		'''Request the source grid tile to map service, validate it and put it in cache'''
+		if not self.isTileInBounds(col, row, zoom, self.tm1):
+			return None
+
+		#don't request again a tile known as missing
+		cache = self.getSrcCache(layKey)
+		if cache.isMissing(col, row, zoom):
+			#request not sent because the tile is known as missing
+			metrics.count(self.srcKey, 'avoided')
+			return None
+
+		#WMS sources can be requested by metatiles
+		if self.service == 'WMS' and getattr(self, 'metaSize', None) is not None:
+			data = self.requestMetaTile(layKey, col, row, zoom, token)
+			if data is not None:
+				return data
+			#the metatile failed, fall back to a request of the single tile
+
+		url = self.buildUrl(layKey, col, row, zoom)
+		#print(url)
+		
+		try:
+			#make request on a persistent connection
+			t0 = time.perf_counter()
+			data = self.http.request(url, self.headers, token)
+			metrics.add('download', time.perf_counter() - t0)
+		except concurrent.futures.CancelledError:
+			#an aborted download does not mean the tile is missing
+			raise
+		except Exception as e:
+			metrics.count(self.srcKey, 'errors')
+			print("Can't download tile x"+str(col)+" y"+str(row))
+			print(url)
+			data = None
+			reason = str(e)
+			missing = isinstance(e, urllib.error.HTTPError) and e.code in self.MISSING_STATUS
+	
+		#Make sure the stream is correct and put in db
+		if data is not None:
+			format = imghdr.what(None, data)
+			if format is None:
+				data = None
+				missing = False
+			else:
+				data, format = self.encodeTile(layKey, data, format)
+				cache.putTile(col, row, zoom, data, format)
+
+		#only a tile reported as missing by the server is recorded in the cache, other errors can be transient
+		if data is None:
+			if missing:
+				cache.putMissing(col, row, zoom, reason)
+			else:
+				cache.putFailed(col, row, zoom)
+		
+		return data
+
+
+	def encodeTile(self, layKey, data, format):
+		'''Apply the layer store policy to downloaded tile data, return (data, format) to put in cache'''
+		lay = self.layers[layKey]
+		if lay.storeFormat is None:
+			return data, format
+		with metrics.timer('encode'):
+			if self.transcoder is not None:
+				return self.transcoder.submit(transcode, data, lay.storeFormat, lay.storeQuality, format).result()
+			return transcode(data, lay.storeFormat, lay.storeQuality, format)
+
+
+	def requestMetaTile(self, layKey, col, row, zoom, token=None):
+		'''
+		Get a WMS tile by requesting the whole metatile containing it in a single GetMap call
+		All tiles of the metatile are put in cache, return bytes data of the requested one
+		or None if the metatile request failed
+		'''
+		nx, ny = self.metaSize
+		key = (self.srcKey, layKey, self.grid, zoom, 'meta', col // nx, row // ny)
+		#tiles of recent metatiles are kept in memory, until they are commited in cache
+		with self._metaLock:
+			tiles = self._metaTiles.get(key)
+		if tiles is None:
+			tiles = self.coalesce(key, self.fetchMetaTile, (layKey, col // nx, row // ny, zoom, token), token)
+			if tiles is None:
+				#failures are not kept, the metatile will be requested again
+				return None
+			with self._metaLock:
+				self._metaTiles[key] = tiles
+				while len(self._metaTiles) > self.META_MEMORY:
+					self._metaTiles.popitem(last=False)
+		return tiles.get((col, row))
+
+
+	def fetchMetaTile(self, layKey, mcol, mrow, zoom, token=None):
+		'''
+		Request a metatile, split it in tiles and put them in cache, return a dict {(col, row): data}
+		or None if the request fails
+		'''
+		nx, ny = self.metaSize
+		buf = getattr(self, 'metaBuffer', 0)
+		ts = self.tm1.tileSize
+		res = self.tm1.getRes(zoom)
+
+		#Clamp the metatile to the matrix bounds, so the request doesn't exceed the crs domain (like latitudes beyond 90°)
+		inBounds = lambda c, r: self.isTileInBounds(c, r, zoom, self.tm1)
+		tiles = [(mcol * nx + i, mrow * ny + j) for i in range(nx) for j in range(ny)]
+		tiles = [(c, r) for c, r in tiles if inBounds(c, r)]
+		if not tiles:
+			return {}
+		cmin, cmax = min(c for c, r in tiles), max(c for c, r in tiles)
+		rmin, rmax = min(r for c, r in tiles), max(r for c, r in tiles)
+		if self.tm1.originLoc == "NW":
+			rowTop, rowAbove, rowBelow = rmin, rmin - 1, rmax + 1
+		else:
+			rowTop, rowAbove, rowBelow = rmax, rmax + 1, rmin - 1
+
+		#Metatile bbox, extended by the buffer on each side except at the matrix edges
+		bufW = buf if inBounds(cmin - 1, rowTop) else 0
+		bufE = buf if inBounds(cmax + 1, rowTop) else 0
+		bufN = buf if inBounds(cmin, rowAbove) else 0
+		bufS = buf if inBounds(cmin, rowBelow) else 0
+		xmin, ymax = self.tm1.getTileCoords(cmin, rowTop, zoom)
+		xmin, ymax = xmin - bufW * res, ymax + bufN * res
+		width = (cmax - cmin + 1) * ts + bufW + bufE
+		height = (rmax - rmin + 1) * ts + bufN + bufS
+		bbox = (xmin, ymax - height * res, xmin + width * res, ymax)
+		url = self.buildWMSUrl(layKey, bbox, width, height)
+		cache = self.getSrcCache(layKey)
+
+		try:
+			t0 = time.perf_counter()
+			data = self.http.request(url, self.headers, token)
+			metrics.add('download', time.perf_counter() - t0)
+			img = Image.open(io.BytesIO(data))
+			img.load()
+		except concurrent.futures.CancelledError:
+			raise
+		except Exception as e:
+			metrics.count(self.srcKey, 'errors')
+			print("Can't download metatile x"+str(mcol)+" y"+str(mrow)+" : "+str(e))
+			print(url)
+			#tiles are not flagged as missing, they will be requested one by one
+			return None
+
+		#Split the metatile, tiles are encoded in the store format or else in the layer format
+		lay = self.layers[layKey]
+		if lay.storeFormat is not None:
+			fmt, quality = lay.storeFormat, lay.storeQuality
+		else:
+			fmt = 'JPEG' if lay.format.lower() in ('jpeg', 'jpg') else 'PNG'
+			quality = None
+		result = {}
+		for c, r in tiles:
+			i = c - cmin
+			j = r - rowTop if self.tm1.originLoc == "NW" else rowTop - r
+			x, y = bufW + i * ts, bufN + j * ts
+			tile = img.crop((x, y, x + ts, y + ts))
+			with metrics.timer('encode'):
+				result[(c, r)], format = encodeImage(tile, fmt, quality)
+			cache.putTile(c, r, zoom, result[(c, r)], format)
+		return result
+
+
+	def getSrcTile(self, layKey, col, row, zoom, token=None):
+		'''Return bytes data of a source grid tile, from cache or downloaded'''
+		data, format = self.getSrcCache(layKey).getTile(col, row, zoom)
+		if data is not None and (format or imghdr.what(None, data)) is not None:
+			return data
+		key = (self.srcKey, layKey, self.grid, zoom, col, row)
+		return self.coalesce(key, self.requestTile, (layKey, col, row, zoom, token), token)
+
+
+	def getSrcZoom(self, layKey, res):
+		'''Return the source zoom level whose resolution is the closest one finer or equal to res (in source crs units)'''
+		lay = self.layers[layKey]
+		zmax = min(lay.zmax, len(self.tm1.getResList()) - 1)
+		for z in range(lay.zmin, zmax + 1):
+			if self.tm1.getRes(z) <= res * self.ZOOM_TOLERANCE:
+				return z
+		return zmax
+
+
+	def warpTile(self, layKey, col, row, zoom, token=None):
+		"""
+		Build a destination grid tile by resampling the source tiles covering it, put it in cache
+		Return (data, partial), data is image data (png or store format) or None if no source tile is available
+		Tiles that could be built only partially are returned with partial flag but not cached
+		"""
+		if not self.isTileInBounds(col, row, zoom):
+			return None, False
+		cache = self.getCache(layKey)
+		if cache.isMissing(col, row, zoom):
+			#request not sent because the tile is known as missing
+			metrics.count(self.srcKey, 'avoided')
+			return None, False
+
+		#Coords of destination pixels centers, reprojected in source crs (inverse mapping)
+		size = self.tm2.tileSize
+		res = self.tm2.getRes(zoom)
+		xmin, ymax = self.tm2.getTileCoords(col, row, zoom)
+		xs = xmin + (np.arange(size) + 0.5) * res
+		ys = ymax - (np.arange(size) + 0.5) * res
+		xs, ys = np.meshgrid(xs, ys)
+		#points outside the source crs domain (eg. poles in mercator) give non finite coords, masked below
+		with np.errstate(invalid='ignore', divide='ignore'):
+			sx, sy = reproj(self.tm2.CRS, self.tm1.CRS, xs, ys)
+		valid = np.isfinite(sx) & np.isfinite(sy)
+		if not valid.any():
+			cache.putMissing(col, row, zoom, 'Outside source crs')
+			return None, False
+
+		#Source zoom level, its resolution should be close to destination resolution
+		#and the number of source tiles must stay reasonable where the projection is highly distorted
+		sxmin, sxmax = sx[valid].min(), sx[valid].max()
+		symin, symax = sy[valid].min(), sy[valid].max()
+		szoom = self.getSrcZoom(layKey, math.sqrt((sxmax - sxmin) * (symax - symin)) / size)
+		while True:
+			sres = self.tm1.getRes(szoom)
+			#one pixel margin for bilinear interpolation
+			col1, rowA = self.tm1.getTileNumber(sxmin - sres, symax + sres, szoom)
+			col2, rowB = self.tm1.getTileNumber(sxmax + sres, symin - sres, szoom)
+			row1, row2 = min(rowA, rowB), max(rowA, rowB)
+			if (col2 - col1 + 1) * (row2 - row1 + 1) <= self.MAX_SRC_TILES or szoom <= self.layers[layKey].zmin:
+				break
+			szoom -= 1
+
+		#Mosaic of source tiles, missing ones are left transparent
+		ts = self.tm1.tileSize
+		mosaic = np.zeros(((row2 - row1 + 1) * ts, (col2 - col1 + 1) * ts, 4), dtype=np.uint8)
+		nbTiles, nbMissing = 0, 0
+		for c in range(col1, col2 + 1):
+			for r in range(row1, row2 + 1):
+				if not self.isTileInBounds(c, r, szoom, self.tm1):
+					continue
+				nbTiles += 1
+				data = self.getSrcTile(layKey, c, r, szoom, token)
+				try:
+					img = Image.open(io.BytesIO(data)).convert('RGBA')
+				except Exception:
+					nbMissing += 1
+					continue
+				#mosaic rows go from north to south whatever the tile matrix origin
+				i = r - row1 if self.tm1.originLoc == "NW" else row2 - r
+				j = c - col1
+				mosaic[i*ts:(i+1)*ts, j*ts:(j+1)*ts] = np.asarray(img)
+		if nbTiles and nbMissing == nbTiles:
+			#source tiles record their own failures, the warped tile can be tried again soon
+			cache.putFailed(col, row, zoom)
+			return None, False
+
+		#Resample, source pixels coords are relative to mosaic top left corner
+		t0 = time.perf_counter()
+		mx, my = self.tm1.getTileCoords(col1, row1 if self.tm1.originLoc == "NW" else row2, szoom)
+		px = (sx - mx) / sres - 0.5
+		py = (my - sy) / sres - 0.5
+		px[~valid] = np.nan
+		img = Image.fromarray(warp(mosaic, px, py, getattr(self, 'resampling', self.RESAMPLING)), 'RGBA')
+		metrics.add('warp', time.perf_counter() - t0)
+		with metrics.timer('encode'):
+			lay = self.layers[layKey]
+			data, format = encodeImage(img, lay.storeFormat or 'PNG', lay.storeQuality)
+
+		if nbMissing == 0:
+			cache.putTile(col, row, zoom, data, format)
+		return data, nbMissing > 0
+
+
+	def listTiles(self, bbox, zoom):
+		
+		xmin, ymin, xmax, ymax = bbox
+				
+		#Get first tile indices (tiles matrix origin is top left)
+		firstCol, firstRow = self.tm2.getTileNumber(xmin, ymax, zoom)
+		
+		#Total number of tiles required
+		nbTilesX = math.ceil( (xmax - xmin) / (self.tm2.tileSize * self.tm2.getRes(zoom)) )
+		nbTilesY = math.ceil( (ymax - ymin) / (self.tm2.tileSize * self.tm2.getRes(zoom)) )
+			
+		#Add more tiles because background image will be offseted 
+		# and could be to small to cover all area
+		nbTilesX += 1
+		nbTilesY += 1
+
+		#Build list of required column and row numbers
+		cols = [firstCol+i for i in range(nbTilesX)]
+		if self.tm2.originLoc == "NW":
+			rows = [firstRow+i for i in range(nbTilesY)]
+		else:
+			rows = [firstRow-i for i in range(nbTilesY)]
+
+		return cols, rows
+
+
+	def getTiles(self, layKey, tiles, zoom):
+		'''
+		Return a dict {(col, row): data} of requested tiles already available in cache
+		Missing, expired or corrupted tiles are omitted
+		'''
+		cache = self.getCache(layKey)
+		with metrics.timer('cache'):
+			result = cache.getTiles(tiles, zoom)
+		result = {tile:data for tile, (data, t, format) in result.items() if (format or imghdr.what(None, data)) is not None}
+		metrics.count(self.srcKey, 'cacheHits', len(result))
+		metrics.count(self.srcKey, 'misses', len(tiles) - len(result))
+		return result
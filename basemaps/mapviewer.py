@@ -18,648 +18,112 @@
 #  ***** GPL LICENSE BLOCK *****
 
 #built-in imports
-import math
-import os
 import io
+import os
+import math
 import threading
-import datetime
-import sqlite3
-import urllib.request
-import imghdr
+import collections
+import time
+import concurrent.futures
 
 #bpy imports
 import bpy
 from bpy.props import StringProperty, IntProperty, FloatProperty, BoolProperty, EnumProperty, FloatVectorProperty
 from bpy_extras.view3d_utils import region_2d_to_location_3d, region_2d_to_vector_3d
+from bpy_extras.io_utils import ExportHelper
 import blf, bgl
 
 #deps imports
 from PIL import Image
-try:
-	from osgeo import osr
-except:
-	PROJ = False
-else:
-	PROJ = True
+import numpy as np #Ship with Blender since 2.70
 
 #addon import
-from .servicesDefs import grids, sources
-
-
-####################################
-
-#http://www.geopackage.org/spec/#tiles
-#https://github.com/GitHubRGI/geopackage-python/blob/master/Packaging/tiles2gpkg_parallel.py
-#https://github.com/Esri/raster2gpkg/blob/master/raster2gpkg.py
-
-
-#table_name refer to the name of the table witch contains tiles data
-#here for simplification, table_name will always be named "gpkg_tiles"
-
-class GeoPackage():
-
-	MAX_DAYS = 90
-
-	def __init__(self, path, tm):
-		self.dbPath = path
-		self.name = os.path.splitext(os.path.basename(path))[0]
-		
-		#Get props from TileMatrix object
-		self.crs = tm.CRS
-		self.tileSize = tm.tileSize
-		self.xmin, self.ymin, self.xmax, self.ymax = tm.globalbbox
-		self.resolutions = tm.getResList()
-
-		if not self.isGPKG():
-			self.create()
-			self.insertMetadata()
-			
-			self.insertCRS(self.crs, str(self.crs), wkt='')
-			#self.insertCRS(3857, "Web Mercator", wkt='')
-			#self.insertCRS(4326, "WGS84", wkt='')
-
-			self.insertTileMatrixSet()
-
-
-	def isGPKG(self):
-		if not os.path.exists(self.dbPath):
-			return False	
-		db = sqlite3.connect(self.dbPath)
-		
-		#check application id
-		app_id = db.execute("PRAGMA application_id").fetchone()
-		if not app_id[0] == 1196437808:
-			db.close()
-			return False
-			
-		#quick check of table schema
-		try:
-			db.execute('SELECT table_name FROM gpkg_contents LIMIT 1')
-			db.execute('SELECT srs_name FROM gpkg_spatial_ref_sys LIMIT 1')
-			db.execute('SELECT table_name FROM gpkg_tile_matrix_set LIMIT 1')
-			db.execute('SELECT table_name FROM gpkg_tile_matrix LIMIT 1')
-			db.execute('SELECT zoom_level, tile_column, tile_row, tile_data FROM gpkg_tiles LIMIT 1')
-		except:
-			db.close()
-			return False
-		else:
-			db.close()
-			return True  
-		
-		
-	def create(self):
-		"""Create default geopackage schema on the database."""
-		db = sqlite3.connect(self.dbPath) #this attempt will create a new file if not exist
-		cursor = db.cursor()
-
-		# Add GeoPackage version 1.0 ("GP10" in ASCII) to the Sqlite header
-		cursor.execute("PRAGMA application_id = 1196437808;")
-		
-		cursor.execute("""
-			CREATE TABLE gpkg_contents (
-				table_name TEXT NOT NULL PRIMARY KEY,
-				data_type TEXT NOT NULL,
-				identifier TEXT UNIQUE,
-				description TEXT DEFAULT '',
-				last_change DATETIME NOT NULL DEFAULT
-				(strftime('%Y-%m-%dT%H:%M:%fZ','now')),
-				min_x DOUBLE,
-				min_y DOUBLE,
-				max_x DOUBLE,
-				max_y DOUBLE,
-				srs_id INTEGER,
-				CONSTRAINT fk_gc_r_srs_id FOREIGN KEY (srs_id)
-					REFERENCES gpkg_spatial_ref_sys(srs_id));
-		""")
-		
-		cursor.execute("""
-			CREATE TABLE gpkg_spatial_ref_sys (
-				srs_name TEXT NOT NULL,
-				srs_id INTEGER NOT NULL PRIMARY KEY,
-				organization TEXT NOT NULL,
-				organization_coordsys_id INTEGER NOT NULL,
-				definition TEXT NOT NULL,
-				description TEXT);
-		""")
-
-		cursor.execute("""
-			CREATE TABLE gpkg_tile_matrix_set (
-				table_name TEXT NOT NULL PRIMARY KEY,
-				srs_id INTEGER NOT NULL,
-				min_x DOUBLE NOT NULL,
-				min_y DOUBLE NOT NULL,
-				max_x DOUBLE NOT NULL,
-				max_y DOUBLE NOT NULL,
-				CONSTRAINT fk_gtms_table_name FOREIGN KEY (table_name)
-					REFERENCES gpkg_contents(table_name),
-				CONSTRAINT fk_gtms_srs FOREIGN KEY (srs_id)
-					REFERENCES gpkg_spatial_ref_sys(srs_id));
-		""")
-
-		cursor.execute("""
-			CREATE TABLE gpkg_tile_matrix (
-				table_name TEXT NOT NULL,
-				zoom_level INTEGER NOT NULL,
-				matrix_width INTEGER NOT NULL,
-				matrix_height INTEGER NOT NULL,
-				tile_width INTEGER NOT NULL,
-				tile_height INTEGER NOT NULL,
-				pixel_x_size DOUBLE NOT NULL,
-				pixel_y_size DOUBLE NOT NULL,
-				CONSTRAINT pk_ttm PRIMARY KEY (table_name, zoom_level),
-				CONSTRAINT fk_ttm_table_name FOREIGN KEY (table_name)
-					REFERENCES gpkg_contents(table_name));
-		""")		
-		
-		cursor.execute("""
-			CREATE TABLE gpkg_tiles (
-				id INTEGER PRIMARY KEY AUTOINCREMENT,
-				zoom_level INTEGER NOT NULL,
-				tile_column INTEGER NOT NULL,
-				tile_row INTEGER NOT NULL,
-				tile_data BLOB NOT NULL,
-				last_modified TIMESTAMP DEFAULT (datetime('now','localtime')),
-				UNIQUE (zoom_level, tile_column, tile_row));
-		""")
-
-
-
-	def insertMetadata(self):
-		db = sqlite3.connect(self.dbPath)
-		query = """INSERT INTO gpkg_contents (
-					table_name, data_type,
-					identifier, description,
-					min_x, min_y, max_x, max_y,
-					srs_id)
-				VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);"""
-		db.execute(query, ("gpkg_tiles", "tiles", self.name, "Created with BlenderGIS", self.xmin, self.ymin, self.xmax, self.ymax, self.crs))  
-		db.commit()
-		db.close()		
-
-
-	def insertCRS(self, code, name, wkt=''):
-		db = sqlite3.connect(self.dbPath)
-		db.execute(""" INSERT INTO gpkg_spatial_ref_sys (
-					srs_id,
-					organization,
-					organization_coordsys_id,
-					srs_name,
-					definition)
-				VALUES (?, ?, ?, ?, ?)
-			""", (code, "EPSG", code, name, wkt))
-		db.commit()
-		db.close()
-
-
-	def insertTileMatrixSet(self):
-		db = sqlite3.connect(self.dbPath)
-		
-		#Tile matrix set
-		query = """INSERT OR REPLACE INTO gpkg_tile_matrix_set (
-					table_name, srs_id,
-					min_x, min_y, max_x, max_y)
-				VALUES (?, ?, ?, ?, ?, ?);"""
-		db.execute(query, ('gpkg_tiles', self.crs, self.xmin, self.ymin, self.xmax, self.ymax))
-		
-		
-		#Tile matrix of each levels
-		for level, res in enumerate(self.resolutions):
-			
-			w = math.ceil( (self.xmax - self.xmin) / (self.tileSize * res) )
-			h = math.ceil( (self.ymax - self.ymin) / (self.tileSize * res) )			
-			
-			query = """INSERT OR REPLACE INTO gpkg_tile_matrix (
-						table_name, zoom_level,
-						matrix_width, matrix_height,
-						tile_width, tile_height,
-						pixel_x_size, pixel_y_size)
-					VALUES (?, ?, ?, ?, ?, ?, ?, ?);"""  
-			db.execute(query, ('gpkg_tiles', level, w, h, self.tileSize, self.tileSize, res, res))	   
-		
-		
-		db.commit()
-		db.close()  
-		
+from .servicesDefs import sources, grids
+from .mapservice import MapService, CachePolicy, CancelToken, PROJ
+from .mapexport import MapExport
+from .metrics import metrics
 
-	def putTile(self, x, y, z, data):
-		db = sqlite3.connect(self.dbPath)
-		query = """INSERT OR REPLACE INTO gpkg_tiles 
-		(zoom_level, tile_column, tile_row, tile_data) VALUES (?,?,?,?)"""
-		db.execute(query, (z, x, y, data))
-		db.commit()
-		db.close()
-
-	def getTile(self, x, y, z):
-		#connect with detect_types parameter for automatically convert date to Python object
-		db = sqlite3.connect(self.dbPath, detect_types=sqlite3.PARSE_DECLTYPES)
-		query = 'SELECT tile_data, last_modified FROM gpkg_tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?'
-		result = db.execute(query, (z, x, y)).fetchone()
-		db.close()
-		if result is None:
-			return None
-		timeDelta = datetime.datetime.now() - result[1]
-		if timeDelta.days > self.MAX_DAYS:
-			return None
-		return result[0]
-
-
-	def getTiles(self, tiles, z): #work in progress
-		
-		n = len(tiles)
-		xs, ys = zip(*tiles)
-		
-		lst = [z] + list(xs) + list(ys)
-		
-		db = sqlite3.connect(self.dbPath, detect_types=sqlite3.PARSE_DECLTYPES)
-		query = "SELECT * FROM gpkg_tiles WHERE zoom_level = ? AND tile_column IN (" + ','.join('?'*n) + ") AND tile_row IN (" + ','.join('?'*n) + ")"
-		
-		result = db.execute(query, lst).fetchall()
-		db.close()
-		
-		print(n, len(result))
-		for r in result:
-			id, z, c, r, data, t = r
-			print(c, r)
-
-####################################
-
-class Ellps():
-	"""ellipsoid"""
-	def __init__(self, a, b):
-		self.a =  a#equatorial radius in meters
-		self.b =  b#polar radius in meters
-		self.f = (self.a-self.b)/self.a#inverse flat
-		self.perimeter = (2*math.pi*self.a)#perimeter at equator
-
-GRS80 = Ellps(6378137, 6356752.314245)
 
+####################
 
-def reproj(crs1, crs2, x1, y1):
+class TilesLRU():
 	"""
-	Reproject x1,y1 coords from crs1 to crs2 
-	Actually support only lat long (decimel degrees) <--> web mercator
-	Warning, latitudes 90° or -90° are outside web mercator bounds
+	Size bounded (in bytes) cache of decoded tiles images
+	The least recently used tiles are evicted first when the cache is full
 	"""
-	if crs1 == 4326 and crs2 == 3857:
-		long, lat = x1, y1
-		k = GRS80.perimeter/360
-		x2 = long * k
-		lat = math.log( math.tan((90 + lat) * math.pi / 360.0 )) / (math.pi / 180.0)
-		y2 = lat * k
-		return x2, y2
-	elif crs1 == 3857 and crs2 == 4326:
-		k = GRS80.perimeter/360
-		long = x1 / k
-		lat = y1 / k
-		lat = 180 / math.pi * (2 * math.atan( math.exp( lat * math.pi / 180.0)) - math.pi / 2.0)
-		return long, lat
-	else:
-		#need an external lib (pyproj or gdal osr) to support others crs
-		if not PROJ:
-			raise NotImplementedError
-		else: #gdal osr
-			prj1 = osr.SpatialReference()
-			prj1.ImportFromEPSG(crs1)
-
-			prj2 = osr.SpatialReference()
-			prj2.ImportFromEPSG(crs2)
-
-			transfo = osr.CoordinateTransformation(prj1, prj2)
-			x2, y2, z2 = transfo.TransformPoint(x1, y1)
-			return x2, y2
-
-
-####################################
-
-class TileMatrix():
-	
-	defaultNbLevels = 24
-	
-	def __init__(self, gridDef):
-
-		#create class attributes from grid dictionnary
-		for k, v in gridDef.items():
-			setattr(self, k, v)
-		
-		#Convert bbox to grid crs is needed
-		if self.bboxCRS != self.CRS:
-			lonMin, latMin, lonMax, latMax = self.bbox
-			self.xmin, self.ymax = self.geoToProj(lonMin, latMax)
-			self.xmax, self.ymin = self.geoToProj(lonMax, latMin)
-		else:
-			self.xmin, self.xmax = self.bbox[0], self.bbox[2]
-			self.ymin, self.ymax = self.bbox[1], self.bbox[3]
-
-		#Get initial resolution
-		if getattr(self, 'resolutions', None) is not None:
-			pass
-		else:
-			if getattr(self, 'initRes', None) is not None:
-				pass
-			else:
-				# at zoom level zero, 1 tile covers whole bounding box
-				dx = abs(self.xmax - self.xmin)
-				dy = abs(self.ymax - self.ymin)
-				dst = max(dx, dy)
-				self.initRes = dst / self.tileSize
-
-		#
-		if getattr(self, 'resolutions', None) is not None:
-			self.nbLevels = len(self.resolutions)
-		elif getattr(self, 'nbLevels', None) is not None:
-			pass
-		else:
-			self.nbLevels = self.defaultNbLevels
-
-		
-		# Define tile matrix origin
-		if self.originLoc == "NW":
-			self.originx, self.originy = self.xmin, self.ymax
-		elif self.originLoc == "SW":
-			self.originx, self.originy = self.xmin, self.ymin
-		else:
-			raise NotImplementedError
-	
-	@property
-	def globalbbox(self):
-		return self.xmin, self.ymin, self.xmax, self.ymax
-
-
-	def geoToProj(self, long, lat):
-		"""convert longitude latitude un decimal degrees to grid crs"""
-		if self.CRS == 4326:
-			return long, lat
-		else:
-			return reproj(4326, self.CRS, long, lat)
-
-	def projToGeo(self, x, y):
-		"""convert grid crs coords to longitude latitude in decimal degrees"""
-		if self.CRS == 4326:
-			return x, y
-		else:
-			return reproj(self.CRS, 4326, x, y)
-
-
-	def getResList(self):
-		if getattr(self, 'resolutions', None) is not None:
-			return self.resolutions
-		else:
-			return [self.initRes / self.resFactor**zoom for zoom in range(self.nbLevels)]
-
-	def getRes(self, zoom):
-		"""Resolution (meters/pixel) for given zoom level (measured at Equator)"""
-		if getattr(self, 'resolutions', None) is not None:
-			if zoom > len(self.resolutions):
-				zoom = len(self.resolutions)
-			return self.resolutions[zoom]
-		else:
-			return self.initRes / self.resFactor**zoom
-
-
-	def getTileNumber(self, x, y, zoom):
-		"""Convert projeted coords to tiles number"""
-		res = self.getRes(zoom)
-		geoTileSize = self.tileSize * res
-		dx = x - self.originx
-		if self.originLoc == "NW":
-			dy = self.originy - y
-		else:
-			dy = y - self.originy
-		col = dx / geoTileSize
-		row = dy / geoTileSize
-		col = int(math.floor(col))
-		row = int(math.floor(row))
-		return col, row
-
-	def getTileCoords(self, col, row, zoom):
-		"""
-		Convert tiles number to projeted coords
-		(top left pixel if matrix origin is NW)
-		"""
-		res = self.getRes(zoom)
-		geoTileSize = self.tileSize * res
-		x = self.originx + (col * geoTileSize)
-		if self.originLoc == "NW":
-			y = self.originy - (row * geoTileSize)
-		else:
-			y = self.originy + (row * geoTileSize) #bottom left
-			y += geoTileSize #top left
-		return x, y
-	
-
-###################"
-
-class MapService():
-	"""
-	Represent a tile service from source
-	""" 
-	
-	def __init__(self, srcKey, cacheFolder):
-		
-
-		#create class attributes from source dictionnary
-		self.srcKey = srcKey
-		source = sources[self.srcKey]
-		for k, v in source.items():
-			setattr(self, k, v)
-
-		#Build objects from layers definitions
-		class Layer(): pass
-		layersObj = {}
-		for layKey, layDict in self.layers.items(): 
-			lay = Layer()
-			for k, v in layDict.items():
-				setattr(lay, k, v)
-			layersObj[layKey] = lay
-		self.layers = layersObj
-	
-		#Build source tile matrix
-		self.tm1 = TileMatrix(grids[self.grid])
-		
-		#Build destination tile matrix (NOT YET IMPLEMENTED)
-		if getattr(self, 'dstGrid', None) is not None:
-			self.tm2 = TileMatrix(grids[self.tm2])
-		else:
-			self.tm2 = self.tm1
-
-		#Init cache dict
-		self.cacheFolder = cacheFolder
-		self.caches = {}
-
-
-	def getCache(self, layKey):
-		'''Return existing cache for requested layer or built it if not exists'''
-		cache = self.caches.get(layKey)
-		if cache is None:			
-			mapKey = self.srcKey + '_' + layKey
-			dbPath = self.cacheFolder + mapKey+ ".gpkg"
-			self.caches[layKey] = GeoPackage(dbPath, self.tm2)
-			return self.caches[layKey]
-		else:
-			return cache
-
-
-
-	def buildUrl(self, layKey, col, row, zoom):
-		"""
-		Receive tiles coords coords in destination tile matrix space
-		convert to source tile matrix space and build request url
-		"""
-		url = self.urlTemplate
-		lay = self.layers[layKey]
-		
-		if self.service == 'TMS':
-			url = url.replace("{LAY}", lay.urlKey)
-			if not self.quadTree:
-				url = url.replace("{X}", str(col))
-				url = url.replace("{Y}", str(row))
-				url = url.replace("{Z}", str(zoom))
-			else:
-				quadkey = self.getQuadKey(col, row, zoom)
-				url = url.replace("{QUADKEY}", quadkey) 
-			
-		if self.service == 'WMTS':
-			url = self.urlTemplate['BASE_URL']
-			if url[-1] != '?' :
-				url += '?'
-			params = ['='.join([k,v]) for k, v in self.urlTemplate.items() if k != 'BASE_URL']
-			url += '&'.join(params)
-			url = url.replace("{LAY}", lay.urlKey)
-			url = url.replace("{FORMAT}", lay.format)
-			url = url.replace("{STYLE}", lay.style)
-			url = url.replace("{MATRIX}", self.matrix)  
-			url = url.replace("{X}", str(col))
-			url = url.replace("{Y}", str(row))
-			url = url.replace("{Z}", str(zoom))
-			
-		if self.service == 'WMS':
-			url = self.urlTemplate['BASE_URL']
-			if url[-1] != '?' :
-				url += '?'  
-			params = ['='.join([k,v]) for k, v in self.urlTemplate.items() if k != 'BASE_URL']
-			url += '&'.join(params)
-			url = url.replace("{LAY}", lay.urlKey)
-			url = url.replace("{FORMAT}", lay.format)
-			url = url.replace("{STYLE}", lay.style)
-			url = url.replace("{CRS}", str(self.tm1.CRS))
-			url = url.replace("{WIDTH}", str(self.tileSize))
-			url = url.replace("{HEIGHT}", str(self.tileSize))
-			
-			xmin, ymax = self.tm1.getTileCoords(col, row, zoom)
-			xmax = xmin + self.tm1.tileSize * self.tm1.getRes(zoom)
-			ymin = ymax - self.tm1.tileSize * self.tm1.getRes(zoom)
-			if self.urlTemplate['VERSION'] == '1.3.0' and self.tm1.CRS == 4326:
-				bbox = ','.join(map(str,[ymin,xmin,ymax,xmax]))
-			else:
-				bbox = ','.join(map(str,[xmin,ymin,xmax,ymax]))
-			url = url.replace("{BBOX}", bbox)
-													
-		return url
-
-
-	def getQuadKey(self, x, y, z):
-		"Converts TMS tile coordinates to Microsoft QuadTree"
-		quadKey = ""
-		for i in range(z, 0, -1):
-			digit = 0
-			mask = 1 << (i-1)
-			if (x & mask) != 0:
-				digit += 1
-			if (y & mask) != 0:
-				digit += 2
-			quadKey += str(digit)
-		return quadKey
-
-
-	def getTile(self, layKey, col, row, zoom):
-		"""
-		Return bytes data of requested tile
-		Tile is downloaded from map service or directly pick up from cache database.
-		"""
-
-		cache = self.getCache(layKey)
-	
-		#don't try to get tiles out of map bounds
-		x,y = self.tm2.getTileCoords(col, row, zoom) #top left
-		if row < 0 or col < 0:
-			return None
-		elif not self.tm2.xmin <= x < self.tm2.xmax or not self.tm2.ymin < y <= self.tm2.ymax:
-			return None
-				
-		#check if tile already exists in cache
-		data = cache.getTile(col, row, zoom)
-		
-		#if so check if its a valid image
-		if data is not None:
-			format = imghdr.what(None, data)
-			if format is None:#corrupted
-				data = None
-			
-		#if not or corrupted try to download it from map service			
-		if data is None:
-		
-			url = self.buildUrl(layKey, col, row, zoom)
-			#print(url)
-			
-			try:
-				#make request
-				req = urllib.request.Request(url, None, self.headers)
-				handle = urllib.request.urlopen(req, timeout=3)
-				#open image stream
-				data = handle.read()
-				handle.close()
-			except:
-				print("Can't download tile x"+str(col)+" y"+str(row))
-				print(url)
-				data = None
-		
-			#Make sure the stream is correct and put in db
-			if data is not None:
-				format = imghdr.what(None, data)
-				if format is None:
-					data = None
-				else:
-					cache.putTile(col, row, self.zoom, data)
-		
-		return data
 
+	def __init__(self, maxSize):
+		self.maxSize = maxSize
+		self.size = 0
+		self._tiles = collections.OrderedDict() #{key: (img, nbBytes)}, most recently used at the end
+		self._lock = threading.Lock()
+		self.hits, self.misses, self.evictions = 0, 0, 0
+
+	def get(self, key):
+		'''Return the cached image or None'''
+		with self._lock:
+			item = self._tiles.get(key)
+			if item is None:
+				self.misses += 1
+				return None
+			self.hits += 1
+			self._tiles.move_to_end(key)
+			return item[0]
+
+	def put(self, key, img):
+		nbBytes = img.width * img.height * len(img.getbands())
+		if nbBytes > self.maxSize:
+			return
+		with self._lock:
+			old = self._tiles.pop(key, None)
+			if old is not None:
+				self.size -= old[1]
+			self._tiles[key] = (img, nbBytes)
+			self.size += nbBytes
+			while self.size > self.maxSize:
+				k, (i, n) = self._tiles.popitem(last=False)
+				self.size -= n
+				self.evictions += 1
+
+	def clear(self):
+		with self._lock:
+			self._tiles.clear()
+			self.size = 0
+
+	def __len__(self):
+		return len(self._tiles)
+
+	def stats(self):
+		return {'tiles':len(self), 'bytes':self.size, 'hits':self.hits, 'misses':self.misses, 'evictions':self.evictions}
+
+
+#Decoded tiles shared by all maps, keys are (srcKey, layKey, zoom, col, row)
+decodedTiles = TilesLRU(maxSize=256*1024**2)
 
-	def listTiles(self, bbox, zoom):
-		
-		xmin, ymin, xmax, ymax = bbox
-				
-		#Get first tile indices (tiles matrix origin is top left)
-		firstCol, firstRow = self.tm1.getTileNumber(xmin, ymax, zoom)
-		
-		#Total number of tiles required
-		nbTilesX = math.ceil( (xmax - xmin) / (self.tm1.tileSize * self.tm1.getRes(zoom)) )
-		nbTilesY = math.ceil( (ymax - ymin) / (self.tm1.tileSize * self.tm1.getRes(zoom)) )
-			
-		#Add more tiles because background image will be offseted 
-		# and could be to small to cover all area
-		nbTilesX += 1
-		nbTilesY += 1
-
-		#Build list of required column and row numbers
-		cols = [firstCol+i for i in range(nbTilesX)]
-		if self.tm1.originLoc == "NW":
-			rows = [firstRow+i for i in range(nbTilesY)]
-		else:
-			rows = [firstRow-i for i in range(nbTilesY)]
-
-		return cols, rows
 
+####################
 
-	def getTiles(self, layKey, tiles, z): #test
-		cache = self.getCache(layKey)
-		cache.getTiles(tiles, z)
+class MapRequest():
+	"""Parameters of a map update shared by its jobs, with the generation number and cancel token of the request"""
 
+	def __init__(self, gen, token, zoom, col1, row1):
+		self.gen = gen
+		self.token = token
+		self.zoom = zoom
+		self.col1, self.row1 = col1, row1 #top left tile of the mosaic
+		self.decoded = {} #{(col, row): PIL image} tiles found in memory
+		self.cached = {} #{(col, row): data} tiles found in cache
+		self.provisional = {} #{(col, row): PIL image} tiles temporarily built from others zoom levels
 
-####################
 
 class MapImage(MapService):
 	
 	"""Handle a map as background image in Blender"""
+
+	PREFETCH_RING = 1 #width, in tiles, of the ring around the view prefetched in cache
+	PREFETCH_BUDGET = 32 * 1024**2 #max bytes downloaded by prefetching during a session
+	FILL_LEVELS = 4 #number of lower zoom levels searched for a cached ancestor to fill tiles being downloaded
+	MOUSE_RADIUS = 1 #tiles within this distance, in tiles, of the mouse cursor are loaded first
 	
 	def __init__(self, context):
 
@@ -674,13 +138,15 @@ class MapImage(MapService):
 		folder = self.scn.cacheFolder
 		mapKey = self.scn.mapSource
 		self.srcKey, self.layKey = mapKey.split(':')
+		dstGrid = self.scn.mapGrid if self.scn.mapGrid != 'SOURCE' else None
 
 		#Paths
 		# Tiles mosaic used as background image in Blender
-		self.imgPath = folder + self.srcKey + '_' + self.layKey + ".png"
+		self.imgName = self.srcKey + '_' + self.layKey
+		self.imgPath = folder + self.imgName + ".png"
 		
 		#Init parent MapService class
-		super().__init__(self.srcKey, folder)
+		super().__init__(self.srcKey, folder, dstGrid)
 	
 		#Get layer def obj
 		self.layer = self.layers[self.layKey]
@@ -706,27 +172,33 @@ class MapImage(MapService):
 		#Read scene props
 		self.update()
 
-		#Fake browser header
-		self.headers = {
-			'Accept' : 'image/png,image/*;q=0.8,*/*;q=0.5' ,
-			'Accept-Charset' : 'ISO-8859-1,utf-8;q=0.7,*;q=0.7' ,
-			'Accept-Encoding' : 'gzip,deflate' ,
-			'Accept-Language' : 'fr,en-us,en;q=0.5' ,
-			'Keep-Alive': 115 ,
-			'Proxy-Connection' : 'keep-alive' ,
-			'User-Agent' : 'Mozilla/5.0 (Windows; U; Windows NT 5.1; fr; rv:1.9.2.13) Gecko/20101003 Firefox/12.0',
-			'Referer' : self.referer}
-
 		#Thread attributes
-		self.running = False
 		self.thread = None
+		self.generation = 0 #incremented on each new request, results of older requests are discarded
+		self.token = CancelToken() #cancel token of the running request
+		self.futures = [] #jobs submitted to the pool
+		self.lock = threading.Lock() #protect mosaic and image from concurrent updates
+		self.nbTiles, self.cptTiles = 0, 0
+		self.mouse = None #mouse cursor coords in crs, updated by the modal operator
+		#Prefetch attributes
+		self.prefetchFutures = []
+		self.prefetchToken = CancelToken()
+		self.prefetchBytes = 0 #bytes downloaded by prefetch during this session
+		self.prefetchLock = threading.Lock() #prefetch jobs run concurrently in the pool threads
 		#Background image attributes
 		self.img = None #bpy image
+		self.imgData = None #(generation, data) mosaic converted by the loading thread, waiting to be copied in the bpy image
+		self.pngGen = None #generation of the mosaic last written as png in imgPath
+		#pixels of a generated image can be written from a numpy array since Blender 2.83,
+		#older versions load the mosaic from a png file
+		self.fastPixels = bpy.app.version >= (2, 83, 0)
 		self.bkg = None #bpy background
 		self.img_w, self.img_h = None, None #width, height
 		self.img_ox, self.img_oy = None, None #image origin
-		#Store list of previous tile number requested
-		self.previousCols, self.previousRows = None, None
+		#Mosaic kept between requests, with its zoom, top left tile and the set of tiles successfully pasted
+		self.mosaic = None
+		self.mosaicZoom, self.mosaicCol1, self.mosaicRow1 = None, None, None
+		self.mosaicTiles = set()
 
 
 	#fast access to some properties of destination grid
@@ -740,6 +212,13 @@ class MapImage(MapService):
 	@property
 	def tileSize(self):
 		return self.tm.tileSize
+	@property
+	def zmin(self):
+		return self.layer.zmin if self.tm2 is self.tm1 else 0
+	@property
+	def zmax(self):
+		'''Max zoom level, reprojected tiles are available at all levels of destination grid'''
+		return self.layer.zmax if self.tm2 is self.tm1 else len(self.tm2.getResList()) - 1
 
 
 
@@ -749,6 +228,7 @@ class MapImage(MapService):
 		self.zoom = self.scn['z']
 		self.scale = self.scn['scale']
 		self.lat, self.long = self.scn['lat'], self.scn['long']
+		self.saveImg = self.scn.mapSaveImg
 
 		#scene origin coords in projeted system
 		self.origin_x, self.origin_y = self.tm.geoToProj(self.long, self.lat)
@@ -758,63 +238,273 @@ class MapImage(MapService):
 	def get(self):
 		'''Launch run() function in a new thread'''
 		self.stop()
-		self.running = True
-		self.thread = threading.Thread(target=self.run_multi)
+		self.cancelPrefetch()
+		#scene props are read here, bpy must not be accessed from the loading thread
+		with self.lock:
+			self.update()
+		self.token = CancelToken()
+		self.thread = threading.Thread(target=self.run_multi, args=(self.generation, self.token))
 		self.thread.start()
 
 
 	def stop(self):
-		'''Stop actual thread'''
-		if self.running:
-			self.running = False
-			self.thread.join()
+		'''
+		Cancel actual request and return immediately, without waiting for its thread
+		Downloads in progress are aborted and results that still come back are discarded
+		'''
+		#under the lock, a running request checks the generation and queues its jobs atomically
+		with self.lock:
+			self.generation += 1
+			self.token.cancel()
+			#drop jobs still waiting in the pool queue
+			for future in self.futures:
+				future.cancel()
 
 
 
-	def run_multi(self):
+	def run_multi(self, gen, token):
 		'''Main process, launch multiple thread to retreive tiles and build mosaic'''
 
-		self.update()
-		
-		self.request()
-		
-		#List all tiles	
-		tiles = [ (c, r) for c in self.cols for r in self.rows]
-		
-		#test
-		#self.getTiles(self.layKey, tiles, self.zoom)
-		
-		#Create PIL image in memory
-		self.mosaic = Image.new("RGBA", (self.img_w , self.img_h), None)
-
-		#reinit cpt progress
-		self.nbTiles = len(self.cols) * len(self.rows)
-		self.cptTiles = 0	
-			
-		#Launch threads
-		nbThread = 4
-		n = len(tiles)
-		q = math.ceil(n/nbThread)
-		parts = [tiles[i:i+q] for i in range(0, n, q)]
-		threads = []
-		for part in parts:
-			t = threading.Thread(target=self.load, args=(part,))
-			threads.append(t)
-			t.start()
-
-		# Wait for all threads to complete
-		for t in threads:
-			t.join()
-	
-		if self.running:
-			#save image
-			self.mosaic.save(self.imgPath)			
-			#Place background image
-			self.place()
+		with self.lock:
+			#a newer request has been made before this thread starts
+			if gen != self.generation:
+				return
+
+			self.request()
+
+			#List all tiles
+			tiles = [ (c, r) for c in self.cols for r in self.rows]
+
+			#Reuse previous mosaic if it has the same zoom level and size
+			changed = True
+			if self.mosaic is not None and self.mosaicZoom == self.zoom and self.mosaic.size == (self.img_w, self.img_h):
+				#shift it according to the new top left tile
+				sign = 1 if self.tm.originLoc == "NW" else -1
+				dx = (self.mosaicCol1 - self.col1) * self.tileSize
+				dy = (self.mosaicRow1 - self.row1) * sign * self.tileSize
+				if dx != 0 or dy != 0:
+					mosaic = Image.new("RGBA", (self.img_w , self.img_h), None)
+					mosaic.paste(self.mosaic, (dx, dy))
+					self.mosaic = mosaic
+				#keep tiles still in view, only the newly exposed ones need to be loaded
+				required = set(tiles)
+				self.mosaicTiles = set(tile for tile in self.mosaicTiles if tile in required)
+				#Nothing to do if the mosaic is unchanged and complete
+				if dx == 0 and dy == 0 and len(self.mosaicTiles) == len(tiles):
+					changed = False
+			else:
+				#Create PIL image in memory
+				self.mosaic = Image.new("RGBA", (self.img_w , self.img_h), None)
+				self.mosaicTiles = set()
+			self.mosaicZoom, self.mosaicCol1, self.mosaicRow1 = self.zoom, self.col1, self.row1
+
+			if not changed:
+				return
+
+			tiles = [tile for tile in tiles if tile not in self.mosaicTiles]
+			#Parameters of this request, jobs must not read attributes that could be changed by a newer request
+			req = MapRequest(gen, token, self.zoom, self.col1, self.row1)
+
+		#Get tiles already decoded in memory
+		for col, row in tiles:
+			img = decodedTiles.get((self.srcKey, self.layKey, self.dstGrid, req.zoom, col, row))
+			if img is not None:
+				req.decoded[(col, row)] = img
+		metrics.count(self.srcKey, 'memoryHits', len(req.decoded))
+
+		#Get others cached tiles with a single query, only the misses will be downloaded
+		missing = [tile for tile in tiles if tile not in req.decoded]
+		req.cached = self.getTiles(self.layKey, missing, req.zoom)
+
+		#Fill the tiles to download with images built from cached tiles of others zoom levels,
+		#and show them immediately, they will be replaced as downloads complete
+		downloads = [tile for tile in missing if tile not in req.cached]
+		if downloads:
+			req.provisional = self.getProvisional(downloads, req.zoom)
+		if req.provisional:
+			with self.lock:
+				if gen != self.generation:
+					return
+				for (col, row), img in req.provisional.items():
+					posx = (col - req.col1) * self.tileSize
+					posy = abs((row - req.row1)) * self.tileSize
+					self.mosaic.paste(img, (posx, posy))
+			#bpy is not thread safe, the image will be updated by the operator timer
+			self.prepareImage(gen)
+
+		with self.lock:
+			if gen != self.generation:
+				return
+			#reinit cpt progress
+			self.nbTiles = len(tiles)
+			self.cptTiles = 0
+			#Queue a job per tile in the threads pool, from the view center outwards
+			self.futures = [self.pool.submit(self.load, col, row, req, priority=priority)
+				for priority, (col, row) in self.sortTiles(tiles, req.zoom)]
+			futures = self.futures
+
+		# Wait for all jobs to complete or to be cancelled
+		concurrent.futures.wait(futures)
+
+		with self.lock:
+			if gen != self.generation:
+				return
+			#Use idle time to warm the cache around the view
+			self.prefetch()
+			#reinit cpt progress
+			self.nbTiles, self.cptTiles = 0, 0
+
+		#Update bpy image and place it as background on next operator timer event,
+		#the complete map is also written as png so it can be kept with the blend file
+		self.prepareImage(gen, png=True)
+
+
+
+	def sortTiles(self, tiles, zoom):
+		'''
+		Return a list of (priority, (col, row)) ordered by distance from the view center (spiral order),
+		tiles close to the mouse cursor get a lower priority value so they are loaded before the others
+		'''
+		size = self.tileSize * self.tm.getRes(zoom)
+		def tilePos(x, y):
+			#fractional tile number of a point
+			if self.tm.originLoc == "NW":
+				return (x - self.tm.originx) / size, (self.tm.originy - y) / size
+			else:
+				return (x - self.tm.originx) / size, (y - self.tm.originy) / size
+		cx, cy = tilePos(self.origin_x, self.origin_y)
+		def spiral(tile):
+			dx, dy = tile[0] + 0.5 - cx, tile[1] + 0.5 - cy
+			return dx*dx + dy*dy, math.atan2(dy, dx)
+		tiles = sorted(tiles, key=spiral)
+		if self.mouse is None:
+			return [(0, tile) for tile in tiles]
+		mx, my = tilePos(*self.mouse)
+		r = self.MOUSE_RADIUS + 0.5
+		return [(-1 if abs(col + 0.5 - mx) <= r and abs(row + 0.5 - my) <= r else 0, (col, row)) for col, row in tiles]
+
+
+	def getImages(self, tiles, zoom):
+		'''Return {(col, row): PIL image} of the tiles available in memory or in cache, without downloading'''
+		images = {}
+		for col, row in tiles:
+			img = decodedTiles.get((self.srcKey, self.layKey, self.dstGrid, zoom, col, row))
+			if img is not None:
+				images[(col, row)] = img
+		missing = [tile for tile in tiles if tile not in images]
+		if missing:
+			for (col, row), (data, t, format) in self.getCache(self.layKey).getTiles(missing, zoom).items():
+				try:
+					img = Image.open(io.BytesIO(data))
+					img.load()
+				except:
+					continue
+				decodedTiles.put((self.srcKey, self.layKey, self.dstGrid, zoom, col, row), img)
+				images[(col, row)] = img
+		return images
+
+
+	def getProvisional(self, tiles, zoom):
+		'''
+		Return {(col, row): PIL image} provisional images of tiles that must be downloaded, built from
+		cached children tiles (downscaled and assembled) or from a cached ancestor (cropped and upscaled)
+		'''
+		#only quadtree tile matrix, each tile is divided in 4 tiles at next zoom level
+		if getattr(self.tm, 'resolutions', None) is not None or self.tm.resFactor != 2:
+			return {}
+		ts = self.tileSize
+		#in a SW tile matrix, rows go up so the first half row of a tile is the bottom one
+		flip = self.tm.originLoc != "NW"
+		provisional = {}
+
+		#Children tiles at next zoom level
+		if zoom + 1 <= self.zmax:
+			children = [(2*col + i, 2*row + j) for col, row in tiles for i in (0, 1) for j in (0, 1)]
+			images = self.getImages(children, zoom + 1)
+			half = ts // 2
+			for col, row in tiles:
+				parts = [(i, j) for i in (0, 1) for j in (0, 1) if (2*col + i, 2*row + j) in images]
+				if not parts:
+					continue
+				img = Image.new("RGBA", (ts, ts), "white")
+				for i, j in parts:
+					child = images[(2*col + i, 2*row + j)].resize((half, half), Image.BILINEAR)
+					img.paste(child, (i * half, (1 - j if flip else j) * half))
+				provisional[(col, row)] = img
+
+		#Ancestor tiles at previous zoom levels, the closest first
+		remaining = [tile for tile in tiles if tile not in provisional]
+		for dz in range(1, self.FILL_LEVELS + 1):
+			if not remaining or zoom - dz < self.zmin:
+				break
+			images = self.getImages(set((col >> dz, row >> dz) for col, row in remaining), zoom - dz)
+			sub = 2**dz #number of tiles per ancestor side
+			for col, row in remaining:
+				parent = images.get((col >> dz, row >> dz))
+				if parent is None:
+					continue
+				i, j = col % sub, row % sub
+				if flip:
+					j = sub - 1 - j
+				box = (i * ts // sub, j * ts // sub, (i + 1) * ts // sub, (j + 1) * ts // sub)
+				provisional[(col, row)] = parent.crop(box).resize((ts, ts), Image.BILINEAR)
+			remaining = [tile for tile in remaining if tile not in provisional]
+
+		return provisional
+
+
+	def prefetch(self):
+		'''
+		Queue low priority jobs to download in cache the tiles surrounding the view
+		and the tiles covering the view at previous and next zoom levels
+		Must be called with the lock held, after checking the request is still the current one
+		'''
+		if self.prefetchBytes >= self.PREFETCH_BUDGET:
+			return
+		token = self.prefetchToken = CancelToken()
+		jobs = [] #(priority, zoom, tiles)
+
+		#Ring of tiles around the current view
+		r = self.PREFETCH_RING
+		cols = range(min(self.cols) - r, max(self.cols) + r + 1)
+		rows = range(min(self.rows) - r, max(self.rows) + r + 1)
+		view = set((c, r) for c in self.cols for r in self.rows)
+		jobs.append( (1, self.zoom, [(c, r) for c in cols for r in rows if (c, r) not in view]) )
+
+		#Parent and children tiles at zoom level -1 and +1
+		for priority, z in [(2, self.zoom - 1), (3, self.zoom + 1)]:
+			if self.zmin <= z <= self.zmax:
+				cols, rows = self.listTiles(self.bbox, z)
+				jobs.append( (priority, z, [(c, r) for c in cols for r in rows]) )
+
+		cache = self.getCache(self.layKey)
+		for priority, z, tiles in jobs:
+			#skip tiles already in cache
+			cached = cache.hasTiles(tiles, z)
+			for col, row in tiles:
+				if (col, row) not in cached:
+					f = self.pool.submit(self.prefetchTile, col, row, z, token, priority=priority)
+					self.prefetchFutures.append(f)
+
+
+	def prefetchTile(self, col, row, zoom, token):
+		'''Prefetch job, download a tile in cache unless prefetching has been cancelled'''
+		if token.cancelled or self.prefetchBytes >= self.PREFETCH_BUDGET:
+			return
+		data, partial = self.downloadTile(self.layKey, col, row, zoom, token)
+		if data is not None:
+			with self.prefetchLock:
+				self.prefetchBytes += len(data)
 
-		#reinit cpt progress
-		self.nbTiles, self.cptTiles = 0, 0
 
+	def cancelPrefetch(self):
+		'''Drop queued prefetch jobs and abort the running downloads'''
+		#prefetch() is called under the lock by the request thread, so it can't start a new prefetch concurrently
+		with self.lock:
+			self.prefetchToken.cancel()
+			for future in self.prefetchFutures:
+				future.cancel()
+			self.prefetchFutures = []
 
 
 	def progress(self):
@@ -824,9 +514,9 @@ class MapImage(MapService):
 
 
 	def view3dToProj(self, dx, dy):
-		'''Convert view3d coords to crs coords'''
-		x = self.origin_x + dx
-		y = self.origin_y + dy  
+		'''Convert view3d coords to crs coords, view3d units are crs units divided by the map scale'''
+		x = self.origin_x + dx * self.scale
+		y = self.origin_y + dy * self.scale
 		return x, y
 
 	def moveOrigin(self, dx, dy):
@@ -874,6 +564,7 @@ class MapImage(MapService):
 		"""
 
 		#Get list of required tiles to cover area
+		self.bbox = bbox
 		self.cols, self.rows = self.listTiles(bbox, self.zoom)
 		
 		#Keep first tile (top left) indices
@@ -888,56 +579,173 @@ class MapImage(MapService):
 		self.img_ox = img_xmin + self.img_w/2 * self.res
 		self.img_oy = img_ymax - self.img_h/2 * self.res
 
-			
-		#Stop thread if the request is same as previous
-		if self.previousCols == self.cols and self.previousRows == self.rows:
-			self.running = False
-		else:
-			self.previousCols = self.cols
-			self.previousRows = self.rows
-
 
 
 
-	def load(self, tiles):
-		'''Get tiles and paste them in mosaic'''
+	def load(self, col, row, req):
+		'''Get a tile and paste it in mosaic'''
 		
-		for tile in tiles:
-			
-			#cancel thread if requested
-			if not self.running:
-				return			
-			
-			#unpack col and row indices
-			col, row = tile
-				
-			#Get image bytes data
-			data = self.getTile(self.layKey, col, row, self.zoom)
+		#cancel job if requested
+		if req.token.cancelled:
+			return
+
+		img = req.decoded.get((col, row))
+		#partially reprojected tiles are shown like provisional ones, but not kept
+		partial = False
+		if img is None:
+			#Get image bytes data from cache or download it
+			data = req.cached.get((col, row))
+			if data is None:
+				#raise a CancelledError if the request is cancelled during the download
+				data, partial = self.downloadTile(self.layKey, col, row, req.zoom, req.token)
+			t0 = time.perf_counter()
 			try:
-				#open with PIL
+				#open with PIL and decode now, before sharing it with others threads
 				img = Image.open(io.BytesIO(data))
+				img.load()
+				metrics.add('decode', time.perf_counter() - t0)
 			except:
 				#create an empty tile if we are unable to get a valid stream
-				img = Image.new("RGBA", (self.tileSize , self.tileSize), "white")
-		
-			#Paste tile into mosaic image
-			posx = (col - self.col1) * self.tileSize
-			posy = abs((row - self.row1)) * self.tileSize		
-			self.mosaic.paste(img, (posx, posy))
-			
+				img = None
+			else:
+				if not partial:
+					decodedTiles.put((self.srcKey, self.layKey, self.dstGrid, req.zoom, col, row), img)
+
+		if img is None and (col, row) in req.provisional:
+			#keep the provisional image, the tile will be requested again on next update
+			tile = None
+		elif img is None:
+			#paste an empty tile, it will be requested again on next update
+			#known missing tiles are painted in grey instead of white
+			if self.getCache(self.layKey).isMissing(col, row, req.zoom):
+				color = "lightgrey"
+			else:
+				color = "white"
+			tile = Image.new("RGBA", (self.tileSize , self.tileSize), color)
+		else:
+			tile = img
+
+		#Paste tile into mosaic image
+		posx = (col - req.col1) * self.tileSize
+		posy = abs((row - req.row1)) * self.tileSize
+		with self.lock:
+			#the mosaic could have been shifted by a newer request
+			if req.gen != self.generation:
+				return
+			if tile is not None:
+				with metrics.timer('paste'):
+					self.mosaic.paste(tile, (posx, posy))
+			#a partial tile will be requested again on next update, when missing source tiles could be available
+			if img is not None and not partial:
+				self.mosaicTiles.add((col, row))
 			self.cptTiles += 1
 
 
 		
 
+	def prepareImage(self, gen, png=False):
+		'''
+		Convert the mosaic to what will be copied in the bpy image, in the loading thread
+		so the operator timer only has to hand it to Blender : a flat array of pixels or a png file
+		png forces writing the png file, even if pixels are copied from the array
+		'''
+		with self.lock:
+			if gen != self.generation:
+				return
+			mosaic = self.mosaic.copy()
+			toFile = self.saveImg or not self.fastPixels
+		t0 = time.perf_counter()
+		px = None
+		if not toFile:
+			#bpy pixels are flat rgba floats, starting from bottom left
+			px = np.asarray(mosaic, dtype=np.uint8)[::-1].astype(np.float32).ravel()
+			px /= 255
+		if toFile or png:
+			#write and rename, Blender never reads a partially written file
+			tmpPath = self.imgPath + '.tmp'
+			mosaic.save(tmpPath, 'PNG')
+			os.replace(tmpPath, self.imgPath)
+		metrics.add('convert', time.perf_counter() - t0)
+		with self.lock:
+			if gen != self.generation:
+				return
+			self.imgData = (gen, px)
+			if toFile or png:
+				#only the png of a complete map can be kept as is when the viewer ends
+				self.pngGen = gen if png else None
+
+
+	def refresh(self):
+		'''
+		Copy the mosaic prepared by the loading thread into the bpy image and place it, if it changed since last call
+		Must be called from Blender main thread
+		'''
+		with self.lock:
+			imgData, self.imgData = self.imgData, None
+			if imgData is None or imgData[0] != self.generation:
+				return False
+			self.updateImage(imgData[1])
+			self.place()
+		return True
+
+
+	def updateImage(self, px=None):
+		'''
+		Copy the mosaic into the bpy image used as background
+		px is the flat array of pixels prepared by the loading thread, if None the png file written by the thread is loaded
+		'''
+		t0 = time.perf_counter()
+
+		if px is not None:
+			#write directly the mosaic in the pixels buffer of a generated image
+			try:
+				img = bpy.data.images[self.imgName]
+			except KeyError:
+				img = bpy.data.images.new(self.imgName, self.img_w, self.img_h, alpha=True)
+			if tuple(img.size) != (self.img_w, self.img_h):
+				img.scale(self.img_w, self.img_h)
+			img.pixels.foreach_set(px)
+			img.update()
+			self.img = img
+
+		else:
+			#load or reload the png from disk
+			try:
+				self.img = [img for img in bpy.data.images if img.filepath == self.imgPath][0]
+			except:
+				self.img = bpy.data.images.load(self.imgPath)
+			else:
+				self.img.reload()
+
+		metrics.add('save', time.perf_counter() - t0)
+
+
+	def saveImage(self):
+		'''
+		Write the map as png file in cache folder and use it as background image,
+		pixels of a generated image are not saved with the blend file
+		'''
+		with self.lock:
+			if self.mosaic is None or self.img is None or self.img.source != 'GENERATED':
+				return
+			generated = self.img
+			self.saveImg = True
+			if self.pngGen != self.generation or self.imgData is not None:
+				#the map viewer ends before the png of the last map has been written by the loading thread
+				self.mosaic.save(self.imgPath)
+			self.updateImage()
+			if self.bkg is not None:
+				self.bkg.image = self.img
+			if generated.users == 0:
+				bpy.data.images.remove(generated)
+
+
 	def place(self):
 		'''Set map as background image'''
-				
-		#Get or load bpy image
-		try:
-			self.img = [img for img in bpy.data.images if img.filepath == self.imgPath][0]
-		except:
-			self.img = bpy.data.images.load(self.imgPath)
+
+		if self.img is None:
+			return
+		t0 = time.perf_counter()
 
 		#Activate view3d background
 		self.view3d.show_background_images = True
@@ -949,7 +757,7 @@ class MapImage(MapService):
 		#Get or load background image
 		bkgs = [bkg for bkg in self.view3d.background_images if bkg.image is not None]
 		try:
-			self.bkg = [bkg for bkg in bkgs if bkg.image.filepath == self.imgPath][0]
+			self.bkg = [bkg for bkg in bkgs if bkg.image == self.img][0]
 		except:
 			self.bkg = self.view3d.background_images.new()
 			self.bkg.image = self.img
@@ -976,9 +784,8 @@ class MapImage(MapService):
 		dst = dst * self.res / self.scale
 		dst /= 2
 		self.reg3d.view_distance = dst
-		
-		#Update image drawing   
-		self.bkg.image.reload()
+
+		metrics.add('place', time.perf_counter() - t0)
 
 
 
@@ -1031,6 +838,13 @@ def draw_callback(self, context):
 	# cursor crs coords
 	blf.position(font_id, cx-45, 10, 0)
 	blf.draw(font_id, str((int(self.posx), int(self.posy))))
+	# pipeline stats, top left corner
+	if scn.mapShowStats:
+		y = h - 20
+		for line in metrics.summary():
+			blf.position(font_id, 10, y, 0)
+			blf.draw(font_id, line)
+			y -= 15
 
 
 
@@ -1046,6 +860,14 @@ class MAP_VIEW(bpy.types.Operator):
 		
 		if context.area.type == 'VIEW_3D':
 			
+			#Get map, before setting up anything to undo if the map can't be displayed
+			try:
+				self.map = MapImage(context)
+			except ValueError as e:
+				#eg. a grid requiring GDAL to reproject the tiles
+				self.report({'ERROR'}, str(e))
+				return {'CANCELLED'}
+
 			#Add draw callback to view space
 			args = (self, context)
 			self._handle = bpy.types.SpaceView3D.draw_handler_add(draw_callback, args, 'WINDOW', 'POST_PIXEL')
@@ -1070,15 +892,10 @@ class MAP_VIEW(bpy.types.Operator):
 			# thread progress infos reported in draw callback
 			self.nb, self.nbTotal = 0, 0
 	
-			#Get map
-			self.map = MapImage(context)
-			"""
-			try:
-				self.map = MapImage(context)
-			except Exception as e:
-				self.report({'ERROR'}, str(e))
-				return {'CANCELLED'}
-			"""
+			#Start background maintenance of the caches folder
+			self.cachePolicy = CachePolicy(context.scene.cacheFolder)
+			self.cachePolicy.start()
+
 			self.map.get()
 			
 			return {'RUNNING_MODAL'}
@@ -1105,6 +922,8 @@ class MAP_VIEW(bpy.types.Operator):
 		scn = bpy.context.scene
 		
 		if event.type == 'TIMER':
+			#copy the mosaic updated by the loading threads in the background image
+			self.map.refresh()
 			#report thread progression
 			self.nb, self.nbTotal = self.map.progress()
 			return {'PASS_THROUGH'}
@@ -1126,7 +945,7 @@ class MAP_VIEW(bpy.types.Operator):
 				else:
 					context.region_data.view_distance /= 2 #tile matrix res factor
 					# map zoom up
-					if scn["z"] < self.map.layer.zmax:
+					if scn["z"] < self.map.zmax:
 						scn["z"] += 1
 						self.map.get()
 	
@@ -1149,7 +968,7 @@ class MAP_VIEW(bpy.types.Operator):
 				else:
 					context.region_data.view_distance *= 2
 					#map zoom down  
-					if scn["z"] > self.map.layer.zmin:
+					if scn["z"] > self.map.zmin:
 						scn["z"] -= 1
 						self.map.get()
 
@@ -1158,6 +977,8 @@ class MAP_VIEW(bpy.types.Operator):
 			#Report mouse location coords in projeted crs
 			loc = self.mouseTo3d(context, event.mouse_region_x, event.mouse_region_y)
 			self.posx, self.posy = self.map.view3dToProj(loc.x, loc.y)
+			#tiles under the cursor will be loaded first
+			self.map.mouse = (self.posx, self.posy)
 			
 			#Drag background image (edit its offset values)
 			if self.inMove and self.map.bkg is not None:
@@ -1200,17 +1021,112 @@ class MAP_VIEW(bpy.types.Operator):
 
 		if event.type in {'ESC'}:
 			self.map.stop()
+			self.map.cancelPrefetch()
+			self.map.refresh()
+			self.map.saveImage()
+			#don't freeze the UI while pending tiles are commited
+			self.map.close(wait=False)
+			self.cachePolicy.stop()
 			bpy.types.SpaceView3D.draw_handler_remove(self._handle, 'WINDOW')
 			return {'CANCELLED'}
 
 		if event.type in {'RET'}:
 			self.map.stop()
+			self.map.cancelPrefetch()
+			#the map stays as background, keep it with the blend file
+			self.map.refresh()
+			self.map.saveImage()
+			#don't freeze the UI while pending tiles are commited
+			self.map.close(wait=False)
+			self.cachePolicy.stop()
 			bpy.types.SpaceView3D.draw_handler_remove(self._handle, 'WINDOW')
 			return {'FINISHED'}
 
 		return {'RUNNING_MODAL'}
 
 
+class MAP_STATS_EXPORT(bpy.types.Operator):
+
+	bl_idname = "view3d.map_stats_export"
+	bl_description = 'Write tiles pipeline statistics as json file in cache folder'
+	bl_label = "Export stats"
+
+	def execute(self, context):
+		path = context.scene.cacheFolder + 'basemaps_stats.json'
+		try:
+			metrics.export(path)
+		except OSError as e:
+			self.report({'ERROR'}, str(e))
+			return {'CANCELLED'}
+		self.report({'INFO'}, "Stats written in " + path)
+		return {'FINISHED'}
+
+
+class MAP_EXPORT(bpy.types.Operator, ExportHelper):
+
+	bl_idname = "view3d.map_export"
+	bl_description = 'Export the area of the map displayed in the 3d view as a georeferenced raster (GeoTIFF or PNG with worldfile)'
+	bl_label = "Export map"
+
+	filename_ext = ".tif"
+	filter_glob = StringProperty(default="*.tif;*.png", options={'HIDDEN'})
+
+	zoom = IntProperty(name="Zoom level", description="Zoom level of the exported raster", min=0, max=24, default=0)
+
+	def check(self, context):
+		#keep png extension if chosen by the user
+		return False
+
+	def invoke(self, context, event):
+		#zoom of the map viewer, limits of the layer are checked by MapExport
+		self.zoom = context.scene.get('z', 0)
+		return ExportHelper.invoke(self, context, event)
+
+	def execute(self, context):
+		scn = context.scene
+		if 'z' not in scn:
+			self.report({'ERROR'}, "No map displayed, run the map viewer first")
+			return {'CANCELLED'}
+		srcKey, layKey = scn.mapSource.split(':')
+		dstGrid = scn.mapGrid if scn.mapGrid != 'SOURCE' else None
+
+		#Extent of the 3d view, at the zoom level of the map viewer
+		try:
+			srv = MapService(srcKey, scn.cacheFolder, dstGrid)
+		except ValueError as e:
+			self.report({'ERROR'}, str(e))
+			return {'CANCELLED'}
+		tm = srv.tm2
+		srv.close()
+		region = [r for r in context.area.regions if r.type == 'WINDOW'][0]
+		x, y = tm.geoToProj(scn['long'], scn['lat'])
+		res = tm.getRes(scn['z'])
+		w, h = region.width / 2 * res, region.height / 2 * res
+		bbox = (x - w, y - h, x + w, y + h)
+
+		try:
+			export = MapExport(scn.mapSource, scn.cacheFolder, bbox, tm.CRS, self.zoom, dstGrid)
+		except ValueError as e:
+			self.report({'ERROR'}, str(e))
+			return {'CANCELLED'}
+		wm = context.window_manager
+		wm.progress_begin(0, export.nbRows)
+		try:
+			failed = export.run(self.filepath, lambda done, total: wm.progress_update(done))
+		except (OSError, ValueError) as e:
+			self.report({'ERROR'}, str(e))
+			return {'CANCELLED'}
+		finally:
+			wm.progress_end()
+
+		msg = "Map exported (" + str(export.width) + " x " + str(export.height) + " px)"
+		if failed:
+			self.report({'WARNING'}, msg + ", " + str(failed) + " tiles unavailable")
+		else:
+			self.report({'INFO'}, msg)
+		return {'FINISHED'}
+
+
 ####################################
 # Properties in scene
 
@@ -1223,6 +1139,18 @@ bpy.types.Scene.cacheFolder = bpy.props.StringProperty(
       subtype = 'DIR_PATH'
       )
 
+bpy.types.Scene.mapSaveImg = BoolProperty(
+	name = "Save map image",
+	description = "Write the map as png file in cache folder on each update (slower, otherwise it's only written when the map viewer ends)",
+	default = False
+	)
+
+bpy.types.Scene.mapShowStats = BoolProperty(
+	name = "Show stats",
+	description = "Display tiles pipeline statistics (latencies, cache hits, downloads) in the map view",
+	default = False
+	)
+
 
 srcItems = []
 for srckey, src in sources.items():
@@ -1240,6 +1168,18 @@ bpy.types.Scene.mapSource = EnumProperty(
 			items = srcItems
 			)
 
+#without GDAL, tiles can only be reprojected between lat long and web mercator
+gridItems = [('SOURCE', 'Source grid', 'Display tiles in the grid of the map source')]
+for gridkey, grid in sorted(grids.items()):
+	if PROJ or grid['CRS'] in (4326, 3857):
+		gridItems.append( (gridkey, gridkey, 'Reproject tiles to EPSG:' + str(grid['CRS'])) )
+
+bpy.types.Scene.mapGrid = EnumProperty(
+			name = "Grid",
+			description = "Tiles matrix in which the map is displayed, tiles are reprojected if it differs from the source one",
+			items = gridItems
+			)
+
 ####################################
 
 class MAP_PANEL(bpy.types.Panel):
@@ -1255,7 +1195,13 @@ class MAP_PANEL(bpy.types.Panel):
 		scn = context.scene
 		layout.prop(scn, "cacheFolder")
 		layout.prop(scn, "mapSource")		
+		layout.prop(scn, "mapGrid")
+		layout.prop(scn, "mapSaveImg")
 		layout.operator("view3d.map_view")
+		row = layout.row(align=True)
+		row.prop(scn, "mapShowStats")
+		row.operator("view3d.map_stats_export")
+		layout.operator("view3d.map_export")
 		layout.prop(scn, "fontColor")
 
 
@@ -0,0 +1,189 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+"""
+Conversion of basemaps caches from and to MBTiles, usable without Blender
+
+MBTiles rows are numbered from the bottom (TMS scheme), rows of tiles matrix with a north west origin are flipped.
+The MBTiles specification only defines web mercator tilesets, others grids are converted the same way
+but others tools will probably not read them.
+
+Usage example :
+python -m basemaps.mbtiles export OSM:MAPNIK /path/to/cache/ /path/to/osm.mbtiles
+python -m basemaps.mbtiles import OSM:MAPNIK /path/to/cache/ /path/to/osm.mbtiles
+"""
+
+#https://github.com/mapbox/mbtiles-spec/blob/master/1.3/spec.md
+
+#built-in imports
+import os
+import math
+import sqlite3
+import argparse
+import collections
+
+#addon import
+from .mapservice import MapService, iterBatches
+
+#MBTiles metadata format <--> tile_format column of the caches (named as by imghdr)
+FORMATS = {'png':'png', 'jpg':'jpeg', 'webp':'webp'}
+
+
+class MBTiles():
+	"""MBTiles file, tiles are converted from or to the rows numbering of a tile matrix"""
+
+	BATCH_SIZE = 1000 #number of tiles read and inserted at once
+
+	def __init__(self, path, tm):
+		self.path = path
+		self.tm = tm
+		if self.tm.CRS != 3857:
+			print("MBTiles are web mercator tilesets, a grid in EPSG:" + str(self.tm.CRS) + " will not be readable by others tools")
+
+	def flipRow(self, row, zoom):
+		'''Convert a row number between the tile matrix and TMS numbering (the conversion is its own inverse)'''
+		if self.tm.originLoc == "SW":
+			return row
+		height = math.ceil((self.tm.ymax - self.tm.ymin) / (self.tm.tileSize * self.tm.getRes(zoom)))
+		return height - 1 - row
+
+	def getBounds(self, zoom, colmin, colmax, rowmin, rowmax):
+		'''Return lon/lat bounds of a range of tiles'''
+		xmin, ymax = self.tm.getTileCoords(colmin, rowmin if self.tm.originLoc == "NW" else rowmax, zoom)
+		xmax, ymin = self.tm.getTileCoords(colmax + 1, rowmax + 1 if self.tm.originLoc == "NW" else rowmin - 1, zoom)
+		lonmin, latmin = self.tm.projToGeo(xmin, ymin)
+		lonmax, latmax = self.tm.projToGeo(xmax, ymax)
+		return lonmin, latmin, lonmax, latmax
+
+	def export(self, cache, name, progress=None):
+		'''
+		Write all tiles of a GeoPackage cache in a new MBTiles file, an existing file is replaced
+		progress is an optional function called with (nb tiles done, total nb tiles)
+		Return the number of tiles exported
+		'''
+		cache.flush() #pending writes first
+		src = cache.getConnection()
+		total = src.execute("SELECT COUNT(*) FROM gpkg_tiles").fetchone()[0]
+		formats = dict(src.execute("SELECT tile_format, COUNT(*) FROM gpkg_tiles GROUP BY tile_format"))
+
+		if os.path.exists(self.path):
+			os.remove(self.path)
+		db = sqlite3.connect(self.path, isolation_level=None)
+		#the file is rebuilt from scratch if the export fails, no need to journalize
+		db.execute("PRAGMA journal_mode = OFF")
+		db.execute("PRAGMA synchronous = OFF")
+		db.execute("BEGIN")
+		db.execute("CREATE TABLE metadata (name TEXT, value TEXT)")
+		db.execute("CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)")
+
+		nbTiles = 0
+		ranges = {} #{zoom: [colmin, colmax, rowmin, rowmax]}
+		for batch in iterBatches(cache.exportTiles(), self.BATCH_SIZE):
+			db.executemany("INSERT INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?,?,?,?)",
+				[(z, x, self.flipRow(y, z), data) for x, y, z, data, format in batch])
+			for x, y, z, data, format in batch:
+				r = ranges.setdefault(z, [x, x, y, y])
+				r[0], r[1], r[2], r[3] = min(r[0], x), max(r[1], x), min(r[2], y), max(r[3], y)
+			nbTiles += len(batch)
+			if progress is not None:
+				progress(nbTiles, total)
+		#index built once all tiles are inserted, it's faster than updating it on each insert
+		db.execute("CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row)")
+
+		#Metadata, format is the most frequent one (tiles of unknown format are supposed to be png)
+		formats = collections.Counter({(f or 'png'): n for f, n in formats.items()})
+		format = formats.most_common(1)[0][0] if formats else 'png'
+		metadata = {
+			'name': name,
+			'type': 'baselayer',
+			'version': '1.0',
+			'description': 'Exported with BlenderGIS',
+			'format': {v:k for k, v in FORMATS.items()}.get(format, format)
+		}
+		if ranges:
+			zmin, zmax = min(ranges), max(ranges)
+			metadata['minzoom'], metadata['maxzoom'] = str(zmin), str(zmax)
+			bounds = self.getBounds(zmax, *ranges[zmax])
+			metadata['bounds'] = ','.join(str(round(v, 6)) for v in bounds)
+			metadata['center'] = ','.join(str(round(v, 6)) for v in ((bounds[0] + bounds[2]) / 2, (bounds[1] + bounds[3]) / 2)) + ',' + str(zmin)
+		db.executemany("INSERT INTO metadata (name, value) VALUES (?,?)", metadata.items())
+		db.execute("COMMIT")
+		db.close()
+		return nbTiles
+
+	def getMetadata(self):
+		db = sqlite3.connect(self.path)
+		try:
+			return dict(db.execute("SELECT name, value FROM metadata"))
+		except sqlite3.OperationalError:
+			return {}
+		finally:
+			db.close()
+
+	def load(self, cache, progress=None):
+		'''
+		Import all tiles of the MBTiles file in a GeoPackage cache, in a single transaction
+		Tiles already in cache are replaced
+		progress is an optional function called with (nb tiles done, total nb tiles)
+		Return the number of tiles imported
+		'''
+		#format is recorded in cache if known, otherwise it will be sniffed when read
+		format = FORMATS.get(self.getMetadata().get('format'))
+		db = sqlite3.connect(self.path)
+		try:
+			total = db.execute("SELECT COUNT(*) FROM tiles").fetchone()[0]
+			cursor = db.execute("SELECT tile_column, tile_row, zoom_level, tile_data FROM tiles")
+			tiles = ((x, self.flipRow(y, z), z, data, format) for x, y, z, data in cursor)
+			report = None if progress is None else lambda n: progress(n, total)
+			return cache.importTiles(tiles, report)
+		finally:
+			db.close()
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Convert a BlenderGIS basemap cache from or to MBTiles')
+	parser.add_argument('action', choices=['export', 'import'], help='export the cache to MBTiles, or import MBTiles in the cache')
+	parser.add_argument('mapKey', help='source and layer keys as defined in servicesDefs, eg. OSM:MAPNIK')
+	parser.add_argument('cacheFolder')
+	parser.add_argument('mbtiles', help='path of the MBTiles file')
+	parser.add_argument('--grid', help='key of the grid of the cache, default to the source grid')
+	args = parser.parse_args()
+
+	srcKey, layKey = args.mapKey.split(':')
+	os.makedirs(args.cacheFolder, exist_ok=True)
+	srv = MapService(srcKey, os.path.join(args.cacheFolder, ''), args.grid)
+	cache = srv.getCache(layKey)
+	mbtiles = MBTiles(args.mbtiles, srv.tm2)
+
+	def progress(done, total):
+		if done == total or done % (mbtiles.BATCH_SIZE * 10) == 0:
+			print(str(done) + '/' + str(total) + ' tiles')
+
+	try:
+		if args.action == 'export':
+			n = mbtiles.export(cache, args.mapKey, progress)
+		else:
+			n = mbtiles.load(cache, progress)
+	finally:
+		srv.close()
+	print(str(n) + ' tiles ' + args.action + 'ed')
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,168 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+"""
+Instrumentation of the tiles pipeline
+
+Stages timed :
+cache (sqlite lookup), download (http request), warp (reprojection), encode (tiles transcoded before caching),
+decode (PIL), paste (into mosaic), convert (mosaic converted to pixels or png by the loading thread),
+save (mosaic copied to the bpy image), place (background image setup)
+
+Counters by source :
+memoryHits, cacheHits, misses, requests, retries, errors, bytes (downloaded, before decompression),
+avoided (requests not sent because the tile is known as missing), coalesced (downloads shared with another request)
+"""
+
+#built-in imports
+import time
+import json
+import threading
+import contextlib
+
+
+class Histogram():
+	"""Latency histogram with power of 2 buckets, in milliseconds"""
+
+	BOUNDS = [2**i for i in range(15)] #upper bounds, from 1ms to 16s, last bucket is unbounded
+
+	def __init__(self):
+		self.buckets = [0] * (len(self.BOUNDS) + 1)
+		self.count = 0
+		self.total = 0 #ms
+		self.min, self.max = None, None
+
+	def add(self, ms):
+		i = 0
+		while i < len(self.BOUNDS) and ms > self.BOUNDS[i]:
+			i += 1
+		self.buckets[i] += 1
+		self.count += 1
+		self.total += ms
+		self.min = ms if self.min is None else min(self.min, ms)
+		self.max = ms if self.max is None else max(self.max, ms)
+
+	@property
+	def mean(self):
+		return self.total / self.count if self.count else None
+
+	def percentile(self, p):
+		'''Estimated value under which p percent of the samples fall (upper bound of the bucket)'''
+		if not self.count:
+			return None
+		n = 0
+		for i, nb in enumerate(self.buckets):
+			n += nb
+			if n >= self.count * p / 100:
+				return min(self.BOUNDS[i], self.max) if i < len(self.BOUNDS) else self.max
+
+	def toDict(self):
+		r = lambda v: None if v is None else round(v, 3)
+		return {
+			'count': self.count,
+			'total': r(self.total),
+			'mean': r(self.mean),
+			'min': r(self.min),
+			'max': r(self.max),
+			'p50': r(self.percentile(50)),
+			'p95': r(self.percentile(95)),
+			'buckets': dict(zip([str(b) for b in self.BOUNDS] + ['inf'], self.buckets))
+		}
+
+
+class Metrics():
+	"""Thread safe collector of stages latencies and per source counters"""
+
+	STAGES = ('cache', 'download', 'warp', 'encode', 'decode', 'paste', 'convert', 'save', 'place')
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self.reset()
+
+	def reset(self):
+		with self._lock:
+			self.stages = {stage: Histogram() for stage in self.STAGES}
+			self.sources = {} #{srcKey: {counter name: value}}
+			self.start = time.time()
+
+	def add(self, stage, seconds):
+		'''Record the duration of a stage'''
+		with self._lock:
+			self.stages[stage].add(seconds * 1000)
+
+	@contextlib.contextmanager
+	def timer(self, stage):
+		'''Context manager recording the duration of the enclosed block'''
+		t0 = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.add(stage, time.perf_counter() - t0)
+
+	def count(self, srcKey, name, n=1):
+		'''Increment a counter of the source'''
+		with self._lock:
+			counters = self.sources.setdefault(srcKey, {})
+			counters[name] = counters.get(name, 0) + n
+
+	def hitRatio(self, srcKey=None):
+		'''Ratio of tiles found in memory or cache, for a source or all of them'''
+		with self._lock:
+			sources = [self.sources.get(srcKey, {})] if srcKey is not None else list(self.sources.values())
+			hits = sum(c.get('memoryHits', 0) + c.get('cacheHits', 0) for c in sources)
+			total = hits + sum(c.get('misses', 0) for c in sources)
+		return hits / total if total else None
+
+	def toDict(self):
+		with self._lock:
+			d = {
+				'duration': round(time.time() - self.start, 3),
+				'stages': {stage: h.toDict() for stage, h in self.stages.items()},
+				'sources': {k: dict(c) for k, c in self.sources.items()}
+			}
+		for srcKey in d['sources']:
+			d['sources'][srcKey]['hitRatio'] = self.hitRatio(srcKey)
+		return d
+
+	def export(self, path):
+		'''Write the metrics in a json file'''
+		with open(path, 'w') as f:
+			json.dump(self.toDict(), f, indent=2)
+
+	def summary(self):
+		'''Return a list of short text lines, one per stage and per source'''
+		lines = []
+		with self._lock:
+			for stage in self.STAGES:
+				h = self.stages[stage]
+				if h.count:
+					lines.append(stage + ' : ' + str(h.count) + ' x ' + str(round(h.mean, 1)) + 'ms (p95 ' + str(round(h.percentile(95), 1)) + 'ms)')
+			sources = list(self.sources.keys())
+		for srcKey in sources:
+			c = self.sources[srcKey]
+			ratio = self.hitRatio(srcKey)
+			ratio = '-' if ratio is None else str(int(ratio * 100)) + '%'
+			lines.append(srcKey + ' : hits ' + ratio + ', ' + str(round(c.get('bytes', 0) / 1024**2, 1)) + ' MB, '
+				+ str(c.get('retries', 0)) + ' retries, ' + str(c.get('errors', 0)) + ' errors, '
+				+ str(c.get('avoided', 0) + c.get('coalesced', 0)) + ' requests saved')
+		return lines
+
+
+#Shared by all map services
+metrics = Metrics()
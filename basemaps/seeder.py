@@ -0,0 +1,176 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+"""
+Headless seeding of basemaps caches, usable without Blender
+
+Usage example :
+python -m basemaps.seeder OSM:MAPNIK /path/to/cache/ --bbox 2.9 45.7 3.2 45.9 --crs 4326 --zmin 0 --zmax 14
+"""
+
+#built-in imports
+import os
+import argparse
+import concurrent.futures
+import multiprocessing
+
+#addon import
+from .mapservice import MapService, reprojBbox
+
+
+class Seeder():
+	"""Download in cache all tiles of a layer covering a bbox for a range of zoom levels"""
+
+	BATCH_SIZE = 1000 #number of tiles checked in cache and queued at once
+	DEFAULT_TILE_SIZE = 20000 #bytes, tile size used for estimation when the cache is still empty
+	DENSIFY = 10 #number of points per bbox edge used to reproject the bbox
+
+	def __init__(self, mapKey, cacheFolder, bbox, bboxCRS, zmin, zmax, dstGrid=None, storeFormat=None, storeQuality=None, processes=0):
+		'''
+		storeFormat and storeQuality override the store policy of the layer
+		processes is the number of processes used to transcode tiles, 0 to transcode them in the download threads
+		'''
+		srcKey, self.layKey = mapKey.split(':')
+		cacheFolder = os.path.join(cacheFolder, '') #cache path is built by concatenation
+		self.srv = MapService(srcKey, cacheFolder, dstGrid)
+		lay = self.srv.layers[self.layKey]
+		if storeFormat is not None:
+			lay.storeFormat = self.srv.checkStoreFormat(storeFormat)
+		if storeQuality is not None:
+			lay.storeQuality = storeQuality
+		self.processes = processes if lay.storeFormat is not None else 0
+		self.cache = self.srv.getCache(self.layKey)
+		self.tm = self.srv.tm2
+		self.zmin, self.zmax = zmin, zmax
+		#convert bbox to tile matrix crs
+		self.bbox = reprojBbox(bboxCRS, self.tm.CRS, bbox, self.DENSIFY)
+
+	def getRange(self, zoom):
+		'''Return (colmin, colmax, rowmin, rowmax) of tiles covering the bbox, clipped to tile matrix extent'''
+		xmin, ymin, xmax, ymax = self.bbox
+		xmin, xmax = max(xmin, self.tm.xmin), min(xmax, self.tm.xmax)
+		ymin, ymax = max(ymin, self.tm.ymin), min(ymax, self.tm.ymax)
+		#shift bottom right corner by half a pixel, a bbox edge on a tiles border does not need the next tile
+		eps = self.tm.getRes(zoom) / 2
+		col1, row1 = self.tm.getTileNumber(xmin, ymax, zoom)
+		col2, row2 = self.tm.getTileNumber(max(xmin, xmax - eps), min(ymax, ymin + eps), zoom)
+		return col1, col2, min(row1, row2), max(row1, row2)
+
+	def listTiles(self, zoom):
+		'''Yield (col, row) tiles at this zoom level, column by column'''
+		colmin, colmax, rowmin, rowmax = self.getRange(zoom)
+		for col in range(colmin, colmax + 1):
+			for row in range(rowmin, rowmax + 1):
+				if self.srv.isTileInBounds(col, row, zoom):
+					yield col, row
+
+	def estimate(self):
+		'''
+		Return a dict with the number of tiles covering the bbox, the number of them already in cache,
+		and an estimation of the bytes to download
+		'''
+		nbTiles, nbCached = 0, 0
+		for zoom in range(self.zmin, self.zmax + 1):
+			#same tiles as seeded by run(), tiles out of the matrix bounds are skipped
+			nbTiles += sum(1 for tile in self.listTiles(zoom))
+			#only tiles in bounds are put in cache, they can be counted by range
+			colmin, colmax, rowmin, rowmax = self.getRange(zoom)
+			nbCached += self.cache.countTiles(zoom, colmin, colmax, rowmin, rowmax)[0]
+		tileSize = self.cache.getAverageTileSize() or self.DEFAULT_TILE_SIZE
+		return {'tiles':nbTiles, 'cached':nbCached, 'bytes':int((nbTiles - nbCached) * tileSize)}
+
+	def run(self, progress=None):
+		'''
+		Download missing tiles, tiles already in cache are skipped so an interrupted seeding can be resumed
+		progress is an optional function called with (zoom, nb tiles done, nb tiles failed)
+		Return the number of tiles that could not be downloaded
+		'''
+		nbDone, nbFailed = 0, 0
+		if self.processes:
+			#encoding is cpu bound, download threads would be serialized by the GIL
+			self.srv.transcoder = concurrent.futures.ProcessPoolExecutor(self.processes)
+		try:
+			for zoom in range(self.zmin, self.zmax + 1):
+				batch = []
+				for tile in self.listTiles(zoom):
+					batch.append(tile)
+					if len(batch) == self.BATCH_SIZE:
+						done, failed = self.seedBatch(batch, zoom)
+						nbDone, nbFailed = nbDone + done, nbFailed + failed
+						batch = []
+						if progress is not None:
+							progress(zoom, nbDone, nbFailed)
+				done, failed = self.seedBatch(batch, zoom)
+				nbDone, nbFailed = nbDone + done, nbFailed + failed
+				if progress is not None:
+					progress(zoom, nbDone, nbFailed)
+		finally:
+			self.srv.close() #stop threads and commit pending tiles
+			if self.srv.transcoder is not None:
+				self.srv.transcoder.shutdown()
+				self.srv.transcoder = None
+		return nbFailed
+
+	def seedBatch(self, tiles, zoom):
+		'''Download in parallel the tiles not in cache, return the number of tiles processed and failed'''
+		cached = self.cache.hasTiles(tiles, zoom)
+		futures = [self.srv.pool.submit(self.srv.downloadTile, self.layKey, col, row, zoom)
+			for col, row in tiles if (col, row) not in cached]
+		concurrent.futures.wait(futures)
+		#partially reprojected tiles are not cached, they count as failed
+		failed = len([f for f in futures if f.exception() is not None or f.result()[0] is None or f.result()[1]])
+		return len(tiles), failed
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Download basemap tiles in a BlenderGIS cache folder')
+	parser.add_argument('mapKey', help='source and layer keys as defined in servicesDefs, eg. OSM:MAPNIK')
+	parser.add_argument('cacheFolder')
+	parser.add_argument('--bbox', nargs=4, type=float, required=True, metavar=('XMIN', 'YMIN', 'XMAX', 'YMAX'))
+	parser.add_argument('--crs', type=int, default=4326, help='EPSG code of the bbox coordinates')
+	parser.add_argument('--zmin', type=int, required=True)
+	parser.add_argument('--zmax', type=int, required=True)
+	parser.add_argument('--estimate', action='store_true', help='only print the estimation')
+	parser.add_argument('--grid', help='key of the grid in which tiles are reprojected, default to the source grid')
+	parser.add_argument('--store-format', choices=['JPEG', 'WEBP', 'PNG'], type=str.upper,
+		help='transcode tiles to this format before putting them in cache, default to the layer store policy')
+	parser.add_argument('--quality', type=int, help='JPEG or WEBP encoding quality')
+	parser.add_argument('--processes', type=int, default=0, nargs='?', const=multiprocessing.cpu_count(),
+		help='transcode tiles in a pool of processes, default to the number of cpu if no value is given')
+	args = parser.parse_args()
+
+	os.makedirs(args.cacheFolder, exist_ok=True)
+	seeder = Seeder(args.mapKey, args.cacheFolder, args.bbox, args.crs, args.zmin, args.zmax, args.grid,
+		args.store_format, args.quality, args.processes)
+	est = seeder.estimate()
+	print('Tiles : ' + str(est['tiles']) + ' (' + str(est['cached']) + ' already in cache)')
+	print('Estimated download : ' + str(round(est['bytes'] / 1024**2, 1)) + ' MB')
+	if args.estimate:
+		seeder.srv.close()
+		return
+
+	def progress(zoom, done, failed):
+		print('zoom ' + str(zoom) + ' : ' + str(done) + '/' + str(est['tiles']) + ' tiles, ' + str(failed) + ' failed')
+
+	failed = seeder.run(progress)
+	print('Seeding complete, ' + str(failed) + ' tiles failed')
+
+
+if __name__ == '__main__':
+	main()
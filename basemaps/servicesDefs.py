@@ -105,6 +105,20 @@ grids = {
 #A source can have multiple layers but have only one grid
 #so to support multiple grid it's necessary to duplicate source definition
 
+#"nbThreads" is the number of concurrent downloads allowed for the source (optional, default to 4)
+#"dedup" enable the deduplicated cache layout, identical tiles are stored only once (optional, default to False)
+#"dstGrid" is the key of the grid in which tiles are served, tiles are reprojected from the source grid (optional)
+#"resampling" is the method used to reproject tiles, 'nearest' or 'bilinear' (optional, default to bilinear)
+#"metaSize" with WMS, number of tiles [columns, rows] requested at once in a single GetMap call (optional)
+#"metaBuffer" with WMS metatiles, margin in pixels added around the metatile to avoid labels clipping (optional, default to 0)
+#  metatiles are an opt-in, check first that the server accepts large GetMap requests and renders them identically
+#  e.g. for a WMS map with labels : "metaSize" : [4, 4], "metaBuffer" : 32
+#"storeFormat" transcode tiles before putting them in cache, 'JPEG', 'WEBP' or 'PNG' (optional, default to the downloaded format)
+#  tiles with transparent pixels are kept in PNG if the store format is JPEG, WEBP fallback to JPEG if PIL can't encode it
+#"storeQuality" JPEG or WEBP encoding quality, from 1 to 100 (optional, default to 80)
+#"storeFormat" and "storeQuality" can also be defined by layer, to override the source ones
+#  e.g. to cache orthophotos as lossy WEBP : "ORTHO" : {..., "storeFormat" : 'WEBP', "storeQuality" : 75}
+
 sources = {
 
 
@@ -124,7 +138,8 @@ sources = {
 			"MAP" : {"urlKey" : 'm', "name" : 'Map', "format" : 'png', "zmin" : 0, "zmax" : 22}
 		},
 		"urlTemplate": "http://mt0.google.com/vt/lyrs={LAY}&x={X}&y={Y}&z={Z}",
-		"referer": "https://www.google.com/maps"
+		"referer": "https://www.google.com/maps",
+		"nbThreads": 4
 	},
 
 	"OSM" : {
@@ -137,7 +152,8 @@ sources = {
 			"MAPNIK" : {"urlKey" : '', "name" : 'Mapnik', "format" : 'png', "zmin" : 0, "zmax" : 19}
 		},
 		"urlTemplate": "http://tile.openstreetmap.org/{Z}/{X}/{Y}.png",
-		"referer": "http://www.openstreetmap.org"
+		"referer": "http://www.openstreetmap.org",
+		"nbThreads": 4
 	},
 
 
@@ -152,7 +168,8 @@ sources = {
 			"MAP" : {"urlKey" : 'G', "name" : 'Map', "format" : 'png', "zmin" : 0, "zmax" : 22}
 		},
 		"urlTemplate": "http://ak.dynamic.t0.tiles.virtualearth.net/comp/ch/{QUADKEY}?it={LAY}",
-		"referer": "http://www.bing.com/maps"
+		"referer": "http://www.bing.com/maps",
+		"nbThreads": 4
 	},
 
 
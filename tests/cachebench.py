@@ -0,0 +1,190 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+"""
+Benchmark of the tiles cache, usable without Blender
+
+Tiles are written then read by several threads, first with a connection and a commit per tile
+(the behaviour before connections were kept open), then through GeoPackage persistent connections and batched writes.
+Then a viewport is loaded from a local stand-in tiles server with an empty cache (cold) and again once cached (warm),
+both with the per tile code path (connection per tile, urllib download) and with MapService.
+Exit status is 1 if some tiles are missing.
+
+Usage example :
+python -m tests.cachebench --tiles 500 --threads 4
+"""
+
+#built-in imports
+import os
+import sys
+import time
+import sqlite3
+import imghdr
+import argparse
+import tempfile
+import urllib.request
+import concurrent.futures
+
+#addon import
+from basemaps.mapservice import GeoPackage, MapService, TileMatrix
+from basemaps.servicesDefs import grids
+from basemaps.metrics import metrics
+from basemaps.seeder import Seeder
+from .testserver import TestServer, TileHandler, tileSource, testSources
+
+
+def legacyPut(path, x, y, z, data, format):
+	db = sqlite3.connect(path)
+	db.execute("INSERT OR REPLACE INTO gpkg_tiles (zoom_level, tile_column, tile_row, tile_data, tile_format) VALUES (?,?,?,?,?)",
+		(z, x, y, data, format))
+	db.commit()
+	db.close()
+
+def legacyGet(path, x, y, z):
+	db = sqlite3.connect(path)
+	result = db.execute("SELECT tile_data FROM gpkg_tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?", (z, x, y)).fetchone()
+	db.close()
+	return result
+
+def legacyGetTile(srv, path, layKey, col, row, zoom):
+	'''Viewport tile loading before this series : cache lookup with its own connection, urllib download and put with its own commit'''
+	result = legacyGet(path, col, row, zoom)
+	data = result[0] if result is not None else None
+	if data is not None and imghdr.what(None, data) is None:
+		data = None
+	if data is None:
+		try:
+			handle = urllib.request.urlopen(urllib.request.Request(srv.buildUrl(layKey, col, row, zoom), None, srv.headers), timeout=3)
+			data = handle.read()
+			handle.close()
+		except Exception:
+			return None
+		format = imghdr.what(None, data)
+		if format is None:
+			return None
+		legacyPut(path, col, row, zoom, data, format)
+	return data
+
+def createLegacyCache(path, tm):
+	'''Create an empty cache with the default rollback journal, with a full sync on each commit, like caches before this series'''
+	GeoPackage(path, tm).close()
+	db = sqlite3.connect(path)
+	db.execute("PRAGMA journal_mode = DELETE")
+	db.close()
+
+
+def run(func, jobs, nbThreads):
+	'''Call func with each tuple of arguments of jobs from nbThreads threads, return (duration, results)'''
+	t0 = time.perf_counter()
+	with concurrent.futures.ThreadPoolExecutor(nbThreads) as executor:
+		results = list(executor.map(lambda args: func(*args), jobs))
+	return time.perf_counter() - t0, results
+
+
+def benchAccess(nbTiles, tileSize, nbThreads):
+	'''Time the writes and reads of tiles with a connection per tile and with GeoPackage, return True if all tiles are read back'''
+	tm = TileMatrix(grids['GLOBAL_MERCATOR'])
+	folder = tempfile.mkdtemp()
+	tiles = [(x, 0, 15, os.urandom(tileSize), 'png') for x in range(nbTiles)]
+	ok = True
+
+	path = os.path.join(folder, 'legacy.gpkg')
+	createLegacyCache(path, tm)
+	tWrite, results = run(lambda x, y, z, data, format: legacyPut(path, x, y, z, data, format), tiles, nbThreads)
+	tRead, results = run(lambda x, y, z, data, format: legacyGet(path, x, y, z), tiles, nbThreads)
+	ok = ok and all(results)
+	print('Connection per tile : write ' + str(round(tWrite, 2)) + 's, read ' + str(round(tRead, 2)) + 's')
+
+	gpkg = GeoPackage(os.path.join(folder, 'pooled.gpkg'), tm)
+	t0 = time.perf_counter()
+	run(gpkg.putTile, tiles, nbThreads)
+	gpkg.flush()
+	tWrite = time.perf_counter() - t0
+	tRead, results = run(lambda x, y, z, data, format: gpkg.getTile(x, y, z)[0], tiles, nbThreads)
+	gpkg.close()
+	ok = ok and all(results)
+	print('Persistent connections : write ' + str(round(tWrite, 2)) + 's, read ' + str(round(tRead, 2)) + 's')
+	return ok
+
+
+def benchViewport(bbox, zoom, nbThreads):
+	'''
+	Load the tiles of the bbox from an empty cache then from the cache, with the per tile code path and with MapService,
+	return True if all tiles are loaded
+	'''
+	folder = os.path.join(tempfile.mkdtemp(), '')
+	seeder = Seeder('BENCH:L', folder, bbox, 4326, zoom, zoom)
+	jobs = [('L', col, row, zoom) for col, row in seeder.listTiles(zoom)]
+	tm = seeder.srv.tm1
+	seeder.srv.close()
+	ok = True
+	durations = {}
+
+	legacyPath = os.path.join(tempfile.mkdtemp(), 'legacy.gpkg')
+	createLegacyCache(legacyPath, tm)
+	for name in ('cold', 'warm'):
+		srv = MapService('BENCH', folder)
+		duration, results = run(lambda *args: legacyGetTile(srv, legacyPath, *args), jobs, nbThreads)
+		srv.close()
+		ok = ok and all(results)
+		durations[('legacy', name)] = duration
+
+	for name in ('cold', 'warm'):
+		#a new service, like a new map view, so tiles only come from the cache database
+		srv = MapService('BENCH', folder)
+		metrics.reset()
+		duration, results = run(srv.getTile, jobs, nbThreads)
+		srv.close()
+		ok = ok and all(results)
+		durations[('pooled', name)] = duration
+		print('Viewport ' + name + ' metrics :')
+		for line in metrics.summary():
+			print('  ' + line)
+
+	print('Viewport of ' + str(len(jobs)) + ' tiles : per tile code path / MapService')
+	for name in ('cold', 'warm'):
+		legacy, pooled = durations[('legacy', name)], durations[('pooled', name)]
+		print('  ' + name + ' : ' + str(round(legacy, 2)) + 's / ' + str(round(pooled, 2)) + 's (x' + str(round(legacy / pooled, 1)) + ')')
+	return ok
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Compare tiles cache accesses with a connection per tile and with persistent connections, then time cold and warm viewport loads with both')
+	parser.add_argument('--tiles', type=int, default=500, help='number of tiles written and read')
+	parser.add_argument('--tile-size', type=int, default=20000, help='bytes')
+	parser.add_argument('--threads', type=int, default=4, help='number of loading threads')
+	parser.add_argument('--bbox', nargs=4, type=float, default=[2.9, 45.7, 3.3, 45.95], metavar=('XMIN', 'YMIN', 'XMAX', 'YMAX'),
+		help='lon/lat area of the viewport')
+	parser.add_argument('--zoom', type=int, default=14, help='zoom level of the viewport')
+	parser.add_argument('--delay', type=float, default=0.02, help='seconds, latency of the stand-in tiles server')
+	args = parser.parse_args()
+
+	ok = benchAccess(args.tiles, args.tile_size, args.threads)
+
+	server = TestServer(TileHandler, args.delay).start()
+	with testSources({'BENCH': tileSource(server.port)}):
+		ok = benchViewport(args.bbox, args.zoom, args.threads) and ok
+	server.stop()
+
+	print('OK' if ok else 'FAILED')
+	sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+	main()
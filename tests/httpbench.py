@@ -0,0 +1,95 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+"""
+Benchmark of tiles downloads through the pool of keep-alive connections against a new urllib connection per tile,
+usable without Blender
+
+The same tiles are requested by several threads from a local stand-in tiles server, first with urlopen then with HTTPPool.
+Exit status is 1 if some requests failed.
+
+Usage example :
+python -m tests.httpbench --tiles 2000 --threads 8 --delay 0.002
+"""
+
+#built-in imports
+import sys
+import time
+import argparse
+import urllib.request
+import concurrent.futures
+
+#addon import
+from basemaps.mapservice import HTTPPool
+from .testserver import TestServer, TileHandler
+
+
+def run(fetch, urls, nbThreads):
+	'''Fetch the urls from nbThreads threads, return (duration, number of failed requests)'''
+	failed = 0
+	t0 = time.perf_counter()
+	with concurrent.futures.ThreadPoolExecutor(nbThreads) as executor:
+		for f in [executor.submit(fetch, url) for url in urls]:
+			try:
+				f.result()
+			except Exception as e:
+				print('Request failed : ' + str(e))
+				failed += 1
+	return time.perf_counter() - t0, failed
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Compare tiles downloads with urlopen and with the pool of keep-alive connections')
+	parser.add_argument('--tiles', type=int, default=2000, help='number of tiles requested')
+	parser.add_argument('--threads', type=int, default=8, help='number of download threads, also the max connections of the pool')
+	parser.add_argument('--delay', type=float, default=0.002, help='seconds, latency of the stand-in tiles server')
+	args = parser.parse_args()
+
+	server = TestServer(TileHandler, args.delay).start()
+	urls = ['http://127.0.0.1:' + str(server.port) + '/15/' + str(i) + '/0.png' for i in range(args.tiles)]
+	headers = {'User-Agent': 'BlenderGIS benchmark'}
+
+	def urlopen(url):
+		req = urllib.request.Request(url, None, headers)
+		with urllib.request.urlopen(req, timeout=3) as handle:
+			return handle.read()
+
+	pool = HTTPPool(maxConn=args.threads)
+	#the environment proxies don't apply to the local server
+	pool.proxies = {}
+	pooled = lambda url: pool.request(url, headers)
+
+	results = {}
+	for name, fetch in (('urlopen', urlopen), ('pooled', pooled)):
+		count = server.count
+		duration, failed = run(fetch, urls, args.threads)
+		results[name] = (duration, failed)
+		print(name + ' : ' + str(server.count - count) + ' requests in ' + str(round(duration, 2)) + 's, '
+			+ str(round(len(urls) / duration)) + ' tiles/s, ' + str(failed) + ' failed')
+	pool.close()
+	server.stop()
+
+	print('Speedup : x' + str(round(results['urlopen'][0] / results['pooled'][0], 2)))
+	ok = not any(failed for duration, failed in results.values())
+	print('OK' if ok else 'FAILED')
+	sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+	main()
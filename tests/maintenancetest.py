@@ -0,0 +1,90 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+"""
+Test of the caches maintenance, usable without Blender
+
+Two caches of a folder are filled beyond the size limits, then maintained once.
+The caches must fit the limits, and the pages freed by eviction must be released to the file system.
+Exit status is 1 if a limit is exceeded or free pages remain in the files.
+
+Usage example :
+python -m tests.maintenancetest --tiles 400 --tile-size 30000
+"""
+
+#built-in imports
+import os
+import sys
+import sqlite3
+import argparse
+import tempfile
+
+#addon import
+from basemaps.mapservice import GeoPackage, CachePolicy, TileMatrix, getFileSize
+from basemaps.servicesDefs import grids
+
+
+def fill(path, nbTiles, tileSize):
+	'''Create a cache of nbTiles random tiles of tileSize bytes'''
+	gpkg = GeoPackage(path, TileMatrix(grids['GLOBAL_MERCATOR']))
+	gpkg.importTiles((col, 0, 12, os.urandom(tileSize), 'png') for col in range(nbTiles))
+	gpkg.close()
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Fill caches beyond their size limits, maintain them and check the files shrink')
+	parser.add_argument('--tiles', type=int, default=400, help='number of tiles of each cache')
+	parser.add_argument('--tile-size', type=int, default=30000, help='bytes')
+	parser.add_argument('--max-cache', type=float, default=8, help='MB, size limit of each cache')
+	parser.add_argument('--max-folder', type=float, default=12, help='MB, size limit of the folder')
+	args = parser.parse_args()
+
+	folder = os.path.join(tempfile.mkdtemp(), '')
+	paths = [folder + 'A_L.gpkg', folder + 'B_L.gpkg']
+	for path in paths:
+		fill(path, args.tiles, args.tile_size)
+	before = sum(getFileSize(path) for path in paths)
+
+	maxCacheSize, maxFolderSize = int(args.max_cache * 1024**2), int(args.max_folder * 1024**2)
+	policy = CachePolicy(folder, maxCacheSize, maxFolderSize)
+	policy.maintain()
+
+	ok = True
+	sizes = []
+	for path in paths:
+		db = sqlite3.connect(path)
+		free = db.execute("PRAGMA freelist_count").fetchone()[0]
+		total = db.execute("PRAGMA page_count").fetchone()[0]
+		size = policy.getSize(db)
+		db.close()
+		sizes.append(size)
+		print(os.path.basename(path) + ' : ' + str(size) + ' bytes of tiles, ' + str(getFileSize(path)) + ' bytes on disk, '
+			+ str(free) + '/' + str(total) + ' free pages')
+		#a few pages can be freed by the last index updates, the evicted tiles must not remain
+		ok = ok and size <= maxCacheSize and free <= 0.01 * total
+	after = sum(getFileSize(path) for path in paths)
+	print('Folder : ' + str(sum(sizes)) + ' bytes of tiles, ' + str(before) + ' bytes on disk before maintenance, ' + str(after) + ' after')
+
+	ok = ok and sum(sizes) <= maxFolderSize and after < before
+	print('OK' if ok else 'FAILED')
+	sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+	main()
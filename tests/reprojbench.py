@@ -0,0 +1,117 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+"""
+Microbenchmark of coordinates reprojection, usable without Blender
+
+Points are reprojected one at a time then as numpy arrays, between lat long and web mercator,
+and with GDAL between lat long and another crs if osr is available (one transformation built per point against the cached one).
+Then tiles of a local stand-in tiles server are warped to another grid, and the warp stage timings are reported.
+Exit status is 1 if the vectorised results differ from the point by point ones.
+
+Usage example :
+python -m tests.reprojbench --points 100000 --epsg 2154
+"""
+
+#built-in imports
+import sys
+import time
+import argparse
+import tempfile
+
+#deps imports
+import numpy as np
+
+#addon import
+from basemaps.mapservice import reproj, PROJ
+from basemaps.metrics import metrics
+from basemaps.seeder import Seeder
+from .testserver import TestServer, TileHandler, tileSource, testSources
+
+if PROJ:
+	from osgeo import osr
+
+
+def reprojUncached(crs1, crs2, x, y):
+	'''Reproject a single point with GDAL, building the transformation like reproj did before it was cached'''
+	prjs = []
+	for crs in (crs1, crs2):
+		prj = osr.SpatialReference()
+		prj.ImportFromEPSG(crs)
+		if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+			prj.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+		prjs.append(prj)
+	return osr.CoordinateTransformation(*prjs).TransformPoint(x, y)[:2]
+
+
+def compare(name, pointwise, crs1, crs2, xs, ys):
+	'''Time the point by point function against vectorised reproj, return True if results match'''
+	t0 = time.perf_counter()
+	pts = np.array([pointwise(crs1, crs2, x, y) for x, y in zip(xs.tolist(), ys.tolist())])
+	t1 = time.perf_counter()
+	x2, y2 = reproj(crs1, crs2, xs, ys)
+	t2 = time.perf_counter()
+	print(name + ' : ' + str(len(xs)) + ' points, by point ' + str(round((t1 - t0) * 1000, 1)) + 'ms, vectorised '
+		+ str(round((t2 - t1) * 1000, 1)) + 'ms, speedup x' + str(round((t1 - t0) / (t2 - t1), 1)))
+	return np.allclose(pts[:,0], x2) and np.allclose(pts[:,1], y2)
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Compare point by point and vectorised reprojection, and time tiles warping')
+	parser.add_argument('--points', type=int, default=100000, help='number of points reprojected')
+	parser.add_argument('--epsg', type=int, default=2154, help='crs used to benchmark GDAL transformations')
+	parser.add_argument('--bbox', nargs=4, type=float, default=[2.0, 45.0, 3.0, 46.0], metavar=('XMIN', 'YMIN', 'XMAX', 'YMAX'),
+		help='lon/lat area of the points and of the warped tiles')
+	parser.add_argument('--zmin', type=int, default=8)
+	parser.add_argument('--zmax', type=int, default=11)
+	args = parser.parse_args()
+
+	xmin, ymin, xmax, ymax = args.bbox
+	lons = np.random.uniform(xmin, xmax, args.points)
+	lats = np.random.uniform(ymin, ymax, args.points)
+	xs, ys = reproj(4326, 3857, lons, lats)
+
+	ok = compare('4326 -> 3857', reproj, 4326, 3857, lons, lats)
+	ok = compare('3857 -> 4326', reproj, 3857, 4326, xs, ys) and ok
+	if PROJ:
+		#the uncached transformations are slow, a sample is enough
+		n = min(args.points, 2000)
+		ok = compare('4326 -> ' + str(args.epsg) + ' uncached', reprojUncached, 4326, args.epsg, lons[:n], lats[:n]) and ok
+		ok = compare('4326 -> ' + str(args.epsg) + ' cached', reproj, 4326, args.epsg, lons, lats) and ok
+	else:
+		print('GDAL osr not available, transformations to EPSG:' + str(args.epsg) + ' skipped')
+
+	#web mercator tiles warped to the lat long grid
+	server = TestServer(TileHandler).start()
+	metrics.reset()
+	with testSources({'REPROJ': tileSource(server.port)}):
+		seeder = Seeder('REPROJ:L', tempfile.mkdtemp(), args.bbox, 4326, args.zmin, args.zmax, dstGrid='GLOBAL_WGS84')
+		failed = seeder.run()
+	server.stop()
+	print('Warped tiles, ' + str(failed) + ' failed :')
+	for line in metrics.summary():
+		print('  ' + line)
+
+	ok = ok and not failed
+	print('OK' if ok else 'FAILED')
+	sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+	main()
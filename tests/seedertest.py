@@ -0,0 +1,82 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+"""
+Test of the cache seeding against a local stand-in tiles server, usable without Blender
+
+An area is seeded in an empty cache folder, every tile covering it must be estimated and stored with a single request per tile.
+The area is then seeded again, like a resumed seeding, no tile must be requested and the estimation must report them all as cached.
+Exit status is 1 if some tiles are missing or requested again.
+
+Usage example :
+python -m tests.seedertest --zmin 8 --zmax 12
+"""
+
+#built-in imports
+import os
+import sys
+import sqlite3
+import argparse
+import tempfile
+
+#addon import
+from basemaps.seeder import Seeder
+from .testserver import TestServer, TileHandler, tileSource, testSources
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Seed an area from a stand-in tiles server, then seed it again and check nothing is requested')
+	parser.add_argument('--bbox', nargs=4, type=float, default=[2.9, 45.7, 3.3, 45.95], metavar=('XMIN', 'YMIN', 'XMAX', 'YMAX'),
+		help='lon/lat area seeded')
+	parser.add_argument('--zmin', type=int, default=8)
+	parser.add_argument('--zmax', type=int, default=12)
+	parser.add_argument('--delay', type=float, default=0.02, help='seconds, latency of the stand-in tiles server')
+	args = parser.parse_args()
+
+	server = TestServer(TileHandler, args.delay).start()
+	with testSources({'SEEDTEST': tileSource(server.port)}):
+		folder = tempfile.mkdtemp()
+
+		seeder = Seeder('SEEDTEST:L', folder, args.bbox, 4326, args.zmin, args.zmax)
+		expected = set((z, col, row) for z in range(args.zmin, args.zmax + 1) for col, row in seeder.listTiles(z))
+		est = seeder.estimate()
+		failed = seeder.run()
+		nbRequests = server.count
+		db = sqlite3.connect(os.path.join(folder, 'SEEDTEST_L.gpkg'))
+		stored = set(db.execute("SELECT zoom_level, tile_column, tile_row FROM gpkg_tiles"))
+		db.close()
+		missing = expected - stored
+		print('First run : ' + str(len(expected)) + ' tiles expected (' + str(est['tiles']) + ' estimated, ' + str(est['cached']) + ' cached), '
+			+ str(nbRequests) + ' requests, ' + str(len(missing)) + ' missing, ' + str(failed) + ' failed')
+
+		seeder = Seeder('SEEDTEST:L', folder, args.bbox, 4326, args.zmin, args.zmax)
+		est2 = seeder.estimate()
+		failed2 = seeder.run()
+		nbRequests2 = server.count - nbRequests
+		print('Second run : ' + str(est2['cached']) + ' tiles cached, ' + str(nbRequests2) + ' requests, ' + str(failed2) + ' failed')
+	server.stop()
+
+	ok = (expected and not missing and not failed and nbRequests == len(expected) and est['tiles'] == len(expected)
+		and est['cached'] == 0 and est2['cached'] == len(expected) and not nbRequests2 and not failed2)
+	print('OK' if ok else 'FAILED')
+	sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+	main()
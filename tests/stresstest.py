@@ -0,0 +1,156 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+"""
+Stress test of a tiles cache shared by several processes, usable without Blender
+
+N processes seed overlapping areas of a layer, served by a local stand-in tiles server, in the same cache folder.
+Optionally another process holds long write transactions, like a maintenance or a vacuum would.
+Every tile of the areas must end up in the cache, and the database must pass sqlite integrity check.
+Exit status is 1 if some tiles are lost or the database is corrupted.
+
+Usage example :
+python -m tests.stresstest --processes 8 --locker
+"""
+
+#built-in imports
+import os
+import io
+import sys
+import time
+import sqlite3
+import argparse
+import tempfile
+import contextlib
+import multiprocessing
+
+#addon import
+from basemaps.mapservice import GeoPackage
+from basemaps.seeder import Seeder
+from .testserver import TestServer, TileHandler, tileSource, testSources
+
+MAP_KEY = 'STRESS:L'
+CACHE_NAME = 'STRESS_L.gpkg'
+
+
+def getArea(i):
+	'''Bbox (lon/lat) seeded by the ith process, each area overlaps the next ones'''
+	lon = 2.0 + i * 0.05
+	return (lon, 45.0, lon + 0.4, 45.4)
+
+
+def seed(i, port, folder, zmin, zmax, busyTimeout, retries, results):
+	'''Seed the area of the ith process, report (i, failed downloads, failed writes) in results queue'''
+	#test sources and class attributes are not inherited by spawned processes
+	GeoPackage.BUSY_TIMEOUT = busyTimeout
+	GeoPackage.WRITE_RETRIES = retries
+	#write errors are only printed by the writer thread of the cache
+	out = io.StringIO()
+	with testSources({'STRESS': tileSource(port)}), contextlib.redirect_stdout(out):
+		failed = Seeder(MAP_KEY, folder, getArea(i), 4326, zmin, zmax).run()
+	results.put((i, failed, out.getvalue().count('Unable to write')))
+
+
+def lock(path, stop, duration):
+	'''Hold write transactions of duration seconds on the database until stop is set'''
+	while not os.path.exists(path) and not stop.is_set():
+		time.sleep(0.01)
+	db = sqlite3.connect(path, timeout=60, isolation_level=None)
+	while not stop.is_set():
+		db.execute("BEGIN IMMEDIATE")
+		time.sleep(duration)
+		db.execute("COMMIT")
+		time.sleep(0.05)
+	db.close()
+
+
+def listExpected(port, folder, n, zmin, zmax):
+	'''Return the set of (zoom, col, row) tiles covering the areas of n processes'''
+	tiles = set()
+	with testSources({'STRESS': tileSource(port)}):
+		for i in range(n):
+			seeder = Seeder(MAP_KEY, folder, getArea(i), 4326, zmin, zmax)
+			for zoom in range(zmin, zmax + 1):
+				tiles.update((zoom, col, row) for col, row in seeder.listTiles(zoom))
+			seeder.srv.close()
+	return tiles
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Seed overlapping areas in the same cache from several processes and check no tile is lost')
+	parser.add_argument('--processes', type=int, default=8, help='number of seeding processes')
+	parser.add_argument('--zmin', type=int, default=10)
+	parser.add_argument('--zmax', type=int, default=13)
+	parser.add_argument('--folder', help='cache folder, default to a new temporary folder')
+	parser.add_argument('--locker', action='store_true', help='run another process holding long write transactions')
+	parser.add_argument('--lock-duration', type=float, default=0.3, help='seconds, duration of the locker transactions')
+	parser.add_argument('--busy-timeout', type=int, default=GeoPackage.BUSY_TIMEOUT, help='ms, sqlite busy timeout of the caches')
+	parser.add_argument('--retries', type=int, default=GeoPackage.WRITE_RETRIES, help='retries of a batch of writes when the database stays locked')
+	parser.add_argument('--delay', type=float, default=0.005, help='seconds, latency of the stand-in tiles server')
+	args = parser.parse_args()
+
+	folder = os.path.join(args.folder or tempfile.mkdtemp(), '')
+	os.makedirs(folder, exist_ok=True)
+	path = folder + CACHE_NAME
+	if os.path.exists(path):
+		parser.error('the cache ' + path + ' already exists, use an empty folder')
+
+	server = TestServer(TileHandler, args.delay).start()
+	print('Cache : ' + path)
+
+	results = multiprocessing.Queue()
+	procs = [multiprocessing.Process(target=seed, args=(i, server.port, folder, args.zmin, args.zmax,
+		args.busy_timeout, args.retries, results)) for i in range(args.processes)]
+	stop = multiprocessing.Event()
+	locker = multiprocessing.Process(target=lock, args=(path, stop, args.lock_duration)) if args.locker else None
+
+	t0 = time.time()
+	for p in procs:
+		p.start()
+	if locker is not None:
+		locker.start()
+	#results are read before joining, a process can't end while its queued data is not consumed
+	reports = [results.get() for p in procs]
+	for p in procs:
+		p.join()
+	stop.set()
+	if locker is not None:
+		locker.join()
+	duration = time.time() - t0
+
+	db = sqlite3.connect(path)
+	stored = set(db.execute("SELECT zoom_level, tile_column, tile_row FROM gpkg_tiles"))
+	integrity = db.execute("PRAGMA integrity_check").fetchone()[0]
+	db.close()
+	expected = listExpected(server.port, folder, args.processes, args.zmin, args.zmax)
+	lost = expected - stored
+
+	print(str(args.processes) + ' processes in ' + str(round(duration, 1)) + 's, ' + str(server.count) + ' tiles requests')
+	print('Failed downloads : ' + str(sum(r[1] for r in reports)) + ', failed writes : ' + str(sum(r[2] for r in reports)))
+	print('Tiles expected : ' + str(len(expected)) + ', stored : ' + str(len(stored)) + ', lost : ' + str(len(lost)))
+	print('Integrity check : ' + integrity)
+	server.stop()
+
+	ok = not lost and integrity == 'ok'
+	print('OK' if ok else 'FAILED')
+	sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,179 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+"""
+Local stand-in map servers (TMS and WMS) used by the test scripts, so they don't depend on (and don't load) real services
+
+The server runs in a thread of the calling process. The sources pointing to it are served to MapService
+by testSources() on a copy of servicesDefs.sources, they must be registered again in each process started by a test.
+"""
+
+#built-in imports
+import io
+import time
+import threading
+import http.server
+import socketserver
+import urllib.parse
+import contextlib
+import unittest.mock
+
+#deps imports
+import numpy as np
+from PIL import Image
+
+#addon import
+from basemaps import mapservice
+from basemaps.servicesDefs import sources
+
+
+class TileHandler(http.server.BaseHTTPRequestHandler):
+	"""TMS stand-in, answer each tile request with a plain png tile whose color depends on the url"""
+
+	protocol_version = 'HTTP/1.1' #keep-alive, like real tiles servers
+	disable_nagle_algorithm = True
+
+	def do_GET(self):
+		self.server.count += 1
+		if self.server.delay:
+			time.sleep(self.server.delay)
+		color = (hash(self.path) % 255, 100, 100)
+		buf = io.BytesIO()
+		Image.new('RGB', (256, 256), color).save(buf, 'PNG')
+		self.sendImage(buf.getvalue())
+
+	def sendImage(self, data):
+		self.send_response(200)
+		self.send_header('Content-Type', 'image/png')
+		self.send_header('Content-Length', str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+	def log_message(self, *args):
+		pass
+
+
+class WMSHandler(TileHandler):
+	"""
+	WMS stand-in, answer GetMap requests with a png rendering a pattern of the map coordinates,
+	so any tile is identical whatever the request (single tile or metatile) it was cut from
+	"""
+
+	CELL = 977.3 #map units, size of the pattern cells
+
+	def do_GET(self):
+		self.server.count += 1
+		if self.server.delay:
+			time.sleep(self.server.delay)
+		params = {k.upper():v for k, v in urllib.parse.parse_qsl(urllib.parse.urlsplit(self.path).query)}
+		xmin, ymin, xmax, ymax = map(float, params['BBOX'].split(','))
+		w, h = int(params['WIDTH']), int(params['HEIGHT'])
+		#coords of pixels centers
+		xs = xmin + (np.arange(w) + 0.5) * (xmax - xmin) / w
+		ys = ymax - (np.arange(h) + 0.5) * (ymax - ymin) / h
+		xs, ys = np.meshgrid(xs, ys)
+		img = np.zeros((h, w, 3), dtype=np.uint8)
+		img[..., 0] = np.floor(xs / self.CELL) % 256
+		img[..., 1] = np.floor(ys / self.CELL) % 256
+		buf = io.BytesIO()
+		Image.fromarray(img).save(buf, 'PNG')
+		self.sendImage(buf.getvalue())
+
+
+class TestServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+	"""Threaded http server on a free local port, count the requests received"""
+
+	daemon_threads = True
+
+	def __init__(self, handler, delay=0):
+		super().__init__(('127.0.0.1', 0), handler)
+		self.port = self.server_address[1]
+		self.delay = delay #seconds, simulated latency of each request
+		self.count = 0
+		self.thread = None
+
+	def start(self):
+		self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+		self.thread.start()
+		return self
+
+	def stop(self):
+		self.shutdown()
+		self.server_close()
+
+	def handle_error(self, request, client_address):
+		#clients closing their connections are expected
+		pass
+
+
+@contextlib.contextmanager
+def testSources(defs):
+	'''
+	Context manager making the {key: source} definitions available to MapService,
+	addon sources are copied so servicesDefs.sources is left untouched
+	'''
+	with unittest.mock.patch.object(mapservice, 'sources', dict(sources, **defs)):
+		yield
+
+
+def tileSource(port):
+	'''Return the definition of a TMS source served by a local TileHandler server, with a single layer named L'''
+	return {
+		"name" : 'Test tiles',
+		"description" : 'Local stand-in tiles server',
+		"service": 'TMS',
+		"grid": 'GLOBAL_MERCATOR',
+		"quadTree": False,
+		"layers" : {
+			"L" : {"urlKey" : '', "name" : 'Test layer', "format" : 'png', "zmin" : 0, "zmax" : 19}
+		},
+		"urlTemplate": "http://127.0.0.1:" + str(port) + "/{Z}/{X}/{Y}.png",
+		"referer": "http://127.0.0.1"
+	}
+
+
+def wmsSource(port, metaSize=None, metaBuffer=0):
+	'''Return the definition of a WMS source served by a local WMSHandler server, with a single layer named L'''
+	source = {
+		"name" : 'Test WMS',
+		"description" : 'Local stand-in WMS server',
+		"service": 'WMS',
+		"grid": 'GLOBAL_MERCATOR',
+		"layers" : {
+			"L" : {"urlKey" : 'test', "name" : 'Test layer', "format" : 'png', "style" : '', "zmin" : 0, "zmax" : 19}
+		},
+		"urlTemplate": {
+			"BASE_URL" : 'http://127.0.0.1:' + str(port) + '/wms?',
+			"SERVICE" : 'WMS',
+			"VERSION" : '1.1.1',
+			"REQUEST" : 'GetMap',
+			"SRS" : 'EPSG:{CRS}',
+			"LAYERS" : '{LAY}',
+			"FORMAT" : 'image/{FORMAT}',
+			"STYLES" : '{STYLE}',
+			"BBOX" : '{BBOX}',
+			"WIDTH" : '{WIDTH}',
+			"HEIGHT" : '{HEIGHT}'
+			},
+		"referer": "http://127.0.0.1"
+	}
+	if metaSize is not None:
+		source["metaSize"] = metaSize
+		source["metaBuffer"] = metaBuffer
+	return source
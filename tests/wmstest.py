@@ -0,0 +1,102 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+"""
+Test of WMS metatiles against a local stand-in WMS server, usable without Blender
+
+The same area is seeded from a source requesting one tile per GetMap call, and from a source requesting metatiles.
+Tiles cut from metatiles must be identical to single tiles, with fewer requests.
+Exit status is 1 if some tiles are missing or differ.
+
+Usage example :
+python -m tests.wmstest --meta-size 4 4 --meta-buffer 16
+"""
+
+#built-in imports
+import os
+import io
+import sys
+import time
+import sqlite3
+import argparse
+import tempfile
+
+#deps imports
+import numpy as np
+from PIL import Image
+
+#addon import
+from basemaps.seeder import Seeder
+from .testserver import TestServer, WMSHandler, wmsSource, testSources
+
+
+def seed(srcKey, folder, bbox, zmin, zmax):
+	'''Seed the bbox, return the tiles {(zoom, col, row): data} stored in cache and the number of failed tiles'''
+	seeder = Seeder(srcKey + ':L', folder, bbox, 4326, zmin, zmax)
+	failed = seeder.run()
+	db = sqlite3.connect(os.path.join(folder, srcKey + '_L.gpkg'))
+	tiles = {(z, x, y):data for z, x, y, data in db.execute("SELECT zoom_level, tile_column, tile_row, tile_data FROM gpkg_tiles")}
+	db.close()
+	return tiles, failed
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Compare tiles seeded by single GetMap requests and by metatiles from a stand-in WMS')
+	parser.add_argument('--bbox', nargs=4, type=float, default=[2.9, 45.7, 3.3, 45.95], metavar=('XMIN', 'YMIN', 'XMAX', 'YMAX'),
+		help='lon/lat area seeded')
+	parser.add_argument('--zmin', type=int, default=8)
+	parser.add_argument('--zmax', type=int, default=12)
+	parser.add_argument('--meta-size', nargs=2, type=int, default=[4, 4], metavar=('COLUMNS', 'ROWS'))
+	parser.add_argument('--meta-buffer', type=int, default=16, help='pixels')
+	parser.add_argument('--delay', type=float, default=0.1, help='seconds, latency of the stand-in WMS server')
+	args = parser.parse_args()
+
+	server = TestServer(WMSHandler, args.delay).start()
+	defs = {'WMSTEST': wmsSource(server.port), 'WMSTEST_META': wmsSource(server.port, args.meta_size, args.meta_buffer)}
+
+	results = {}
+	with testSources(defs):
+		for srcKey in ('WMSTEST', 'WMSTEST_META'):
+			folder = tempfile.mkdtemp()
+			count, t0 = server.count, time.time()
+			tiles, failed = seed(srcKey, folder, args.bbox, args.zmin, args.zmax)
+			results[srcKey] = tiles
+			print(srcKey + ' : ' + str(len(tiles)) + ' tiles, ' + str(server.count - count) + ' requests, '
+				+ str(round(time.time() - t0, 2)) + 's, ' + str(failed) + ' failed')
+	server.stop()
+
+	#metatiles can cache more tiles than requested (the whole metatile), compare the requested ones
+	single, meta = results['WMSTEST'], results['WMSTEST_META']
+	missing = [k for k in single if k not in meta]
+	nbDiff = 0
+	for k in single:
+		if k in meta:
+			a = np.asarray(Image.open(io.BytesIO(single[k])))
+			b = np.asarray(Image.open(io.BytesIO(meta[k])))
+			if a.shape != b.shape or (a != b).any():
+				nbDiff += 1
+	print('Tiles missing from metatiles : ' + str(len(missing)) + ', differing : ' + str(nbDiff))
+
+	ok = single and not missing and not nbDiff
+	print('OK' if ok else 'FAILED')
+	sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+	main()